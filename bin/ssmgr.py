@@ -5,6 +5,9 @@ import csv
 import os.path
 from collections import defaultdict
 
+# SampleSheet.py lives in runmgr/, next to this script once installed or one level up in the source tree
+HERE = os.path.dirname(os.path.abspath(__file__))
+
 def revcomp(seq):
     d = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
     return "".join( [ d[b] for b in seq[::-1] ] )
@@ -363,7 +366,31 @@ class Splitter(object):
             sys.stdout.write("Projects:\n  " + "\n  ".join(projects) + "\n")
 
     def check_barcode(self):
-        pass
+        """Report all samples whose barcodes are within one mismatch of the barcodes in
+`to_check' (comma-separated, each one in the form i7 or i7+i5)."""
+        for d in [os.path.join(HERE, "runmgr"), os.path.join(HERE, "..", "runmgr")]:
+            if os.path.isdir(d) and d not in sys.path:
+                sys.path.append(d)
+        import SampleSheet
+        ss = SampleSheet.SSParser()
+        if not ss.parse(self.infile):
+            return
+        lanes = defaultdict(SampleSheet.BarcodeIndex)
+        for proj in ss.projects.values():
+            for smp in proj.samples:
+                lanes[smp.lane].add(smp.i7index, smp.i5index, (proj, smp))
+        with open(self.outfile, "w") as out:
+            for bc in self.to_check.split(","):
+                bc = bc.strip().upper()
+                if "+" in bc:
+                    idx1, idx2 = bc.split("+", 1)
+                else:
+                    idx1, idx2 = bc, ""
+                for lane in sorted(lanes.keys(), key=lambda l: (not l.isdigit(), int(l) if l.isdigit() else 0, l)):
+                    index = lanes[lane]
+                    for (pos, d) in index.query(idx1, idx2, 1):
+                        proj, smp = index.items[pos]
+                        out.write("\t".join([bc, lane, proj.name, smp.sampleName, smp.i7index, smp.i5index, str(d)]) + "\n")
 
     def concat_sheets(self):
         with open(self.outfile, "w") as out:
@@ -428,7 +455,7 @@ Where options are:
   -w    | Swap i5 and i7 indexes. If specified together with -rc, swap happens after reverse-complement.
   -d    | Drop i5 indexes. If specified together with -w, drop happens after swap.
   -u U  | Replace barcodes in samplesheet with those specified in file U. 
-  -c C  | Check barcodes (not implemented yet)
+  -c C  | Check barcodes C (comma-separated, i7 or i7+i5) against the sample sheet.
   -b    | Show barcode configuration for each project.
   -B    | Print all barcodes.
   -n    | Do not write sample sheet header.
@@ -447,6 +474,10 @@ specified ones (e.g. -x 12 to only extract lanes 3 and 4). Note that -p cannot c
 combined with -l or -x. In all cases, the header of the sample sheet is included, unless 
 -n is used.
 
+With -c, prints all samples whose barcodes are within one mismatch of the specified ones,
+as: barcode, lane, project, sample, i7, i5, distance. Indexes of different lengths are 
+compared over their common prefix.
+
 With -a, concatenates all provided sample sheets into a single one. Header is taken from the
 first file. The only other option used in this case is -o.
 
@@ -29,8 +29,13 @@ the result is a string, while if it is "json" the result is a parsed JSON dictio
         else:
             return result.decode()
 
-    def getRuns(self, n=None):
-        data = self.call(["list", "runs", "-F",  "ExperimentName", "-F", "Status", "--sort-by=DateCreated"], fmt="json")
+    def getRuns(self, n=None, newerThan=None):
+        """Return the list of runs, sorted by creation date. If `newerThan' is specified
+(a date in YYYY-MM-DD format or a duration like 7d), only runs created after it are returned."""
+        arguments = ["list", "runs", "-F",  "ExperimentName", "-F", "Status", "--sort-by=DateCreated"]
+        if newerThan:
+            arguments.append("--newer-than=" + newerThan)
+        data = self.call(arguments, fmt="json")
         if n:
             return data[-n:]
         else:
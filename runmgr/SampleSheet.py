@@ -4,6 +4,11 @@ import sys
 import csv
 import os.path
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # Valid characters in sample IDs
 VALIDCHARS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz-_"
 
@@ -41,6 +46,368 @@ def validseq(seq):
             return False
     return True
 
+# Packed barcodes
+
+BASECODES = {'A': 0, 'C': 1, 'G': 2, 'T': 3, 'a': 0, 'c': 1, 'g': 2, 't': 3}
+MAXPACKED = 32                  # Bases that fit in a 64-bit word
+LOWBITS = 0x5555555555555555
+BLOCKSIZE = 4000000             # Max number of distances computed at once with numpy
+
+def packseq(seq):
+    """Encode `seq' as an integer using two bits per base, with the first base in the
+most significant bits. Returns None if `seq' is too long or contains non-ACGT characters."""
+    if len(seq) > MAXPACKED:
+        return None
+    code = 0
+    for b in seq:
+        if b not in BASECODES:
+            return None
+        code = (code << 2) | BASECODES[b]
+    return code
+
+def packedDistance(x, y):
+    """Number of mismatching bases between packed sequences `x' and `y' (same length)."""
+    x ^= y
+    return bin((x | (x >> 1)) & LOWBITS).count("1")
+
+def _nppopcount(x):
+    """Count mismatching bases in an array of XORed packed sequences."""
+    x = (x | (x >> np.uint64(1))) & np.uint64(LOWBITS)
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+class BarcodeMatrix(object):
+    """Hamming distances between the i7/i5 barcodes of a list of samples. Barcodes are
+packed two bits per base, and distances are computed in blocks with numpy when available,
+or on plain integers otherwise. Results are the same as calling distance() on each pair:
+when lengths differ, only the common prefix of each index is compared."""
+    samples = []
+    codes = []                  # (i7 code, i5 code) for each sample, or None if not packable
+    groups = {}                 # (len i7, len i5) -> positions of packable samples
+    unpacked = []               # Positions of samples that can't be packed
+    _arrays = {}                # Cache of numpy arrays for each group
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.codes = []
+        self.groups = {}
+        self.unpacked = []
+        self._arrays = {}
+        for pos in range(len(samples)):
+            smp = samples[pos]
+            c7 = packseq(smp.i7index)
+            c5 = packseq(smp.i5index)
+            if c7 is None or c5 is None:
+                self.codes.append(None)
+                self.unpacked.append(pos)
+                continue
+            self.codes.append((c7, c5))
+            sig = (len(smp.i7index), len(smp.i5index))
+            if sig in self.groups:
+                self.groups[sig].append(pos)
+            else:
+                self.groups[sig] = [pos]
+
+    def groupArrays(self, sig):
+        if sig not in self._arrays:
+            pos = self.groups[sig]
+            self._arrays[sig] = (np.array(pos, dtype=np.int64),
+                                 np.array([self.codes[p][0] for p in pos], dtype=np.uint64),
+                                 np.array([self.codes[p][1] for p in pos], dtype=np.uint64))
+        return self._arrays[sig]
+
+    def blocks(self, other):
+        """Yield (rows, cols, dist, diag) for all blocks of distances between the packable samples
+of this matrix and those of `other'. `rows' and `cols' are the sample positions and `dist'
+is the matrix of distances (numpy arrays, or lists when numpy is not available). `diag' is
+True when a group is compared with itself, in which case each pair appears twice."""
+        same = other is self
+        sigs1 = list(self.groups.keys())
+        sigs2 = list(other.groups.keys())
+        for i in range(len(sigs1)):
+            sig1 = sigs1[i]
+            for sig2 in (sigs1[i:] if same else sigs2):
+                # Shifts to truncate both sides to the common prefix of each index
+                m7 = min(sig1[0], sig2[0])
+                m5 = min(sig1[1], sig2[1])
+                s1 = (2 * (sig1[0] - m7), 2 * (sig1[1] - m5))
+                s2 = (2 * (sig2[0] - m7), 2 * (sig2[1] - m5))
+                diag = same and sig1 == sig2
+                if np is None:
+                    for (rows, cols, dist) in self._pyblocks(other, sig1, sig2, s1, s2):
+                        yield (rows, cols, dist, diag)
+                else:
+                    for (rows, cols, dist) in self._npblocks(other, sig1, sig2, s1, s2):
+                        yield (rows, cols, dist, diag)
+
+    def _pyblocks(self, other, sig1, sig2, s1, s2):
+        cols = other.groups[sig2]
+        codes2 = [ (other.codes[p][0] >> s2[0], other.codes[p][1] >> s2[1]) for p in cols ]
+        for p in self.groups[sig1]:
+            c7 = self.codes[p][0] >> s1[0]
+            c5 = self.codes[p][1] >> s1[1]
+            yield ([p], cols, [[ packedDistance(c7, b7) + packedDistance(c5, b5) for (b7, b5) in codes2 ]])
+
+    def _npblocks(self, other, sig1, sig2, s1, s2):
+        rows, a7, a5 = self.groupArrays(sig1)
+        cols, b7, b5 = other.groupArrays(sig2)
+        a7 = a7 >> np.uint64(s1[0])
+        a5 = a5 >> np.uint64(s1[1])
+        b7 = b7 >> np.uint64(s2[0])
+        b5 = b5 >> np.uint64(s2[1])
+        step = max(1, BLOCKSIZE // max(1, len(cols)))
+        for start in range(0, len(rows), step):
+            end = start + step
+            dist = _nppopcount(a7[start:end, None] ^ b7[None, :]) + _nppopcount(a5[start:end, None] ^ b5[None, :])
+            yield (rows[start:end], cols, dist)
+
+    def _unpackedPairs(self, other):
+        """Yield (i, j, d) for all pairs involving samples that could not be packed."""
+        same = other is self
+        done = set()
+        for p in self.unpacked:
+            done.add(p)
+            for q in range(len(other.samples)):
+                if same and (q in done or q == p):
+                    continue
+                yield (p, q, self._distance(p, other, q))
+        for q in other.unpacked:
+            if same:
+                continue
+            for p in range(len(self.samples)):
+                if self.codes[p] is not None:
+                    yield (p, q, self._distance(p, other, q))
+
+    def _distance(self, p, other, q):
+        s1 = self.samples[p]
+        s2 = other.samples[q]
+        return distance(s1.i7index, s2.i7index, s1.i5index, s2.i5index)
+
+    def pairs(self, maxdist, other=None):
+        """Return a sorted list of (i, j, d) for all pairs of samples at distance <= `maxdist'.
+If `other' is None, pairs are taken within this matrix (with i < j), otherwise i refers to
+a sample in this matrix and j to a sample in `other'."""
+        if other is None:
+            other = self
+        same = other is self
+        result = []
+        found = []
+        for (rows, cols, dist, diag) in self.blocks(other):
+            if np is None:
+                for i in range(len(rows)):
+                    drow = dist[i]
+                    for j in range(len(cols)):
+                        if drow[j] <= maxdist and (not diag or rows[i] < cols[j]):
+                            found.append((rows[i], cols[j], drow[j]))
+            else:
+                mask = dist <= maxdist
+                if diag:
+                    mask &= rows[:, None] < cols[None, :]
+                ii, jj = np.nonzero(mask)
+                for i, j in zip(ii.tolist(), jj.tolist()):
+                    found.append((int(rows[i]), int(cols[j]), int(dist[i, j])))
+        for (p, q, d) in self._unpackedPairs(other):
+            if d <= maxdist:
+                found.append((p, q, d))
+        for (p, q, d) in found:
+            result.append((min(p, q), max(p, q), d) if same else (p, q, d))
+        result.sort()
+        return result
+
+    def minDistance(self, default=100):
+        """Return the minimum distance between any two samples, or `default' if there are fewer than two."""
+        mbd = default
+        for (rows, cols, dist, diag) in self.blocks(self):
+            if np is None:
+                for i in range(len(rows)):
+                    for j in range(len(cols)):
+                        if not diag or rows[i] < cols[j]:
+                            mbd = min(mbd, dist[i][j])
+            elif diag:
+                mask = rows[:, None] < cols[None, :]
+                if mask.any():
+                    mbd = min(mbd, int(dist[mask].min()))
+            elif dist.size:
+                mbd = min(mbd, int(dist.min()))
+        for (p, q, d) in self._unpackedPairs(self):
+            mbd = min(mbd, d)
+        return mbd
+
+def hamming(a, b):
+    """Number of mismatches between two strings of the same length."""
+    d = 0
+    for i in range(len(a)):
+        if a[i] != b[i]:
+            d += 1
+    return d
+
+def hashKeys(key, maxdist):
+    """Return the hash keys under which two barcodes of the same length that are within
+`maxdist' of each other are guaranteed to share at least one entry. For one mismatch these
+are the barcode with each position masked out in turn; for more, the barcode is split into
+maxdist+1 parts, at least one of which has to match exactly (pigeonhole principle)."""
+    ln = len(key)
+    if maxdist == 0 or ln == 0:
+        return [key]
+    if maxdist == 1:
+        return [ (p, key[:p] + key[p+1:]) for p in range(ln) ]
+    nparts = maxdist + 1
+    bounds = [ ln * k // nparts for k in range(nparts + 1) ]
+    return [ (k, key[bounds[k]:bounds[k+1]]) for k in range(nparts) ]
+
+class BarcodeIndex(object):
+    """Hash index of combined i7+i5 barcodes, to find all pairs of barcodes within a small
+distance in roughly linear time. Barcodes are grouped by the lengths of their indexes; when
+comparing groups with different lengths only the common prefix of each index is used, as
+in distance()."""
+    items = []                  # Object associated with each barcode
+    i7s = []
+    i5s = []
+    groups = {}                 # (len i7, len i5) -> positions
+    _buckets = {}               # (group, len i7, len i5, maxdist) -> {hash key: positions}
+    _conflicts = {}             # maxdist -> list of (i, j, d)
+
+    def __init__(self, samples=None):
+        self.items = []
+        self.i7s = []
+        self.i5s = []
+        self.groups = {}
+        self._buckets = {}
+        self._conflicts = {}
+        if samples:
+            for smp in samples:
+                self.add(smp.i7index, smp.i5index, smp)
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, i7, i5, item=None):
+        """Add barcode `i7'+`i5' to the index, associating it with `item'. Returns its position."""
+        pos = len(self.items)
+        self.items.append(item)
+        self.i7s.append(i7)
+        self.i5s.append(i5)
+        sig = (len(i7), len(i5))
+        if sig in self.groups:
+            self.groups[sig].append(pos)
+        else:
+            self.groups[sig] = [pos]
+        self._buckets = {}
+        self._conflicts = {}
+        return pos
+
+    def key(self, pos, m7, m5):
+        return self.i7s[pos][:m7] + self.i5s[pos][:m5]
+
+    def buckets(self, sig, m7, m5, maxdist):
+        """Return the hash table for group `sig', using barcodes truncated to `m7'+`m5'."""
+        bk = (sig, m7, m5, maxdist)
+        if bk not in self._buckets:
+            table = {}
+            for pos in self.groups[sig]:
+                for h in hashKeys(self.key(pos, m7, m5), maxdist):
+                    if h in table:
+                        table[h].append(pos)
+                    else:
+                        table[h] = [pos]
+            self._buckets[bk] = table
+        return self._buckets[bk]
+
+    def conflicts(self, maxdist=1):
+        """Return a sorted list of (i, j, d) for all pairs of barcodes at distance <= `maxdist', with i < j."""
+        if maxdist in self._conflicts:
+            return self._conflicts[maxdist]
+        candidates = set()
+        sigs = list(self.groups.keys())
+        for a in range(len(sigs)):
+            sig1 = sigs[a]
+            for sig2 in sigs[a:]:
+                m7 = min(sig1[0], sig2[0])
+                m5 = min(sig1[1], sig2[1])
+                table = self.buckets(sig1, m7, m5, maxdist)
+                if sig1 == sig2:
+                    for positions in table.values():
+                        for i in range(len(positions)):
+                            for j in range(i+1, len(positions)):
+                                candidates.add((positions[i], positions[j]))
+                else:
+                    for q in self.groups[sig2]:
+                        for h in hashKeys(self.key(q, m7, m5), maxdist):
+                            for p in table.get(h, []):
+                                candidates.add((min(p, q), max(p, q)))
+        result = []
+        for (i, j) in candidates:
+            d = distance(self.i7s[i], self.i7s[j], self.i5s[i], self.i5s[j])
+            if d <= maxdist:
+                result.append((i, j, d))
+        result.sort()
+        self._conflicts[maxdist] = result
+        return result
+
+    def query(self, i7, i5, maxdist=1):
+        """Return a sorted list of (pos, d) for all barcodes within `maxdist' of `i7'+`i5'."""
+        result = set()
+        for sig in self.groups:
+            m7 = min(len(i7), sig[0])
+            m5 = min(len(i5), sig[1])
+            table = self.buckets(sig, m7, m5, maxdist)
+            for h in hashKeys(i7[:m7] + i5[:m5], maxdist):
+                for p in table.get(h, []):
+                    d = distance(i7, self.i7s[p], i5, self.i5s[p])
+                    if d <= maxdist:
+                        result.add((p, d))
+        return sorted(result)
+
+    def minDistance(self, default=100):
+        """Return the minimum distance between any two barcodes. Pairs within two mismatches
+are found with the index, larger distances require comparing all pairs."""
+        for maxdist in [0, 1, 2]:
+            if self.conflicts(maxdist):
+                return maxdist
+        if len(self.items) < 2:
+            return default
+        smps = [ Sample("", "") for i in range(len(self.items)) ]
+        for i in range(len(smps)):
+            smps[i].i7index = self.i7s[i]
+            smps[i].i5index = self.i5s[i]
+        return BarcodeMatrix(smps).minDistance(default)
+
+def similarBarcodes(bc, seqs, maxdist):
+    """Return the positions and distances of the sequences in `seqs' that are within
+`maxdist' of barcode `bc', comparing the common prefix only (as distance() does)."""
+    result = []
+    code = packseq(bc)
+    if code is None or np is None:
+        for i in range(len(seqs)):
+            d = distance(bc, seqs[i], '', '')
+            if d <= maxdist:
+                result.append((i, d))
+        return result
+    bylen = {}
+    for i in range(len(seqs)):
+        s = seqs[i]
+        if len(s) in bylen:
+            bylen[len(s)].append(i)
+        else:
+            bylen[len(s)] = [i]
+    for (ln, positions) in bylen.items():
+        codes = [ packseq(seqs[i]) for i in positions ]
+        if None in codes:
+            for i in positions:
+                d = distance(bc, seqs[i], '', '')
+                if d <= maxdist:
+                    result.append((i, d))
+            continue
+        m = min(ln, len(bc))
+        a = np.uint64(code >> (2 * (len(bc) - m)))
+        b = np.array(codes, dtype=np.uint64) >> np.uint64(2 * (ln - m))
+        dist = _nppopcount(b ^ a)
+        for j in np.nonzero(dist <= maxdist)[0].tolist():
+            result.append((positions[j], int(dist[j])))
+    result.sort()
+    return result
+
 # Classes
 
 class Sample(object):
@@ -77,6 +444,7 @@ class Project(object):
         self.name = name
         self.lanes = {}
         self.samples = []
+        self._indexes = {}      # lane -> BarcodeIndex
 
     def save(self, out):
         for lanesamples in self.lanes.values():
@@ -89,6 +457,17 @@ class Project(object):
             self.lanes[sample.lane].append(sample)
         else:
             self.lanes[sample.lane] = [sample]
+        self._indexes.pop(sample.lane, None)
+
+    def barcodeIndex(self, lane):
+        """Return a BarcodeIndex of the samples in `lane'. Items are (project, position) pairs."""
+        if lane not in self._indexes:
+            index = BarcodeIndex()
+            lanesamples = self.lanes[lane]
+            for i in range(len(lanesamples)):
+                index.add(lanesamples[i].i7index, lanesamples[i].i5index, (self, i))
+            self._indexes[lane] = index
+        return self._indexes[lane]
 
     def nsamples(self):
         return len(self.samples)
@@ -119,13 +498,21 @@ class Project(object):
                 return "Project {}: bad characters in sample names.".format(self.name)
         return False
 
-    def checkBarcodes(self, lane):
+    def checkBarcodes(self, lane, index=None):
+        """Check the barcodes of this project in `lane'. If supplied, `index' should be a
+BarcodeIndex of the lane (see SSParser.laneIndex), otherwise one is built for this project."""
         warns = []
         warnDiffLength = True
         lanesamples = self.lanes[lane]
         n = len(lanesamples)
         smp1 = lanesamples[0]
         bclen = len(smp1.i7index) + len(smp1.i5index)
+        conflicts = {}
+        for (i, j) in self.laneConflicts(lane, self, index):
+            if i in conflicts:
+                conflicts[i].append(j)
+            else:
+                conflicts[i] = [j]
 
         for i in range(n):
             isample = lanesamples[i]
@@ -138,39 +525,48 @@ class Project(object):
                 warns.append("Project {}, lane {}: invalid characters in i7 index for sample `{}'.".format(self.name, lane, isample.sampleName))
             if not validseq(isample.i5index):
                 warns.append("Project {}, lane {}: invalid characters in i5 index for sample `{}'.".format(self.name, lane, isample.sampleName))
-            for j in range(i+1, n-1):
+            for j in conflicts.get(i, []):
                 jsample = lanesamples[j]
-                d = distance(isample.i7index, jsample.i7index, isample.i5index, jsample.i5index)
-                if d <= 1:
-                    warns.append("Project {}, lane {}: potential barcode conflict, samples `{}' and `{}'".format(self.name, lane, isample.sampleName, jsample.sampleName))
+                warns.append("Project {}, lane {}: potential barcode conflict, samples `{}' and `{}'".format(self.name, lane, isample.sampleName, jsample.sampleName))
         return warns
 
-    def checkBarcodesOther(self, lane, proj2):
+    def checkBarcodesOther(self, lane, proj2, index=None):
         """Check every barcode of this project against all barcodes of proj2."""
         warns = []
         lanesamples1 = self.lanes[lane]
         lanesamples2 = proj2.lanes[lane]
-        for isample in lanesamples1:
-            for jsample in lanesamples2:
-                d = distance(isample.i7index, jsample.i7index, isample.i5index, jsample.i5index)
-                if d <= 1:
-                    warns.append("Project {}, lane {}: potential barcode conflict, samples `{}' and `{}' ({})".format(self.name, lane, isample.sampleName, jsample.sampleName, proj2.name))
+        if index is None:
+            index = BarcodeIndex()
+            for proj in [self, proj2]:
+                lanesamples = proj.lanes[lane]
+                for i in range(len(lanesamples)):
+                    index.add(lanesamples[i].i7index, lanesamples[i].i5index, (proj, i))
+        for (i, j) in self.laneConflicts(lane, proj2, index):
+            isample = lanesamples1[i]
+            jsample = lanesamples2[j]
+            warns.append("Project {}, lane {}: potential barcode conflict, samples `{}' and `{}' ({})".format(self.name, lane, isample.sampleName, jsample.sampleName, proj2.name))
         return warns
 
+    def laneConflicts(self, lane, proj2, index=None):
+        """Return the sorted (i, j) positions of samples of this project and of `proj2'
+(possibly this project itself, in which case i < j) whose barcodes are within one mismatch."""
+        if index is None:
+            index = self.barcodeIndex(lane)
+        result = []
+        for (a, b, d) in index.conflicts(1):
+            pa, i = index.items[a]
+            pb, j = index.items[b]
+            if pa is self and pb is proj2:
+                result.append((min(i, j), max(i, j)) if proj2 is self else (i, j))
+            elif pa is proj2 and pb is self:
+                result.append((j, i))
+        result.sort()
+        return result
+
     def minBarcodeDistance(self):
         mbd = 100
         for lane in self.lanes:
-            lanesamples = self.lanes[lane]
-            n = len(lanesamples)
-            #print((self.name, lane, len(lanesamples)))
-            for i in range(n):
-                isample = lanesamples[i]
-                for j in range(i+1, n-1):
-                    jsample = lanesamples[j]
-                    d = distance(isample.i7index, jsample.i7index, isample.i5index, jsample.i5index)
-                    if d == 0:
-                        print((i, j, d, isample.i7index, jsample.i7index, isample.i5index, jsample.i5index))
-                mbd = min(mbd, d)
+            mbd = min(mbd, self.barcodeIndex(lane).minDistance(mbd))
         return mbd
 
     def modifyIndexes(self, which, op=revcomp):
@@ -179,6 +575,7 @@ class Project(object):
                 smp.i7index = op(smp.i7index)
             elif which == "i5":
                 smp.i7index = op(smp.i7index)
+        self._indexes = {}
 
 class SSParser(object):
     projects = {}
@@ -333,40 +730,60 @@ class SSParser(object):
     def findSimilarBarcodes(self, bc):
         sys.stdout.write("Index {}:\n".format(bc))
         for proj in self.projects.values():
+            # Each sample contributes its i7 and (if present) its i5 index, in this order
+            seqs = []
+            owners = []
             for smp in proj.samples:
-                d = distance(bc, smp.i7index, '', '')
-                if d <= 2:
-                    sys.stdout.write("{}\t{}\t{}\t{}\n".format(proj.name, smp.sampleName, smp.i7index, d))
+                seqs.append(smp.i7index)
+                owners.append(smp)
                 if smp.i5index:
-                    d = distance(bc, smp.i5index, '', '')
-                    if d <= 2:
-                        sys.stdout.write("{}\t{}\t{}\t{}\n".format(proj.name, smp.sampleName, smp.i5index, d))
+                    seqs.append(smp.i5index)
+                    owners.append(smp)
+            for (i, d) in similarBarcodes(bc, seqs, 2):
+                sys.stdout.write("{}\t{}\t{}\t{}\n".format(proj.name, owners[i].sampleName, seqs[i], d))
+
+    def laneIndex(self, lane):
+        """Return a BarcodeIndex of all samples in `lane', across all projects.
+Items are (project, position) pairs."""
+        index = BarcodeIndex()
+        for proj in self.laneprojects[lane]:
+            lanesamples = proj.lanes[lane]
+            for i in range(len(lanesamples)):
+                index.add(lanesamples[i].i7index, lanesamples[i].i5index, (proj, i))
+        return index
 
     def verify(self):
         warnings = []
-        badLanes = []
-
-        # Check for barcodes with a single mismatch in each lane
         for lane in self.laneprojects:
-            laneprojs = self.laneprojects[lane]
-            for i in range(len(laneprojs)):
-                proj1 = laneprojs[i]
-                if proj1.checkLaneNumber():
-                    warnings.append("Project {}: incorrect lane number(s).".format(proj1.name))
-                w = proj1.checkSampleNames()
-                if w:
-                    warnings.append(w)
-                w = proj1.checkSingleDual(lane)
-                if w:
-                    warnings.append(w)
-                w = proj1.checkBarcodes(lane)
+            warnings += self.verifyLane(lane)
+        return warnings
+
+    def verifyLane(self, lane):
+        """Return the warnings for the projects in `lane'. Lanes are independent, so they can be
+checked one at a time to report progress on large sample sheets."""
+        warnings = []
+
+        # Check for barcodes with a single mismatch in the lane
+        laneprojs = self.laneprojects[lane]
+        index = self.laneIndex(lane)
+        for i in range(len(laneprojs)):
+            proj1 = laneprojs[i]
+            if proj1.checkLaneNumber():
+                warnings.append("Project {}: incorrect lane number(s).".format(proj1.name))
+            w = proj1.checkSampleNames()
+            if w:
+                warnings.append(w)
+            w = proj1.checkSingleDual(lane)
+            if w:
+                warnings.append(w)
+            w = proj1.checkBarcodes(lane, index)
+            if w:
+                warnings += w
+            for j in range(i+1, len(laneprojs)):
+                proj2 = laneprojs[j]
+                w = proj1.checkBarcodesOther(lane, proj2, index)
                 if w:
                     warnings += w
-                for j in range(i+1, len(laneprojs)):
-                    proj2 = laneprojs[j]
-                    w = proj1.checkBarcodesOther(lane, proj2)
-                    if w:
-                        warnings += w
         return warnings
 
     def saveToFile(self, filename):
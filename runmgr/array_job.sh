@@ -0,0 +1,13 @@
+#!/bin/bash
+
+## Run one task of a job array submitted by rundb.
+## Usage: array_job.sh script argsfile
+##   script   = batch script to run
+##   argsfile = file with the arguments of each task, one tab-separated line per task
+## The task reads line number SLURM_ARRAY_TASK_ID+1 of argsfile.
+
+SCRIPT=$1
+ARGSFILE=$2
+
+IFS=$'\t' read -r -a ARGS < <(sed -n "$((SLURM_ARRAY_TASK_ID+1))p" $ARGSFILE)
+exec bash $SCRIPT "${ARGS[@]}"
@@ -31,6 +31,47 @@ BCL="${binPath}/bcl2fastq.qsub"
 REP="${binPath}/runmgr/makeReports.sh"
 PDS="${binPath}/parse_demux_stats.py"
 EDIT="${binPath}/runmgr/edit_samplesheet.sh"
+EVENT="${binPath}/runmgr/post_event.sh"
+ARRAY="${binPath}/runmgr/array_job.sh"
+
+# Job completion events
+## Note: jobs append a line to this file when they finish (see post_event.sh),
+##       so that rundb doesn't have to look for marker files at every update.
+##       It must be writable by the jobs and readable by rundb. Leave empty to
+##       disable events and only use marker files. Upload jobs should report with:
+##       $EVENT upload <run> <project> <exit code>
+eventsFile="${binPath}/runmgr/events.log"
+
+# Job submission
+## Note: with submitMode=single (the default), each job is submitted separately with
+##       the `submit' command. With submitMode=array, all the jobs started in the same
+##       update cycle that run the same script are submitted with a single sbatch call,
+##       as a job array: this calls sbatch directly, bypassing the `submit' wrapper
+##       (jobs with their own submit command, like uploads, still use it). The arguments
+##       of each array are written to a file in jobsDirectory, which must be readable
+##       from the compute nodes. sbatchOptions are added to every sbatch call (e.g.
+##       --account or --qos).
+submitMode=single
+sbatch=sbatch
+sbatchOptions=
+jobsDirectory="${binPath}/runmgr/jobs"
+
+## Note: the state of the jobs of ongoing operations is checked at every update with
+##       one sacct call, and operations whose job failed, timed out, ran out of memory
+##       or was preempted are marked as failed. Set sacct to fake_sacct.sh for testing.
+sacct=sacct
 
 # Run bcl2fastq in scratch directory?
 USE_SCRATCH=true
+
+## Settings for `rundb serve'. Intervals are in seconds: pollInterval for completion
+## checks and job submissions, syncInterval for loading new runs from Basespace.
+## controlSocket is the Unix socket used to request an immediate refresh (default:
+## the database path followed by .sock).
+pollInterval=10
+syncInterval=300
+controlSocket=
+
+## Maximum number of job submissions and completion checks run at the same time
+## during an update (default: 4).
+updateWorkers=4
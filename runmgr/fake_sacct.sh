@@ -0,0 +1,23 @@
+#!/bin/bash
+
+## Stand-in for sacct, for testing rundb without Slurm. Set sacct to the path of this
+## script in the config. Job states are read from the file in $FAKE_SACCT_STATES (default:
+## fake_sacct.states in the current directory), one "jobid state" pair per line. Prints
+## the states of the jobs requested with --jobs= in the format of sacct --parsable2.
+
+STATES=${FAKE_SACCT_STATES:-fake_sacct.states}
+
+for arg in "$@";
+do
+  if [[ $arg == --jobs=* ]];
+  then
+    for job in $(echo ${arg#--jobs=} | tr ',' ' ');
+    do
+      state=$(awk -v j=$job '$1 == j {print $2}' $STATES 2>/dev/null)
+      if [[ -n $state ]];
+      then
+        echo "${job}|${state}"
+      fi
+    done
+  fi
+done
@@ -2,7 +2,219 @@
 
 import sys
 import json
+from os import getenv
+import heapq
+import hashlib
+from io import StringIO
 import os.path # REMOVE - this is only to make the Excel link work!
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# SampleSheet.py is in runmgr/, next to this script once installed, or in the same directory
+# in the source tree. Without it unknown barcodes are not matched against the sample indexes
+HERE = os.path.dirname(os.path.abspath(__file__))
+if os.path.isdir(os.path.join(HERE, "runmgr")):
+    sys.path.append(os.path.join(HERE, "runmgr"))
+try:
+    import SampleSheet
+except ImportError:
+    SampleSheet = None
+
+# Number of unknown barcodes kept for each lane when reading Stats.json
+NUNKNOWN = 20
+
+# Buffer size for the report files
+BUFSIZE = 1<<20
+
+# Maximum number of project reports written at the same time in batch mode, unless set
+# with -j. Each worker holds a whole Stats.json in memory
+MAXWORKERS = 4
+
+# A sample sheet orientation mistake is reported for a lane when the indexes of at least this
+# many samples (or all of them, if fewer), transformed in the same way, account for at least
+# this fraction of the unknown reads
+ORIENTATION_MIN_SAMPLES = 3
+ORIENTATION_MIN_FRACTION = 0.1
+
+# Stats.json reader
+
+class TopBarcodes(object):
+    """The `n' most frequent unknown barcodes of a lane, and the total count of all of them,
+without storing the others."""
+    lane = None
+    n = NUNKNOWN
+    total = 0
+    heap = []
+    seen = 0
+
+    def __init__(self, n=NUNKNOWN):
+        self.n = n
+        self.total = 0
+        self.heap = []
+        self.seen = 0
+
+    def add(self, bc, count):
+        self.total += count
+        self.seen += 1
+        # Negated position, so on equal counts the barcode that came first is kept
+        item = (count, -self.seen, bc)
+        if len(self.heap) < self.n:
+            heapq.heappush(self.heap, item)
+        elif self.heap and item > self.heap[0]:
+            heapq.heapreplace(self.heap, item)
+
+    def result(self):
+        """Return an UnknownBarcodes entry with only the top barcodes, most frequent first."""
+        return {"Lane": self.lane,
+                "Barcodes": { bc: count for (count, pos, bc) in sorted(self.heap, reverse=True) },
+                "Total": self.total}
+
+class JsonStream(object):
+    """Minimal incremental reader of a JSON text, used when ijson is not available. Values
+are decoded one at a time by the json module, reading more of the file only as needed."""
+    decoder = json.JSONDecoder()
+
+    def __init__(self, f, chunksize=1<<20):
+        self.f = f
+        self.chunksize = chunksize
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, n):
+        """Make sure that at least `n' characters are available, unless the file ends first."""
+        while len(self.buf) - self.pos < n and not self.eof:
+            data = self.f.read(max(self.chunksize, n - len(self.buf) + self.pos))
+            if data:
+                self.buf = self.buf[self.pos:] + data
+                self.pos = 0
+            else:
+                self.eof = True
+
+    def peek(self):
+        """Return the next non-blank character, without consuming it."""
+        while True:
+            self.fill(1)
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos] if self.pos < len(self.buf) else ""
+
+    def expect(self, c):
+        if self.peek() != c:
+            raise ValueError("Bad JSON: expected `{}' at `{}'".format(c, self.buf[self.pos:self.pos+20]))
+        self.pos += 1
+
+    def skip(self, c):
+        """Consume the next character if it is `c'."""
+        if self.peek() == c:
+            self.pos += 1
+
+    def value(self):
+        """Decode the next complete value."""
+        self.peek()
+        more = self.chunksize
+        while True:
+            try:
+                v, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return v
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill(len(self.buf) - self.pos + more)
+            more *= 2
+
+def _readUnknown(js, nunknown):
+    result = []
+    js.expect("[")
+    while js.peek() != "]":
+        top = TopBarcodes(nunknown)
+        js.expect("{")
+        while js.peek() != "}":
+            key = js.value()
+            js.expect(":")
+            if key == "Barcodes":
+                js.expect("{")
+                while js.peek() != "}":
+                    bc = js.value()
+                    js.expect(":")
+                    top.add(bc, js.value())
+                    js.skip(",")
+                js.expect("}")
+            elif key == "Lane":
+                top.lane = js.value()
+            else:
+                js.value()
+            js.skip(",")
+        js.expect("}")
+        result.append(top.result())
+        js.skip(",")
+    js.expect("]")
+    return result
+
+def _readStatsStdlib(f, nunknown):
+    data = {}
+    js = JsonStream(f)
+    js.expect("{")
+    while js.peek() != "}":
+        key = js.value()
+        js.expect(":")
+        if key == "UnknownBarcodes":
+            data[key] = _readUnknown(js, nunknown)
+        else:
+            data[key] = js.value()
+        js.skip(",")
+    return data
+
+def _readStatsIjson(f, nunknown):
+    data = {"UnknownBarcodes": []}
+    builder = None
+    top = None
+    bc = None
+    for (prefix, event, value) in ijson.parse(f, use_float=True):
+        if builder:
+            builder.event(event, value)
+            if prefix == section and event in ["end_array", "end_map"]:
+                data[section] = builder.value
+                builder = None
+        elif prefix.startswith("UnknownBarcodes."):
+            if prefix == "UnknownBarcodes.item" and event == "start_map":
+                top = TopBarcodes(nunknown)
+            elif prefix == "UnknownBarcodes.item" and event == "end_map":
+                data["UnknownBarcodes"].append(top.result())
+            elif prefix == "UnknownBarcodes.item.Lane":
+                top.lane = value
+            elif prefix == "UnknownBarcodes.item.Barcodes" and event == "map_key":
+                bc = value
+            elif prefix.startswith("UnknownBarcodes.item.Barcodes.") and event == "number":
+                top.add(bc, value)
+        elif "." not in prefix and prefix not in ["", "UnknownBarcodes"]:
+            if event in ["start_array", "start_map"]:
+                section = prefix
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+            elif event != "map_key":
+                data[prefix] = value
+    return data
+
+def readStats(filename, nunknown=NUNKNOWN):
+    """Read a bcl2fastq Stats.json file in a single pass, keeping only the `nunknown' most
+frequent barcodes of each lane in UnknownBarcodes (each entry also gets the total count of
+unknown barcodes in Total). Memory use does not depend on the number of unknown barcodes.
+Uses ijson if available."""
+    if ijson:
+        with open(filename, "rb") as f:
+            return _readStatsIjson(f, nunknown)
+    with open(filename, "r") as f:
+        return _readStatsStdlib(f, nunknown)
 
 # Accessors
 
@@ -17,38 +229,93 @@ def getLanes(data):
         lanes.append(ri["LaneNumber"])
     return lanes
 
-def getSampleData(data):
-    total = 0
-    samples = {}
-    for conv in data["ConversionResults"]:
-        for smpinfo in conv["DemuxResults"]:
-            sn = smpinfo["SampleName"]
-            nr = smpinfo["NumberReads"]
-            ix = smpinfo["IndexMetrics"][0]["IndexSequence"]
-            total += nr
-            if sn in samples:
-                samples[sn][0] += nr
-            else:
-                samples[sn] = [nr, 0.0, ix]
-    for sn in samples.keys():
-        sdata = samples[sn]
-        pct = 100.0 * sdata[0] / total
-        sdata[1] = pct
-    samples["##Total"] = total
-    return samples
-
-def getUnknown(data):
-    result = {}
+# Unknown barcodes analysis
+
+# Changes to the sample sheet indexes that could explain unknown barcodes, as the -rc and -w
+# options of ssmgr (reverse-complement index 1, 2 or both, then swap): (rc, swap, description)
+TRANSFORMS = [("", False, ""),
+              ("1", False, "i7 reverse-complemented"),
+              ("2", False, "i5 reverse-complemented"),
+              ("12", False, "i7 and i5 reverse-complemented"),
+              ("", True, "i7 and i5 swapped"),
+              ("1", True, "i7 reverse-complemented, then swapped"),
+              ("2", True, "i5 reverse-complemented, then swapped"),
+              ("12", True, "both reverse-complemented, then swapped")]
+
+def transformIndexes(i7, i5, rc, swap):
+    """Apply a TRANSFORMS entry to a pair of indexes. Returns None if it does not apply (invalid
+bases, a missing i5, or indexes of different lengths for a swap)."""
+    if "1" in rc:
+        if not SampleSheet.validseq(i7):
+            return None
+        i7 = SampleSheet.revcomp(i7)
+    if "2" in rc:
+        if not i5 or not SampleSheet.validseq(i5):
+            return None
+        i5 = SampleSheet.revcomp(i5)
+    if swap:
+        if len(i7) != len(i5):
+            return None
+        (i7, i5) = (i5, i7)
+    return (i7, i5)
+
+def analyzeUnknown(data):
+    """Match the top unknown barcodes of each lane of Stats `data' against the indexes of the
+samples in the lane, as they are and with each of the TRANSFORMS, allowing one mismatch. Returns
+a list of {lane, total, barcodes: [[barcode, count, match], ...], flags: [message, ...]}, where
+match describes the closest sample (exact matches first, then the order of TRANSFORMS) and flags
+report transforms that explain a large part of the unknown reads, most likely an orientation
+mistake in the sample sheet. If SampleSheet is not available, barcodes are not matched."""
+    samples = {}                # lane -> [(name, i7, i5)]
+    for cv in data["ConversionResults"]:
+        lanesamples = samples.setdefault(cv["LaneNumber"], [])
+        for dr in cv["DemuxResults"]:
+            if dr.get("IndexMetrics"):
+                idx = dr["IndexMetrics"][0]["IndexSequence"].split("+")
+                lanesamples.append((dr["SampleName"], idx[0], idx[1] if len(idx) > 1 else ""))
+
+    result = []
     for unk in data["UnknownBarcodes"]:
         lane = unk["Lane"]
-        bcds = unk["Barcodes"]
-        total = 0
-        for bc in bcds.keys():
-            total += bcds[bc]
-        bclist = []
-        for bc in list(bcds)[:20]:
-            bclist.append([bc, bcds[bc], 100.0 * bcds[bc] / total])
-        result[lane] = bclist
+        total = unk.get("Total") or sum(unk["Barcodes"].values())
+        indexes = []
+        for (rc, swap, desc) in (TRANSFORMS if SampleSheet else []):
+            index = SampleSheet.BarcodeIndex()
+            for (name, i7, i5) in samples.get(lane, []):
+                tr = transformIndexes(i7, i5, rc, swap)
+                if tr:
+                    index.add(tr[0], tr[1], name)
+            indexes.append(index)
+
+        barcodes = []
+        explained = [ [0, set()] for t in TRANSFORMS ]   # reads, samples
+        for (bc, count) in unk["Barcodes"].items():
+            parts = bc.split("+")
+            best = None         # (distance, transform, sample)
+            for t in range(len(indexes)):
+                hits = indexes[t].query(parts[0], parts[1] if len(parts) > 1 else "", 1)
+                if hits:
+                    (pos, d) = min(hits, key=lambda h: h[1])
+                    if best is None or d < best[0]:
+                        best = (d, t, indexes[t].items[pos])
+            match = ""
+            if best:
+                (d, t, name) = best
+                match = ", ".join([ x for x in [name, TRANSFORMS[t][2], "1 mismatch" if d else ""] if x ])
+                explained[t][0] += count
+                explained[t][1].add(name)
+            barcodes.append([bc, count, match])
+
+        flags = []
+        nsamples = len(samples.get(lane, []))
+        for t in range(1, len(indexes)):
+            (reads, names) = explained[t]
+            if nsamples and len(names) >= min(ORIENTATION_MIN_SAMPLES, nsamples) and reads >= ORIENTATION_MIN_FRACTION * total:
+                (rc, swap, desc) = TRANSFORMS[t]
+                flags.append("Lane {}: {} sample indexes with {} match {:.1f}% of the unknown reads. Check the sample sheet (ssmgr {}).".format(
+                    lane, len(names), desc, 100.0 * reads / total if total else 0.0,
+                    " ".join(([ "-rc " + rc ] if rc else []) + ([ "-w" ] if swap else []))))
+        result.append({"lane": lane, "total": total, "barcodes": barcodes, "flags": flags})
     return result
 
 # HTML writers
@@ -95,13 +362,22 @@ A.tblhdr1 {
   display: none;
   width: 100%;
 }
-TABLE.greenbar {
-  width: 100%;
-  border: 1px solid green;
+.pctbar {
+  display: inline-block;
+  width: 100px;
+  height: 10px;
+  border: 1px solid gray;
+  vertical-align: middle;
 }
-TD.greenbar {
+.pctfill {
+  display: block;
+  height: 100%;
   background: green;
 }
+.warning {
+  color: #CC0000;
+  font-weight: bold;
+}
 """
 
 JS = """function toggle(id) {
@@ -112,6 +388,182 @@ JS = """function toggle(id) {
       elt.style.display = "table-row-group";
   }
 }
+
+// The reports are built in the browser from the REPORT payload written by write_payload().
+// Samples are [name, sampleid, reads, barcode]; percentages are relative to `base'.
+
+function el(tag, attrs, text) {
+  var e = document.createElement(tag);
+  for (var a in attrs || {}) {
+    e.setAttribute(a, attrs[a]);
+  }
+  if (text !== undefined) {
+    e.textContent = text;
+  }
+  return e;
+}
+
+function add(parent, tag, attrs, text) {
+  return parent.appendChild(el(tag, attrs, text));
+}
+
+function fmt(n) {
+  return n.toLocaleString("en-US");
+}
+
+function pct(n, base) {
+  return base > 0 ? 100.0 * n / base : 0.0;
+}
+
+function pctCell(tr, p) {
+  var td = add(tr, "TD", {align: "right", width: "20%", nowrap: ""}, p.toFixed(2) + "% ");
+  var bar = add(td, "SPAN", {"class": "pctbar"});
+  add(bar, "SPAN", {"class": "pctfill", style: "width: " + Math.min(p, 100).toFixed(1) + "%;"});
+}
+
+function sampleRows(tbody, samples, base, withId) {
+  var frag = document.createDocumentFragment();
+  for (var i = 0; i < samples.length; i++) {
+    var s = samples[i];
+    var tr = add(frag, "TR", {"class": "btmbord"});
+    add(tr, "TD", {}, withId ? (i + 1) + ". " + s[0] : s[0]);
+    if (withId) {
+      add(tr, "TD", {}, s[1]);
+    }
+    add(tr, "TD", {align: "right"}, fmt(s[2]));
+    pctCell(tr, pct(s[2], base));
+    add(add(tr, "TD", {align: "center"}), "TT", {}, s[3]);
+  }
+  tbody.appendChild(frag);
+}
+
+function barchart(parent, height, traces, layout) {
+  var div = add(parent, "DIV", {style: "width: 100%; height: " + height + "px;"});
+  Plotly.newPlot(div, traces, layout);
+}
+
+function renderWarnings(root, warnings) {
+  if (warnings.length) {
+    var tbl = add(root, "TABLE", {width: "90%"});
+    add(add(tbl, "TR"), "TH", {"class": "tblhdr"}, "Warnings");
+    warnings.forEach(function(w) {
+      add(add(tbl, "TR", {"class": "btmbord"}), "TD", {"class": "warning"}, w);
+    });
+    add(root, "BR");
+    add(root, "BR");
+  }
+}
+
+// Unknown barcodes are [barcode, reads, match]; percentages are relative to all unknown reads
+function renderUnknown(root, lanes) {
+  lanes.forEach(function(lane) {
+    var tbl = add(root, "TABLE", {width: "90%"});
+    add(add(tbl, "TR"), "TH", {"class": "tblhdr", colspan: 4},
+        "Unknown barcodes - lane " + lane.lane + " (top " + lane.barcodes.length + " of " + fmt(lane.total) + " reads)");
+    var tr = add(tbl, "TR", {"class": "btmbord"});
+    ["Barcode", "Reads", "Pct Unknown", "Closest sample index"].forEach(function(h, i) {
+      add(add(tr, "TD", {align: ["center", "right", "center", "left"][i]}), "B", {}, h);
+    });
+    var frag = document.createDocumentFragment();
+    lane.barcodes.forEach(function(b) {
+      var tr = add(frag, "TR", {"class": "btmbord"});
+      add(add(tr, "TD", {align: "center"}), "TT", {}, b[0]);
+      add(tr, "TD", {align: "right"}, fmt(b[1]));
+      pctCell(tr, pct(b[1], lane.total));
+      add(tr, "TD", {}, b[2]);
+    });
+    tbl.appendChild(frag);
+    add(root, "BR");
+    add(root, "BR");
+  });
+}
+
+function renderProject(root, report) {
+  var warnings = [];
+  report.unknown.forEach(function(lane) { warnings = warnings.concat(lane.flags); });
+  renderWarnings(root, warnings);
+  report.sets.forEach(function(set) {
+    if (report.barchart) {
+      barchart(root, 400, [{x: set.samples.map(function(s) { return s[0]; }),
+                            y: set.samples.map(function(s) { return s[2]; }),
+                            type: "bar"}],
+               {title: "Reads by sample"});
+      add(root, "BR");
+    }
+    var tbl = add(root, "TABLE", {width: "90%"});
+    add(add(tbl, "TR"), "TH", {"class": "tblhdr", colspan: 5}, "Samples - " + (set.lane ? "lane " + set.lane : "all lanes"));
+    var tr = add(tbl, "TR", {"class": "btmbord"});
+    ["Sample", "SampleID", "Reads", "Pct Reads", "Index"].forEach(function(h, i) {
+      add(add(tr, "TD", {align: ["left", "left", "right", "center", "center"][i]}), "B", {}, h);
+    });
+    var tbody = add(tbl, "TBODY");
+    sampleRows(tbody, set.samples, set.base, true);
+    tr = add(tbody, "TR", {"class": "btmbord"});
+    add(add(tr, "TD", {colspan: 2}), "B", {}, "Total");
+    add(tr, "TD", {align: "right"}, fmt(set.reads));
+    add(tr, "TD", {colspan: 2});
+    add(root, "BR");
+    add(root, "BR");
+  });
+  renderUnknown(root, report.unknown);
+}
+
+function renderRun(root, report) {
+  renderWarnings(root, report.warnings);
+  if (report.barchart) {
+    var lanes = report.lanes.map(function(l) { return "L" + l.lane; });
+    barchart(root, 600, report.traces.map(function(t) {
+      return {x: lanes, y: t[1], name: t[0], type: "bar"};
+    }), {barmode: "stack"});
+  }
+  report.lanes.forEach(function(lane) {
+    add(root, "BR");
+    add(root, "BR");
+    var tbl = add(root, "TABLE", {width: "90%"});
+    add(add(tbl, "TR"), "TH", {"class": "tblhdr", colspan: 3}, "Lane " + lane.lane);
+    var tr = add(tbl, "TR");
+    ["Total reads", "PF reads", "Identified reads"].forEach(function(h) {
+      add(tr, "TH", {align: "left", width: "33%"}, h);
+    });
+    tr = add(tbl, "TR");
+    add(add(tr, "TD"), "B", {}, fmt(lane.total));
+    var td = add(tr, "TD");
+    add(td, "B", {}, fmt(lane.pf));
+    td.appendChild(document.createTextNode(" (" + pct(lane.pf, lane.total).toFixed(1) + "% of total reads)"));
+    td = add(tr, "TD");
+    add(td, "B", {}, fmt(lane.id));
+    td.appendChild(document.createTextNode(" (" + pct(lane.id, lane.pf).toFixed(1) + "% of PF reads)"));
+    var cell = add(add(tbl, "TR"), "TD", {colspan: 3});
+    lane.projects.forEach(function(proj) {
+      var ptbl = add(cell, "TABLE", {width: "100%"});
+      var thead = add(ptbl, "THEAD");
+      tr = add(thead, "TR");
+      add(tr, "TH", {"class": "tblhdr2", align: "left", colspan: 3}, "Project " + proj.name + " (" + proj.samples.length + " samples)");
+      add(tr, "TH", {"class": "tblhdr2", align: "right", colspan: 2}, fmt(proj.reads) + " reads (" + pct(proj.reads, lane.id).toFixed(1) + "% of lane)");
+      var tbody = add(ptbl, "TBODY", {"class": "smpltable"});
+      // Sample rows are only built the first time the project is opened
+      thead.onclick = function() {
+        if (!tbody.firstChild) {
+          var hdr = add(tbody, "TR");
+          ["Sample", "Reads", "Pct Reads", "Index"].forEach(function(h, i) {
+            add(add(hdr, "TD", {align: ["left", "right", "center", "center"][i]}), "B", {}, h);
+          });
+          sampleRows(tbody, proj.samples, proj.base, false);
+        }
+        tbody.style.display = tbody.style.display == "table-row-group" ? "none" : "table-row-group";
+      };
+      add(cell, "BR");
+    });
+  });
+}
+
+function renderReport(root, report) {
+  if (report.type == "run") {
+    renderRun(root, report);
+  } else {
+    renderProject(root, report);
+  }
+}
 """
 
 def start_page(out, projname):
@@ -139,72 +591,21 @@ def end_page(out):
 </HTML>
 """)
 
-def samples_table(out, data):
-    smpdata = getSampleData(data)
-    out.write("""<BR><BR><TABLE width='90%'>
-<TR><TH class='tblhdr' colspan=5>Samples</TH></TR>
-<TR class='btmbord'>
-  <TD><B>Sample</B></TD>
-  <TD align='right'><B>Reads</B></TD>
-  <TD align='center'><B>Pct Reads</B></TD>
-  <TD align='center'><b>Index</b></TD>
-</TR>
-""")
-    for k in sorted(smpdata.keys()):
-        if k == '##Total':
-            continue
-        sdata = smpdata[k]
-        out.write("""<TR class='btmbord'>
-  <TD>{}</TD>
-  <TD align='right'>{:,d}</TD>
-  <TD width='20%' align='right'>{:.2f}% {}</TD>
-  <TD align='center'><tt>{}</tt></TD>
-</TR>
-""".format(k, sdata[0], sdata[1], draw_bar(sdata[1]), sdata[2]))
-    out.write("""<TR class='btmbord'><TD><B>Total</B></TD><TD align='right'>{:,d}</TD><TD></TD><TD></TD><TD></TD></TR>""".format(smpdata["##Total"]))
-    out.write("""</TABLE>
-""")
-
-def draw_bar(pct):
-    return """<PROGRESS max="100" value="{}">{:.2f}</PROGRESS>""".format(int(pct), pct)
-
-# def draw_bar(pct):
-#     if pct < 1:
-#         return """<TABLE class='greenbar'><TR><TD>&nbsp;</TD></TR></TABLE>"""
-#     else:
-#         return """<TABLE class='greenbar'><TR><TD width="{:.2f}%" class='greenbar'>&nbsp;</TD><TD></TD></TR></TABLE>""".format(pct)
-
-def unknown_table(out, data):
-    unk = getUnknown(data)
-    #print(unk)
-    lanes = getLanes(data)
-    nlanes = len(lanes)
-    out.write("""<BR><BR><TABLE width='90%'>
-<TR><TH class='tblhdr' colspan={}>Unknown Barcodes (first 20)</TH></TR>
-<TR>""".format(nlanes * 2))
-    for l in lanes:
-        out.write("<TH colspan=2>Lane {}</TH>".format(l))
-    out.write("</TR>\n")
-
-    for i in range(20):
-        out.write("<TR>")
-        for l in lanes:
-            bc = unk[l][i]
-            out.write("<TD align='center'><TT>{}</TT></TD><TD align='right'>{:.2f}%</TD>".format(bc[0], bc[2]))
-        out.write("</TR>\n")
+def write_payload(out, payload):
+    """Write the data of a report as a single compact JSON object, followed by the call that
+renders it (see renderReport() in JS). Sample tables and charts are built by the browser, so the
+page only contains each sample once."""
+    out.write("<DIV id='report'></DIV>\n<SCRIPT>\nvar REPORT = ")
+    out.write(json.dumps(payload, separators=(",", ":")).replace("</", "<\\/"))
+    out.write(";\nrenderReport(document.getElementById('report'), REPORT);\n</SCRIPT>\n")
 
-    out.write("""</TABLE>
-""")
+def sample_rows(ss):
+    return [ [smp.name, smp.sampleid, smp.reads, smp.barcode] for smp in ss.samples ]
 
 # Classes
 
 class Sample(object):
-    name = ""
-    sampleid = ""
-    samplenum = 0
-    barcode = ""
-    reads = 0
-    readsfrac = 0.0
+    __slots__ = ["name", "sampleid", "samplenum", "barcode", "reads"]
 
     def __init__(self, name, smpid, barcode, reads):
         if name[0] in "0123456789":
@@ -213,28 +614,30 @@ class Sample(object):
         self.sampleid = smpid
         self.barcode = barcode
         self.reads = reads
+        self.samplenum = 0
         try:
             self.samplenum = int(smpid.split("_")[0])
         except ValueError:
             pass
 
 class SampleSet(object):
-    lane = 0
-    project = ""
-    samples = []
-    reads = 0
+    """The samples of a project in one lane (or in all lanes, if lane is 0). Samples can be
+looked up by name. Percentages are computed when they are needed, relative to the reads
+in the set unless a different total is set with force_readsfrac()."""
+    __slots__ = ["lane", "project", "samples", "reads", "total", "_byname"]
 
     def __init__(self, lane):
         self.lane = lane
+        self.project = ""
         self.samples = []
         self.reads = 0
+        self.total = None
+        self._byname = {}
 
     def add(self, sample):
         self.samples.append(sample)
         self.reads += sample.reads
-        if self.reads > 0:
-            for smp in self.samples:
-                smp.readsfrac = 100.0 * smp.reads / self.reads
+        self._byname.setdefault(sample.name, sample)
 
     def sortSamples(self):
         self.samples.sort(key=lambda r: r.samplenum)
@@ -242,15 +645,16 @@ class SampleSet(object):
     def findSample(self, samplename):
         if samplename[0] in "0123456789":
             samplename = "S-" + samplename
-        for smp in self.samples:
-            if smp.name == samplename:
-                return smp
-        return None
+        return self._byname.get(samplename)
 
     def force_readsfrac(self, total):
         if total > 0:
-            for smp in self.samples:
-                smp.readsfrac = 100.0 * smp.reads / total
+            self.total = total
+
+    def readsfrac(self, smp):
+        """Percentage of the reads in this set (or of the forced total) that belong to `smp'."""
+        total = self.total or self.reads
+        return 100.0 * smp.reads / total if total > 0 else 0.0
 
 def combine_samplesets(sets):
     """Combine all samplesets in `sets' into a single sampleset."""
@@ -260,24 +664,20 @@ def combine_samplesets(sets):
             smp0 = ss.findSample(smp1.name)
             if smp0:
                 smp0.reads += smp1.reads
+                ss.reads += smp1.reads
             else:
-                smp0 = Sample(smp1.name, smp1.sampleid, "-", smp1.reads)
-                ss.add(smp0)
-    ss.reads = sum([smp.reads for smp in ss.samples])
-    for smp in ss.samples:
-        smp.readsfrac = 100.0 * smp.reads / ss.reads
+                ss.add(Sample(smp1.name, smp1.sampleid, "-", smp1.reads))
     return ss
 
 class Lane(object):
-    ln = 0
-    samplesets = []
-    totalreads = 0
-    pfreads = 0
-    idreads = 0
+    __slots__ = ["ln", "samplesets", "totalreads", "pfreads", "idreads"]
 
     def __init__(self, ln):
         self.ln = ln
         self.samplesets = []
+        self.totalreads = 0
+        self.pfreads = 0
+        self.idreads = 0
 
     def add(self, sampleset):
         sampleset.lane = self.ln
@@ -301,29 +701,34 @@ Projects:
 
 class MultiLane(object):
     lanes = []
+    _bynumber = {}
+
+    def __init__(self):
+        self.lanes = []
+        self._bynumber = {}
 
     def addLane(self, lane):
         self.lanes.append(lane)
         self.lanes.sort(key=lambda l: l.ln)
+        self._bynumber[lane.ln] = lane
 
     def findLane(self, ln):
-        for lane in self.lanes:
-            if lane.ln == ln:
-                return lane
-        return None
+        return self._bynumber.get(ln)
 
 class Project(MultiLane):
     name = ""
     jsondata = None
     samplesets = []
     reads = 0
-    _nbarcharts = 0
+    barchart = True
+    _unknown = None
 
     def __init__(self, name):
+        MultiLane.__init__(self)
         self.name = name
         self.samplesets = []
-        self.lanes = []
         self.reads = 0
+        self._unknown = None
 
     def add(self, sampleset):
         sampleset.project = self.name
@@ -333,7 +738,7 @@ class Project(MultiLane):
     def toHTML(self, out, xls):
         start_page(out, self.name)
         self.write_header(out, xls)
-        self.samples_table(out)
+        write_payload(out, self.payload())
         end_page(out)
 
     def write_header(self, out, xls):
@@ -350,51 +755,21 @@ class Project(MultiLane):
 <BR><BR>
 """.format(link, self.jsondata["Flowcell"], self.jsondata["RunId"], ", ".join([str(l) for l in lanes]), getRunConfiguration(self.jsondata)))
 
-    def samples_table(self, out):
-        for ss in self.samplesets:
-            self.samples_table_one(out, ss)
-        if len(self.samplesets) > 1:
-            combined = combine_samplesets(self.samplesets)
-            self.samples_table_one(out, combined)
-
-    def draw_barchart(self, out, ss):
-        name = "smphist" + str(self._nbarcharts)
-        tracename = "trace" + str(self._nbarcharts)
-        self._nbarcharts += 1
-        out.write("""<DIV id='{}' style="width: 100%, height: 400px;"></DIV><BR><BR>
-<SCRIPT>
-""".format(name))
-        smpnames = ", ".join(["'" + smp.name + "'" for smp in ss.samples])
-        values = ", ".join(["{:.2f}".format(smp.reads) for smp in ss.samples])
-        out.write("""
-  var xValue = [{}];
-  var yValue = [{}];
-  var {} = [
-    {{
-        x: xValue,
-        y: yValue,
-        type: 'bar'
-    }}
-];
-  var layout = {{ title: 'Reads by sample' }};
-  Plotly.newPlot('{}', {}, layout);
-</SCRIPT>
-""".format(smpnames, values, tracename, name, tracename))
-
-    def samples_table_one(self, out, ss):
-        self.draw_barchart(out, ss)
-        out.write("""<TABLE width='90%'>
-<TR><TH class='tblhdr' colspan=5>Samples{}</TH></TR>
-<TR class='btmbord'><TD><B>Sample</B></TD><TD><B>SampleID</B></TD><TD align='right'><B>Reads</B></TD><TD align='center'><B>Pct Reads</B></TD><TD align='center'><b>Index</b></TD></TR>
-""".format(" - all lanes" if ss.lane == 0 else " - lane {}".format(ss.lane)))
-        smpidx = 1
-        for smp in ss.samples:
-            out.write("""<TR class='btmbord'><TD>{}. {}</TD><TD>{}</TD><TD align='right'>{:,d}</TD><TD width='20%' align='right'>{:.2f}% {}</TD><TD align='center'><tt>{}</tt></TD></TR>
-""".format(smpidx, smp.name, smp.sampleid, smp.reads, smp.readsfrac, draw_bar(smp.readsfrac), smp.barcode))
-            smpidx += 1
-        out.write("""<TR class='btmbord'><TD colspan='2'><B>Total</B></TD><TD align='right'>{:,d}</TD><TD></TD><TD></TD><TD></TD></TR>""".format(ss.reads))
-        out.write("""</TABLE><BR><BR>
-""")
+    def unknownBarcodes(self):
+        """Return the analysis of the unknown barcodes of this project (see analyzeUnknown)."""
+        if self._unknown is None:
+            self._unknown = analyzeUnknown(self.jsondata)
+        return self._unknown
+
+    def payload(self):
+        sets = list(self.samplesets)
+        if len(sets) > 1:
+            sets.append(combine_samplesets(sets))
+        return {"type": "project",
+                "barchart": self.barchart,
+                "sets": [ {"lane": ss.lane, "reads": ss.reads, "base": ss.total or ss.reads, "samples": sample_rows(ss)}
+                          for ss in sets ],
+                "unknown": self.unknownBarcodes()}
 
     def toText(self, out):
         lanes = getLanes(self.jsondata)
@@ -425,19 +800,20 @@ Run configuration:\t{}
                 lpct = 100.0 * smp.reads / lane.pfreads
             else:
                 lpct = 0.0
-            out.write("{}\t{}\t{:.2f}%\t{:.2f}%\t{}\n".format(smp.name, smp.reads, lpct, smp.readsfrac, smp.barcode))
+            out.write("{}\t{}\t{:.2f}%\t{:.2f}%\t{}\n".format(smp.name, smp.reads, lpct, ss.readsfrac(smp), smp.barcode))
 
 class Run(MultiLane):
     name = ""
     totalreads = 0
     pfreads = 0
     idreads = 0
-    _tblid = 0
     barchart = True
+    warnings = []
 
     def __init__(self, name):
+        MultiLane.__init__(self)
         self.name = name
-        self.lanes = []
+        self.warnings = []
 
     def update_reads(self):
         self.totalreads = 0
@@ -465,122 +841,141 @@ class Run(MultiLane):
                    self.idreads, 100.0 * self.idreads / self.pfreads))
 
     def makeTraces(self):
-        projects = []
-        traces = []
+        """Return [project, (lane, reads), ...] for each project, with an entry for every lane
+(0 reads if the project is not in that lane)."""
+        projects = {}           # project -> {lane: reads}, in order of first appearance
         for lane in self.lanes:
             for ss in lane.samplesets:
-                proj = ss.project
-                if proj not in projects:
-                    projects.append(proj)
-        for proj in projects:
-            trace = [proj]
-            for lane in self.lanes:
-                found = False
-                for ss in lane.samplesets:
-                    if ss.project == proj:
-                        trace.append( (lane.ln, ss.reads) )
-                        found = True
-                        break
-                if not found:
-                    trace.append( (lane.ln, 0) )
-            traces.append(trace)
-        return traces
-
-    def draw_barchart(self, out):
-        lanenumbers = [ "'L" + str(lane.ln) + "'" for lane in self.lanes ]
-        out.write("""<DIV id="lanesbars" style="width: 100%; height: 600px;"></DIV>
-<SCRIPT>
-""")
-        traces = self.makeTraces()
-        ntr = 1
-        tracevars = []
-        for trace in traces:
-            trname = trace[0]
-            trdata = trace[1:]
-            trvar = "trace" + str(ntr)
-            tracevars.append(trvar)
-            out.write(""" var {} = {{
-  x: [{}],
-  y: [{}],
-  name: '{}',
-  type: 'bar',
-}};
-
-            """.format(trvar, 
-                       ", ".join(lanenumbers),
-                       ", ".join([str(tr[1]) for tr in trdata]),
-                       trname))
-            ntr += 1
-        out.write("""
-  var data = [{}];
-
-  var layout = {{barmode: 'stack'}};
-
-  Plotly.newPlot("lanesbars", data, layout);
-</SCRIPT>
-        """.format(", ".join(tracevars)))
-
-    def write_lane(self, out, lane):
-        out.write("""<BR><BR><TABLE width="90%">
-<TR><TH colspan='3' class='tblhdr'>Lane {}</TH></TR>
-<TR><TH align='left' width='33%'>Total reads</TH><TH align='left' width='33%'>PF reads</TH><TH align='left' width='33%'>Identified reads</TH></TR>
-<TR>
-  <TD><B>{:,}</B></TD>
-  <TD><B>{:,}</B> ({:.1f}% of total reads)</TD>
-  <TD><B>{:,}</B> ({:.1f}% of PF reads)</TD>
-</TR>
-<TR><TD colspan='3'>
-""".format(lane.ln, lane.totalreads, lane.pfreads, 100.0 * lane.pfreads / lane.totalreads,
-           lane.idreads, 100.0 * lane.idreads / lane.pfreads,
-           (lane.pfreads - lane.idreads), 100.0 * (lane.pfreads - lane.idreads) / lane.pfreads))
-
-        for ss in lane.samplesets:
-            out.write("""<TABLE width='100%'>
-  <THEAD onclick="toggle('tbl{}');">
-    <TR><TH class='tblhdr2' align='left' colspan='3'>Project {} ({} samples)</TH><TH class='tblhdr2' align='right' colspan='2'>{:,} reads ({:.1f}% of lane)</TH></TR>
-            </THEAD>""".format(self._tblid, ss.project, len(ss.samples), ss.reads, 100.0 * ss.reads / lane.idreads if lane.idreads else 0))
-            out.write("""<TBODY id='tbl{}' class='smpltable'>
-<TR width='100%'><TD><B>Sample</B></TD><TD align='right'><B>Reads</B></TD><TD align='center'><B>Pct Reads</B></TD><TD align='center'><b>Index</b></TD></TR>
-            """.format(self._tblid))
-            for smp in ss.samples:
-                out.write("""<TR class='btmbord'><TD>{}</TD><TD align='right'>{:,d}</TD><TD nowrap align='right' width='20%'>{:.2f}% {}</TD><TD align='center'><tt>{}</tt></TD></TR>\n""".format(smp.name, smp.reads, smp.readsfrac, draw_bar(smp.readsfrac), smp.barcode))
-            out.write("""</TBODY>
-  </TABLE>
-  <BR>
-""")
-            self._tblid += 1
-        out.write("""
-</TD></TR>
-</TABLE>
-""")
+                projects.setdefault(ss.project, {}).setdefault(lane.ln, ss.reads)
+        return [ [proj] + [ (lane.ln, reads.get(lane.ln, 0)) for lane in self.lanes ]
+                 for (proj, reads) in projects.items() ]
 
+    def payload(self):
+        lanes = []
+        for lane in self.lanes:
+            lanes.append({"lane": lane.ln, "total": lane.totalreads, "pf": lane.pfreads, "id": lane.idreads,
+                          "projects": [ {"name": ss.project, "reads": ss.reads, "base": ss.total or ss.reads, "samples": sample_rows(ss)}
+                                        for ss in lane.samplesets ]})
+        return {"type": "run",
+                "barchart": self.barchart,
+                "warnings": self.warnings,
+                "lanes": lanes,
+                "traces": [ [trace[0], [ tr[1] for tr in trace[1:] ]] for trace in self.makeTraces() ]}
 
     def toHTML(self, out):
         start_page(out, self.name)
         self.write_header(out)
-        if self.barchart:
-            self.draw_barchart(out)
-        for l in self.lanes:
-            self.write_lane(out, l)
+        write_payload(out, self.payload())
         end_page(out)
 
     def show(self):
         for lane in self.lanes:
             lane.show()
 
+def write_index(out, runname, projnames):
+    """Write the index page of the reports of run `runname'."""
+    out.write("""<!DOCTYPE html>
+<HTML>
+<BODY>
+Run: <A href="{}.html">{}</A><BR><BR>
+Projects: <OL>
+<CENTER>
+<TABLE style='border: 2px solid blue; width: 95%'>
+<TR><TH>Demux Report</TH><TH>MultiQC Report</TH></TR>
+""".format(runname, runname))
+    for p in projnames:
+        out.write("""<TR><TD style='border-top: 1px solid blue;'><LI><A href='{0}.html'>{0}</A></LI></TD><TD style='border-top: 1px solid blue; text-align: center;'><A href='{0}_MultiQC.html'>MultiQC</A></TD></TR>
+""".format(p))
+    out.write("""</TABLE>
+</OL>
+</BODY>
+</HTML>
+""")
+
+# Report manifest
+
+# Stored in the reports directory, records the inputs and outputs of each project report
+MANIFEST = ".manifest.json"
+
+def fingerprint(path, previous=None):
+    """Return [mtime, size, sha1] for file `path', or None if it does not exist. The hash is
+copied from `previous' (an earlier fingerprint) if the mtime and size have not changed."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if previous and previous[0] == st.st_mtime and previous[1] == st.st_size:
+        return [st.st_mtime, st.st_size, previous[2]]
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1<<20), b""):
+            h.update(block)
+    return [st.st_mtime, st.st_size, h.hexdigest()]
+
+def sameInputs(fp1, fp2):
+    """Do two dictionaries of fingerprints describe the same file contents?"""
+    return sorted(fp1) == sorted(fp2) and all([ fp1[k] and fp2[k] and fp1[k][1:] == fp2[k][1:] for k in fp1 ])
+
+def loadManifest(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_if_changed(path, text):
+    """Write `text' to `path', unless the file already has exactly this contents (so that it
+keeps its mtime and is not copied again). Returns True if the file was written."""
+    if os.path.isfile(path):
+        with open(path, "r") as f:
+            if f.read() == text:
+                return False
+    with open(path, "w", buffering=BUFSIZE) as out:
+        out.write(text)
+    return True
+
 # Main
 
-def mainOld(jsonfile, outfile, projname):
-    with open(jsonfile, "r") as f:
-        data = json.load(f)
+def statsFiles(projdir):
+    """Return (project, Stats.json, DemuxSummary file or None) for each project subdirectory of
+`projdir' that contains bcl2fastq Stats, sorted by project name."""
+    result = []
+    for d in sorted(os.listdir(projdir)):
+        jf = os.path.join(projdir, d, "Stats", "Stats.json")
+        if os.path.isfile(jf):
+            demux = sorted(glob(os.path.join(projdir, d, "Stats", "DemuxSummaryF?L?.txt")))
+            result.append((d, jf, demux[0] if demux else None))
+    return result
+
+def defaultWorkers():
+    """Number of worker processes for batch mode: the CPUs allocated to the Slurm job (or
+available to this process), at most MAXWORKERS."""
+    n = getenv("SLURM_CPUS_PER_TASK")
+    if n and n.isdigit():
+        n = int(n)
+    elif hasattr(os, "sched_getaffinity"):
+        n = len(os.sched_getaffinity(0))
+    else:
+        n = os.cpu_count() or 1
+    return max(1, min(n, MAXWORKERS))
+
+def make_project_report(name, jf, demuxfile, outfile, outfiletxt, nunknown=NUNKNOWN):
+    """Write the HTML and text reports for project `name' from its Stats.json file `jf'.
+Returns the data read from `jf', so that it can be used for the run report. This is a
+function so that it can run in a worker process."""
+    M = Main()
+    M.demuxfile = demuxfile
+    if demuxfile:
+        M.readSampleNames()
+    M.nunknown = nunknown
+    data = readStats(jf, nunknown)
+    proj = M.parse_project(name, jf, data)
+    with open(outfile, "w", buffering=BUFSIZE) as out:
+        proj.toHTML(out, outfiletxt)
+    with open(outfiletxt, "w", buffering=BUFSIZE) as out:
+        proj.toText(out)
+    return data
 
-    with open(outfile, "w") as out:
-        start_page(out, projname)
-        write_header(out, data)
-        samples_table(out, data)
-        unknown_table(out, data)
-        end_page(out)
-        
 class Main(object):
     mode = "p"
     run_name = None
@@ -592,6 +987,10 @@ class Main(object):
     demuxfile = None
     samplenames = []
     samplenums = {}
+    projdir = None
+    nworkers = None
+    nunknown = NUNKNOWN
+    force = False
 
     def __init__(self):
         self.jsonfiles = []
@@ -618,8 +1017,20 @@ class Main(object):
             elif prev == "-d":
                 self.demuxfile = a
                 prev = ""
-            elif a in ["-o", "-r", "-t", "-i", "-d"]:
+            elif prev == "-b":
+                self.mode = "b"
+                self.projdir = a.rstrip("/")
+                prev = ""
+            elif prev == "-j":
+                self.nworkers = int(a)
+                prev = ""
+            elif prev == "-k":
+                self.nunknown = int(a)
+                prev = ""
+            elif a in ["-o", "-r", "-t", "-i", "-d", "-b", "-j", "-k"]:
                 prev = a
+            elif a == "-f":
+                self.force = True
             else:
                 if prj:
                     self.projectnames.append(a.rstrip("/"))
@@ -639,17 +1050,86 @@ class Main(object):
                 #print(self.samplenames)
                 #print(self.samplenums)
             proj = self.parse_project(self.projectnames[0], self.jsonfiles[0])
-            with open(self.outfile, "w") as out:
+            with open(self.outfile, "w", buffering=BUFSIZE) as out:
                 proj.toHTML(out, self.outfiletxt)
             if self.outfiletxt:
-                with open(self.outfiletxt, "w") as out:
+                with open(self.outfiletxt, "w", buffering=BUFSIZE) as out:
                     proj.toText(out)
 
+        elif self.mode == "b":
+            self.run_batch()
+
         else:
             run = self.parse_run(self.projectnames, self.jsonfiles)
-            with open(self.outfile, "w") as out:
+            with open(self.outfile, "w", buffering=BUFSIZE) as out:
                 run.toHTML(out)
 
+    def run_batch(self):
+        """Write all reports for the projects in directory `projdir' (one subdirectory per
+project, with the bcl2fastq Stats in Stats/) into its DemuxReports subdirectory: the HTML and
+text report of each project, the run report and the index page. Each Stats.json is read only
+once, and project reports are written in parallel.
+
+A manifest in the reports directory records the fingerprints of the inputs of each project
+report (and of this program, SampleSheet.py and the -k setting). Project reports are only written again if their inputs changed
+(or with -f); the run report and the index are only rewritten if their contents changed."""
+        runname = os.path.basename(os.path.abspath(self.projdir))
+        dest = os.path.join(self.projdir, "DemuxReports")
+        os.makedirs(dest, exist_ok=True)
+        projnames = []
+        jfs = []
+        demuxfiles = []
+        for (name, jf, demux) in statsFiles(self.projdir):
+            projnames.append(name)
+            jfs.append(jf)
+            demuxfiles.append(demux)
+
+        manifestpath = os.path.join(dest, MANIFEST)
+        old = loadManifest(manifestpath)
+        oldgenerator = old.get("generator")
+        if not isinstance(oldgenerator, dict):
+            oldgenerator = {}
+        generator = {}          # Fingerprints of the code that produces the reports
+        for module in [sys.modules[__name__], SampleSheet]:
+            if module:
+                path = os.path.abspath(module.__file__)
+                name = os.path.basename(path)
+                generator[name] = fingerprint(path, oldgenerator.get(name))
+        if self.force or not sameInputs(generator, oldgenerator) or old.get("nunknown") != self.nunknown:
+            oldprojects = {}
+        else:
+            oldprojects = old.get("projects", {})
+        manifest = {"generator": generator, "nunknown": self.nunknown, "projects": {}}
+
+        with ProcessPoolExecutor(max_workers=self.nworkers or defaultWorkers()) as pool:
+            futures = []
+            for i in range(len(projnames)):
+                prev = oldprojects.get(projnames[i], {})
+                inputs = {}     # Paths are relative to projdir
+                for path in [jfs[i], demuxfiles[i]]:
+                    if path:
+                        rel = os.path.relpath(path, self.projdir)
+                        inputs[rel] = fingerprint(path, prev.get("inputs", {}).get(rel))
+                outputs = [ os.path.join(dest, projnames[i] + ext) for ext in [".html", ".txt"] ]
+                manifest["projects"][projnames[i]] = {"inputs": inputs, "outputs": [ os.path.basename(o) for o in outputs ]}
+                if sameInputs(inputs, prev.get("inputs", {})) and all([ os.path.isfile(o) for o in outputs ]):
+                    futures.append(pool.submit(readStats, jfs[i], self.nunknown))
+                else:
+                    sys.stderr.write("Writing report for project {}.\n".format(projnames[i]))
+                    futures.append(pool.submit(make_project_report, projnames[i], jfs[i], demuxfiles[i], outputs[0], outputs[1], self.nunknown))
+            alldata = [ fut.result() for fut in futures ]
+
+        self.run_name = runname
+        run = self.parse_run(projnames, jfs, alldata)
+        out = StringIO()
+        run.toHTML(out)
+        write_if_changed(os.path.join(dest, runname + ".html"), out.getvalue())
+        out = StringIO()
+        write_index(out, runname, projnames)
+        write_if_changed(self.indexfile or os.path.join(dest, "index.html"), out.getvalue())
+        with open(manifestpath, "w") as f:
+            json.dump(manifest, f, indent=1)
+
     def readSampleNames(self):
         with open(self.demuxfile, "r") as f:
             f.readline()
@@ -659,11 +1139,11 @@ class Main(object):
             self.samplenums[smp] = idx
             idx += 1
 
-    def parse_project(self, name, jf):
+    def parse_project(self, name, jf, data=None):
         #sys.stderr.write("parsing project {}\n".format(name))
         proj = Project(name)
-        with open(jf, "r") as f:
-            data = json.load(f)
+        if data is None:
+            data = readStats(jf, self.nunknown)
 
         proj.jsondata = data
         convresults = data["ConversionResults"]
@@ -689,13 +1169,17 @@ class Main(object):
             proj.add(ss)
         return proj
 
-    def parse_run(self, projects, jfs):
+    def parse_run(self, projects, jfs, alldata=None):
+        """Build the Run for `projects', reading their Stats.json files `jfs' unless their
+contents are supplied in `alldata'."""
         run = Run(self.run_name)
 
-        for jf in jfs:
-            sys.stderr.write("Reading {}...\n".format(jf))
-            with open(jf, "r") as f:
-                data = json.load(f)
+        if alldata is None:
+            alldata = []
+            for jf in jfs:
+                sys.stderr.write("Reading {}...\n".format(jf))
+                alldata.append(readStats(jf, self.nunknown))
+        for data in alldata:
             run.jsondata = data
             convresults = data["ConversionResults"]
             for cv in convresults:
@@ -707,7 +1191,10 @@ class Main(object):
                     run.addLane(lane)
 
         for idx in range(len(jfs)):
-            proj = self.parse_project(projects[idx], jfs[idx])
+            proj = self.parse_project(projects[idx], jfs[idx], alldata[idx])
+            for lane in proj.unknownBarcodes():
+                for flag in lane["flags"]:
+                    run.warnings.append("Project {}, {}".format(proj.name, flag))
             for ss in proj.samplesets:
                 sslane = ss.lane
                 lane = run.findLane(sslane)
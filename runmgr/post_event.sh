@@ -0,0 +1,15 @@
+#!/bin/bash
+
+## Append a job completion event to the events file read by `rundb update'.
+## Usage: post_event.sh kind run project status
+##   kind    = download, demux, project or upload
+##   project = project name, or - if the event refers to the whole run
+##   status  = SUCCESS/FAILED (download, project), DONE (demux), exit code (upload)
+
+SCRIPT_HOME=/orange/icbrngs/bin/runmgr/
+source $SCRIPT_HOME/config.sh
+
+if [[ -n $eventsFile ]];
+then
+  printf "%s\t%s\t%s\t%s\t%s\n" $(date +%FT%T) "$1" "$2" "$3" "$4" >> $eventsFile
+fi
@@ -4,15 +4,24 @@ from os import getenv
 import sys
 import csv
 import json
+import time
+import fcntl
+import select
+import signal
+import socket
+import shlex
 import os.path
 import sqlite3 as sql
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
+from contextlib import contextmanager
 from shutil import copyfile
-from datetime import datetime
+from datetime import datetime, timedelta
 from smtplib import SMTP
 
 import Basespace
+import parse_demux_stats
 
 # Tables
 
@@ -47,9 +56,132 @@ TABLES = [ """DROP TABLE IF EXISTS Runs;""",
     Dend text,
     Xstart text,
     Xend text );""",
-  """CREATE INDEX oper_id ON Operations(Id);"""
+  """DROP TABLE IF EXISTS RunSearch;""",
+  """DROP TABLE IF EXISTS Settings;""",
+  """DROP TABLE IF EXISTS DemuxLanes;""",
+  """DROP TABLE IF EXISTS DemuxSamples;"""
 ]
 
+# Schema migrations. Each entry brings the schema from version N to N+1 (the current
+# version is stored in PRAGMA user_version). Entries are lists of SQL statements, or
+# names of RunDB methods for changes that can't be expressed as idempotent SQL. Never
+# edit an existing entry: add a new one at the end.
+
+MIGRATIONS = [
+    # 1: settings table (sync high-water mark)
+    ["""CREATE TABLE IF NOT EXISTS Settings (Name text primary key, Value text);"""],
+    # 2: indexes for polling and listing queries
+    ["""DROP INDEX IF EXISTS oper_id;""",
+     """CREATE INDEX IF NOT EXISTS oper_download ON Operations(Download, Id);""",
+     """CREATE INDEX IF NOT EXISTS oper_demux ON Operations(Demux, Id);""",
+     """CREATE INDEX IF NOT EXISTS oper_upload ON Operations(Upload, Id);""",
+     """CREATE INDEX IF NOT EXISTS proj_parent ON Projects(ParentRun, Upload);""",
+     """CREATE INDEX IF NOT EXISTS proj_upload ON Projects(Upload, ParentRun, Name);""",
+     """CREATE INDEX IF NOT EXISTS run_date ON Runs(DateCreated, Id);"""],
+    # 3: run metadata columns extracted from Json
+    ["migrateRunFields"],
+    # 4: Slurm job IDs of operations
+    ["migrateJobIds"],
+    # 5: demux metrics of each run, per lane and per sample
+    ["""CREATE TABLE IF NOT EXISTS DemuxLanes (
+  RunId int,
+  Lane int,
+  TotalClustersRaw int,
+  TotalClustersPF int,
+  IdentifiedReads int,
+  Undetermined int,
+  primary key (RunId, Lane));""",
+     """CREATE TABLE IF NOT EXISTS DemuxSamples (
+  RunId int,
+  Lane int,
+  Project text,
+  Sample text,
+  SampleId text,
+  IndexSequence text,
+  NumberReads int);""",
+     """CREATE INDEX IF NOT EXISTS demux_samples_run ON DemuxSamples(RunId, Lane);"""],
+]
+
+# Columns holding the Slurm job ID of the last job started for each operation
+JOB_ID_COLUMNS = [("Operations", "Djob"), ("Operations", "Xjob"), ("Projects", "Ujob")]
+
+# Run metadata copied out of the Basespace Json into their own columns of Runs:
+# (column, type, path in the Json document)
+
+RUN_FIELDS = [("FlowcellBarcode", "text", ["FlowcellBarcode"]),
+              ("InstrumentName", "text", ["InstrumentName"]),
+              ("InstrumentType", "text", ["InstrumentType"]),
+              ("NumLanes", "int", ["SequencingStats", "NumLanes"]),
+              ("NumCyclesRead1", "int", ["SequencingStats", "NumCyclesRead1"]),
+              ("NumCyclesIndex1", "int", ["SequencingStats", "NumCyclesIndex1"]),
+              ("NumCyclesIndex2", "int", ["SequencingStats", "NumCyclesIndex2"]),
+              ("NumCyclesRead2", "int", ["SequencingStats", "NumCyclesRead2"])]
+
+def runFields(rundata):
+    """Return the values of RUN_FIELDS in the Basespace run document `rundata' (None if missing)."""
+    values = []
+    for (col, typ, path) in RUN_FIELDS:
+        v = rundata
+        for key in path:
+            v = v.get(key) if isinstance(v, dict) else None
+        values.append(v)
+    return values
+
+# Queries run at every update cycle or in the run manager's lists, checked by `rundb explain'
+
+HOT_QUERIES = [
+    ("checkDownloads", "SELECT b.Id, b.ExperimentName FROM Operations a, Runs b WHERE a.Id=b.Id and a.Download=?;", ["U"]),
+    ("startDownloads", "SELECT b.Id, b.ExperimentName FROM Operations a, Runs b WHERE a.Id=b.Id and a.Download=? and b.Status!='Running' and b.Status!='Uploading';", ["Y"]),
+    ("checkDemux", "SELECT a.Id, a.ExperimentName FROM Runs a, Operations b WHERE a.Id=b.Id and b.Demux=?;", ["U"]),
+    ("startDemux", "SELECT a.Id, a.ExperimentName, a.FlowcellBarcode FROM Runs a, Operations b WHERE a.Id=b.Id and b.Download=? and b.Demux=?;", ["C", "Y"]),
+    ("checkUpload", "SELECT a.Name, a.ParentRun, b.ExperimentName FROM Projects a, Runs b WHERE a.ParentRun = b.Id and a.Upload=?;", ["U"]),
+    ("setUploadStatus", "SELECT Upload FROM Projects WHERE ParentRun=?;", [1]),
+    ("getRunProjects", "SELECT * FROM Projects WHERE ParentRun=? AND status='Y';", [1]),
+    ("ongoingOperations", """SELECT r.Id, r.ExperimentName, o.Download, o.Demux, o.Upload, o.Dstart, o.Dend, o.Xstart, o.Xend,
+  (SELECT min(p.Ustart) FROM Projects p WHERE p.ParentRun=r.Id AND p.Upload=o.Upload) AS Ustart,
+  (SELECT max(p.Uend) FROM Projects p WHERE p.ParentRun=r.Id AND p.Upload=o.Upload) AS Uend
+FROM Operations o, Runs r
+WHERE o.Id=r.Id and (o.Download=? or o.Download=? or o.Demux=? or o.Demux=? or o.Upload=? or o.Upload=?)
+ORDER BY r.DateCreated DESC;""", ["U", "Y", "U", "Y", "U", "Y"]),
+    ("getAllRuns", """SELECT r.Id FROM Runs r LEFT JOIN Operations o ON o.Id=r.Id
+ORDER BY r.DateCreated DESC, r.Id DESC LIMIT ? OFFSET ?;""", [10, 0]),
+]
+
+# Connection settings
+JOURNAL_MODE = "WAL"            # Lets readers (the run manager) work while the updater writes
+BUSY_TIMEOUT = 30               # Seconds to wait for a lock held by another process
+
+# When job completion events are enabled (eventsFile in the config), marker files are
+# only checked this often (in seconds), to catch jobs that did not write an event
+MARKER_POLL_INTERVAL = 900
+
+# Maximum number of job submissions and file checks run at the same time during an
+# update. Can be changed with updateWorkers in the config
+UPDATE_WORKERS = 4
+
+# How jobs are submitted: "single" calls the `submit' command once per job, "array" submits
+# all the jobs of an update cycle that run the same script as a single Slurm job array, with
+# sbatch (jobs that have their own submit command are still submitted one by one). Can be
+# changed with submitMode in the config
+SUBMIT_MODE = "single"
+
+# Slurm job states (as reported by sacct) of jobs that ended without doing their work.
+# Operations whose job ends in one of these states are marked as failed
+FAILED_JOB_STATES = ["FAILED", "TIMEOUT", "OUT_OF_MEMORY", "NODE_FAIL", "PREEMPTED",
+                     "CANCELLED", "BOOT_FAIL", "DEADLINE", "REVOKED"]
+
+# Default intervals (in seconds) for the stages of `rundb serve'. Can be changed with
+# pollInterval and syncInterval in the config
+POLL_INTERVAL = 10              # Completion checks and job submissions
+SYNC_INTERVAL = 300             # Basespace run list
+SYNC_CHECK_INTERVAL = 1         # How often to check whether a background sync has completed
+
+# Basespace run statuses that will not change anymore
+TERMINAL_STATUSES = ["Complete", "Failed", "Stopped", "TimedOut"]
+
+# Runs still not in a terminal status after this many days are no longer re-fetched
+SYNC_WINDOW = 14
+
 # Operation codes
 
 OP_NOT_REQUESTED = "N"
@@ -106,19 +238,79 @@ class Config(object):
         else:
             return None
 
+class Job(object):
+    """A job to be submitted to the scheduler: `script' is the path of the batch script,
+`args' the list of its arguments and `submit' the command used to submit it on its own.
+After submission, `jobid' contains the Slurm job ID, or `error' the reason it failed."""
+    script = ""
+    args = []
+    submit = "submit -p NGS"
+    jobid = None
+    error = None
+
+    def __init__(self, script, args, submit=None):
+        self.script = script
+        self.args = [ str(a) for a in args ]
+        if submit:
+            self.submit = submit
+
+    def command(self):
+        return " ".join([self.submit, self.script] + [ shlex.quote(a) for a in self.args ])
+
+def readDemuxMetrics(projdir):
+    """Read the Stats.json files of the projects in run directory `projdir' and return the
+rows of DemuxLanes and DemuxSamples for the run (without the RunId). Lane totals are the same
+in the Stats of every project; undetermined reads are the PF reads of the lane that were not
+assigned to a sample of any project."""
+    lanes = {}
+    samples = []
+    for (proj, jf, demux) in parse_demux_stats.statsFiles(projdir):
+        data = parse_demux_stats.readStats(jf, nunknown=0)
+        for cv in data["ConversionResults"]:
+            ln = cv["LaneNumber"]
+            lane = lanes.setdefault(ln, [ln, cv["TotalClustersRaw"], cv["TotalClustersPF"], 0])
+            for dr in cv["DemuxResults"]:
+                index = dr["IndexMetrics"][0]["IndexSequence"] if dr.get("IndexMetrics") else None
+                samples.append([ln, proj, dr["SampleName"], dr["SampleId"], index, dr["NumberReads"]])
+                lane[3] += dr["NumberReads"]
+    return ([ lane + [lane[2] - lane[3]] for lane in sorted(lanes.values()) ], samples)
+
+def sbatchDirectives(script):
+    """Return the options in the #SBATCH lines at the top of `script'."""
+    opts = []
+    with open(script, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("#SBATCH"):
+                opts.extend(shlex.split(line[7:]))
+            elif line and not line.startswith("#"):
+                break
+    return opts
+
+def parseJobId(output):
+    """Return the job ID printed by sbatch or submit (the last word of the output, without
+the cluster name that sbatch --parsable may add)."""
+    words = output.split()
+    if not words:
+        return None
+    return words[-1].split(";")[0]
+
 class RunDB(object):
     dbfile = "runs.db"
     conf = None
     _conn = None                # DB connection
-    _lvl = 0                    # For nested opendb() calls
+    _intxn = False              # Inside a transaction() block?
+    persistent = False          # Keep the connection open between transactions?
+    _fts = None                 # Is the full-text search index available?
 
     messages = []               # For notification emails
 
-    def __init__(self, configfile=None):
+    def __init__(self, configfile=None, persistent=False):
         if not configfile:
             configfile = getenv("RUNMGR_CONFIG")
         if os.path.isfile(configfile):
             self.conf = Config(configfile)
+        self.persistent = persistent
 
     def get(self, option):
         return self.conf.get(option)
@@ -127,19 +319,48 @@ class RunDB(object):
         msg = log(s, *args)
         self.messages.append(msg)
 
-    def opendb(self):
+    def connect(self):
+        """Open the database connection if needed. Transactions are managed explicitly by
+transaction(), so the connection is in autocommit mode."""
         if self._conn is None:
-            self._conn = sql.connect(self.dbfile)
+            self._conn = sql.connect(self.dbfile, timeout=BUSY_TIMEOUT, isolation_level=None)
             self._conn.row_factory = sql.Row
-        self._lvl += 1
+            mode = (self.conf and self.conf.get("dbJournalMode")) or JOURNAL_MODE
+            self._conn.execute("PRAGMA journal_mode={};".format(mode))
+            self._conn.execute("PRAGMA synchronous=NORMAL;")
+            self._conn.execute("PRAGMA busy_timeout={};".format(BUSY_TIMEOUT * 1000))
+        return self._conn
 
-    def closedb(self):
-        self._lvl += -1
-        if self._lvl == 0:
-            self._conn.commit()
+    def close(self):
+        if self._conn is not None:
             self._conn.close()
             self._conn = None
 
+    @contextmanager
+    def transaction(self, write=False):
+        """Run the enclosed block as a single transaction, committed at the end of the block
+or rolled back if an exception is raised. Nested blocks join the outermost transaction.
+Use `write' for blocks that modify the database, so the write lock is taken at the start
+instead of failing halfway. Unless the object is persistent, the connection is closed at
+the end of the outermost block."""
+        if self._intxn:
+            yield self._conn
+            return
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE;" if write else "BEGIN;")
+        self._intxn = True
+        try:
+            yield conn
+            conn.execute("COMMIT;")
+        except:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK;")
+            raise
+        finally:
+            self._intxn = False
+            if not self.persistent:
+                self.close()
+
     def execute(self, query, *args):
         return self._conn.execute(query, args)
         
@@ -153,74 +374,310 @@ class RunDB(object):
         return result
         
     def initialize(self):
-        self.opendb()
-        for tab in TABLES:
-            self.execute(tab)
-        self.closedb()
+        with self.transaction(write=True):
+            for tab in TABLES:
+                self.execute(tab)
+            self.execute("PRAGMA user_version=0;")
+        self._fts = None
+        self.migrate()
+
+    def schemaVersion(self):
+        with self.transaction():
+            return self.execute("PRAGMA user_version;").fetchone()[0]
+
+    def migrate(self):
+        """Bring the database schema up to date, applying each pending migration in its own
+transaction. Returns the number of migrations applied."""
+        n = 0
+        while True:
+            with self.transaction(write=True):
+                version = self.execute("PRAGMA user_version;").fetchone()[0]
+                if version >= len(MIGRATIONS):
+                    break
+                for step in MIGRATIONS[version]:
+                    if step.startswith("migrate"):
+                        getattr(self, step)()
+                    else:
+                        self.execute(step)
+                self.execute("PRAGMA user_version={};".format(version + 1))
+            log("Database schema migrated to version {}.", version + 1)
+            n += 1
+        return n
+
+    def migrateRunFields(self):
+        """Add the RUN_FIELDS columns to Runs and fill them from the stored Json."""
+        existing = [ row["name"] for row in self.execute("PRAGMA table_info(Runs);").fetchall() ]
+        for (col, typ, path) in RUN_FIELDS:
+            if col not in existing:
+                self.execute("ALTER TABLE Runs ADD COLUMN {} {};".format(col, typ))
+        rows = []
+        for row in self.execute("SELECT Id, Json FROM Runs;").fetchall():
+            if row["Json"]:
+                rows.append(runFields(json.loads(row["Json"])) + [row["Id"]])
+        self._conn.executemany("UPDATE Runs SET {} WHERE Id=?;".format(
+            ", ".join([ f[0] + "=?" for f in RUN_FIELDS ])), rows)
+
+    def migrateJobIds(self):
+        """Add the JOB_ID_COLUMNS to their tables."""
+        for (table, col) in JOB_ID_COLUMNS:
+            existing = [ row["name"] for row in self.execute("PRAGMA table_info({});".format(table)).fetchall() ]
+            if col not in existing:
+                self.execute("ALTER TABLE {} ADD COLUMN {} text;".format(table, col))
+
+    def explainQueries(self):
+        """Print the query plan of each hot query, flagging the ones that scan a whole table.
+Returns the number of flagged queries."""
+        nbad = 0
+        with self.transaction():
+            for (name, query, args) in HOT_QUERIES:
+                plan = [ row[3] for row in self.execute1("EXPLAIN QUERY PLAN " + query, args).fetchall() ]
+                scans = [ p for p in plan if p.startswith("SCAN") and "INDEX" not in p ]
+                sys.stdout.write("{:20} {}\n".format(name, "SCAN" if scans else "ok"))
+                for p in plan:
+                    sys.stdout.write("    {}\n".format(p))
+                if scans:
+                    nbad += 1
+        return nbad
+
+    def getSetting(self, name, default=None):
+        with self.transaction():
+            row = self.execute("SELECT Value FROM Settings WHERE Name=?", name).fetchone()
+            return row[0] if row else default
+
+    def setSetting(self, name, value):
+        with self.transaction(write=True):
+            self.execute("INSERT OR REPLACE INTO Settings (Name, Value) VALUES (?, ?);", name, value)
 
     def loadAllRuns(self):
+        """Load the full list of runs from Basespace."""
         BS = Basespace.Basespace(self.conf)
         runs = BS.getRuns()
-        nnew = 0
-        self.opendb()
-        try:
-            for run in runs:
-                found = self.execute("SELECT Id FROM Runs WHERE Id=?", run["Id"]).fetchone()
-                if found:
-                    self.execute("UPDATE Runs SET Status=?, Json=? WHERE Id=?",
-                                 run["Status"], json.dumps(run), run["Id"])
-                else:
-                    nnew += 1
-                    self.execute("INSERT INTO Runs (Id, ExperimentName, DateCreated, Status, Json) VALUES (?, ?, ?, ?, ?)",
-                                 run["Id"], run["ExperimentName"], run["DateCreated"], run["Status"], json.dumps(run))
-        finally:
-            self.closedb()
+        self.storeRuns(runs)
+
+    def loadNewRuns(self):
+        """Incremental version of loadAllRuns(): only fetch runs created after the most recent
+one we already have, or after the oldest recent run that is not in a terminal status yet.
+Falls back to loading all runs if the database has never been synced."""
+        self.storeRuns(self.fetchNewRuns(self.syncStart()))
+
+    def fetchNewRuns(self, since):
+        """Get the runs created after `since' (all runs if None) from Basespace. Does not use
+the database, so it can run in a separate thread."""
+        BS = Basespace.Basespace(self.conf)
+        if since is None:
+            return BS.getRuns()
+        return BS.getRuns(newerThan=since)
+
+    def syncStart(self):
+        """Return the date (YYYY-MM-DD) from which runs should be fetched, or None for a full load."""
+        last = self.getSetting("LastRunDate")
+        if not last:
+            return None
+        oldest = (datetime.now() - timedelta(days=SYNC_WINDOW)).isoformat()
+        with self.transaction():
+            row = self.execute("SELECT min(DateCreated) FROM Runs WHERE Status NOT IN ({}) AND DateCreated>=?;".format(
+                ", ".join(["?"] * len(TERMINAL_STATUSES))), *(TERMINAL_STATUSES + [oldest])).fetchone()
+        if row and row[0]:
+            last = min(last, row[0])
+        return last[:10]
+
+    def storeRuns(self, runs):
+        """Add or update `runs' (as returned by Basespace) in the database with a single
+batched upsert, skipping the ones that have not changed. Returns the number of new and
+changed runs."""
+        last = self.getSetting("LastRunDate", "")
+        rows = []
+        for run in runs:
+            last = max(last, run["DateCreated"])
+            rows.append([run["Id"], run["ExperimentName"], run["DateCreated"], run["Status"], json.dumps(run)] + runFields(run))
+        columns = ["Id", "ExperimentName", "DateCreated", "Status", "Json"] + [ f[0] for f in RUN_FIELDS ]
+        updates = ["Status", "Json"] + [ f[0] for f in RUN_FIELDS ]
+        with self.transaction(write=True):
+            # Runs that are new or will be changed by the upsert, for the search index
+            existing = {}
+            for i in range(0, len(rows), 500):
+                ids = [ row[0] for row in rows[i:i+500] ]
+                for r in self.execute("SELECT Id, Status, Json FROM Runs WHERE Id IN ({});".format(", ".join(["?"] * len(ids))), *ids).fetchall():
+                    existing[str(r[0])] = (r[1], r[2])
+            modified = [ row[0] for row in rows if existing.get(str(row[0])) != (row[3], row[4]) ]
+            before = self.execute("SELECT count(*) FROM Runs;").fetchone()[0]
+            cur = self._conn.executemany("""INSERT INTO Runs ({}) VALUES ({})
+ON CONFLICT(Id) DO UPDATE SET {}
+WHERE Runs.Status IS NOT excluded.Status OR Runs.Json IS NOT excluded.Json;""".format(
+                ", ".join(columns), ", ".join(["?"] * len(columns)), ", ".join([ c + "=excluded." + c for c in updates ])), rows)
+            nnew = self.execute("SELECT count(*) FROM Runs;").fetchone()[0] - before
+            nchanged = cur.rowcount - nnew
+            if last:
+                self.setSetting("LastRunDate", last)
+            if modified:
+                self.indexRuns(modified)
         if nnew > 0:
             log("{} runs downloaded from Basespace, {} new runs added.", len(runs), nnew)
+        return nnew, nchanged
 
     def getOperations(self, Id):
-        self.opendb()
-        try:
+        with self.transaction(write=True):
             row = self.execute("SELECT Download, Demux, Upload FROM Operations WHERE Id=?", Id).fetchone()
             if row:
                 return row
             else:
                 self.execute("INSERT INTO Operations(Id) VALUES (?)", Id)
                 return [OP_NOT_REQUESTED, OP_NOT_REQUESTED, OP_NOT_REQUESTED]
-        finally:
-            self.closedb()
 
-    def startDownloads(self):
-        self.opendb()
+    # Operations are carried out in three steps: the pending work is read from the
+    # database, the slow parts (job submissions, file checks) run in a pool of worker
+    # threads, then the resulting state changes are written in one short transaction.
+    # Each of the start* and check* methods returns its work as a list of tasks, each
+    # one a tuple (description, work, apply): work() runs in a worker thread and must not
+    # touch the database, apply(result) runs in the main thread inside the write
+    # transaction. If `tasks' is a list the new tasks are added to it, otherwise they are
+    # run immediately. A work() function that needs to start a job returns a Job instead of
+    # submitting it: all the jobs returned by a set of tasks are submitted together by
+    # submitJobs(), and apply() only receives the jobs that were submitted successfully.
+
+    def runTasks(self, new, tasks=None):
+        if tasks is not None:
+            tasks.extend(new)
+            return tasks
+        if not new:
+            return []
+        nworkers = max(1, int(self.get("updateWorkers") or UPDATE_WORKERS))
+        with ThreadPoolExecutor(max_workers=min(nworkers, len(new))) as pool:
+            futures = [ pool.submit(t[1]) for t in new ]
+        done = []
+        for (t, fut) in zip(new, futures):
+            try:
+                done.append((t, fut.result()))
+            except Exception as e:
+                log("Error in {}: {}", t[0], e)
+        self.submitJobs([ result for (t, result) in done if isinstance(result, Job) ])
+        # Each result is applied in its own savepoint, so that an error in one of them does
+        # not undo the others (e.g. the status of jobs that were just submitted)
+        with self.transaction(write=True):
+            for (t, result) in done:
+                if isinstance(result, Job) and not result.jobid:
+                    log("Error in {}: {}", t[0], result.error)
+                    continue
+                self.execute("SAVEPOINT task;")
+                try:
+                    t[2](result)
+                except Exception as e:
+                    self.execute("ROLLBACK TO task;")
+                    log("Error in {}: {}", t[0], e)
+                self.execute("RELEASE task;")
+        return new
+
+    def submitJobs(self, jobs):
+        """Submit `jobs' (a list of Job objects), setting their jobid or error. In array mode
+the jobs that run the same script are submitted as one Slurm job array, so there is a single
+sbatch call per script however many jobs are pending. Jobs with their own submit command
+are always submitted separately with it, since sbatch would bypass what it sets up."""
+        array = (self.get("submitMode") or SUBMIT_MODE) == "array"
+        groups = {}
+        for job in jobs:
+            if array and job.submit == Job.submit:
+                groups.setdefault(job.script, []).append(job)
+            else:
+                self.submitSingle(job)
+        for (script, group) in groups.items():
+            try:
+                self.submitArray(script, group)
+            except (OSError, subprocess.CalledProcessError) as e:
+                for job in group:
+                    job.error = str(e)
+        return jobs
+
+    def submitSingle(self, job):
         try:
-            for row in self.execute("""SELECT b.Id, b.ExperimentName 
+            job.jobid = parseJobId(subprocess.check_output(job.command(), shell=True, universal_newlines=True))
+        except (OSError, subprocess.CalledProcessError) as e:
+            job.error = str(e)
+
+    def submitArray(self, script, jobs):
+        """Submit `jobs', all running `script', with a single sbatch call. Each task of the
+array runs the script through the array driver, which reads its arguments from a file. The
+#SBATCH directives of the script are passed to sbatch, since it only reads them from the
+driver. The tasks get job IDs of the form ARRAYID_INDEX."""
+        name = os.path.splitext(os.path.basename(script))[0]
+        cmdline = [self.get("sbatch") or "sbatch", "--parsable", "--job-name=" + name] + sbatchDirectives(script)
+        cmdline += shlex.split(self.get("sbatchOptions") or "")
+        if len(jobs) == 1:
+            cmdline += [script] + jobs[0].args
+        else:
+            cmdline += ["--array=0-{}".format(len(jobs) - 1), self.arrayDriver(), script, self.writeArrayArgs(name, jobs)]
+        jobid = parseJobId(subprocess.check_output(cmdline, universal_newlines=True))
+        if not jobid:
+            raise OSError("no job ID returned by sbatch")
+        if len(jobs) == 1:
+            jobs[0].jobid = jobid
+        else:
+            for (i, job) in enumerate(jobs):
+                job.jobid = "{}_{}".format(jobid, i)
+        log("Submitted {} {} job(s) as {}", len(jobs), name, jobid)
+
+    def arrayDriver(self):
+        return self.get("ARRAY") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "array_job.sh")
+
+    def writeArrayArgs(self, name, jobs):
+        """Write the arguments of `jobs', one tab-separated line per job, to a new file in the
+jobs directory, and return its path. The directory must be visible from the compute nodes."""
+        jobsdir = self.get("jobsDirectory") or os.path.abspath(self.dbfile) + ".jobs"
+        os.makedirs(jobsdir, exist_ok=True)
+        path = os.path.join(jobsdir, "{}-{}.args".format(name, datetime.now().strftime("%Y%m%d%H%M%S%f")))
+        with open(path, "w") as f:
+            for job in jobs:
+                f.write("\t".join(job.args) + "\n")
+        return path
+
+    def startDownloads(self, tasks=None):
+        with self.transaction():
+            rows = self.execute("""SELECT b.Id, b.ExperimentName 
 FROM Operations a, Runs b 
-WHERE A.Id == B.Id and a.Download='{}' and b.Status!='Running' and b.Status!='Uploading';""".format(OP_REQUESTED)).fetchall():
-                Id = row[0]
-                ExpName = row[1]
+WHERE A.Id == B.Id and a.Download='{}' and b.Status!='Running' and b.Status!='Uploading';""".format(OP_REQUESTED)).fetchall()
+        new = []
+        for row in rows:
+            Id = row[0]
+            ExpName = row[1]
+            job = Job(self.get("binPath") + "/download_run.qsub", [ExpName, self.get("runDirectory")])
+            def apply(job, Id=Id, ExpName=ExpName):
                 self.log("Starting download of run {}", ExpName)
-                subprocess.check_call("submit -p NGS {}/download_run.qsub {} {}".format(self.get("binPath"), ExpName, self.get("runDirectory")), shell=True)
-                self.execute("UPDATE Operations SET Download='{}', Dstart=? WHERE Id=?".format(OP_ONGOING), now(), Id)
-        finally:
-            self.closedb()
+                self.execute("UPDATE Operations SET Download='{}', Dstart=?, Djob=? WHERE Id=?".format(OP_ONGOING), now(), job.jobid, Id)
+            new.append(("download of " + ExpName, lambda job=job: job, apply))
+        return self.runTasks(new, tasks)
+
+    def checkDownloads(self, tasks=None):
+        with self.transaction():
+            rows = self.execute("SELECT b.Id, b.ExperimentName FROM Operations a, Runs b WHERE a.Id=b.Id and a.Download=?;", OP_ONGOING).fetchall()
+        new = []
+        for row in rows:
+            Id = row["Id"]
+            ExpName = row["ExperimentName"]
+            def work(ExpName=ExpName):
+                return self.downloadMarker(ExpName)
+            def apply(good, Id=Id, ExpName=ExpName):
+                if good is not None:
+                    self.finishDownload(Id, ExpName, good)
+            new.append(("download check of " + ExpName, work, apply))
+        return self.runTasks(new, tasks)
+
+    def downloadMarker(self, ExpName):
+        """Return True or False if the download of run `ExpName' left its SUCCESS or FAILED
+marker, None if it left neither."""
+        if os.path.isfile("{}/{}/FAILED".format(self.get("runDirectory"), ExpName)):
+            return False
+        elif os.path.isfile("{}/{}/SUCCESS".format(self.get("runDirectory"), ExpName)):
+            return True
+        return None
+
+    def finishDownload(self, Id, ExpName, good):
+        with self.transaction(write=True):
+            if good:
+                self.log("Download of run {}: SUCCESS", ExpName)
+                self.execute("UPDATE Operations SET Download=?, Dend=? WHERE Id=?", OP_COMPLETED, now(), Id)
+            else:
+                self.log("Download of run {}: FAILED", ExpName)
+                self.execute("UPDATE Operations SET Download=?, Dend=? WHERE Id=?", OP_FAILED, now(), Id)
 
-    def checkDownloads(self):
-        self.opendb()
-        try:
-            for row in self.execute("SELECT b.Id, b.ExperimentName FROM Operations a, Runs b WHERE a.Id=b.Id and a.Download=?;", OP_ONGOING).fetchall():
-                Id = row["Id"]
-                ExpName = row["ExperimentName"]
-                success = "{}/{}/SUCCESS".format(self.get("runDirectory"), ExpName)
-                failed = "{}/{}/FAILED".format(self.get("runDirectory"), ExpName)
-                if os.path.isfile(failed):
-                    self.log("Download of run {}: FAILED", ExpName)
-                    self.execute("UPDATE Operations SET Download=?, Dend=? WHERE Id=?", OP_FAILED, now(), Id)
-                elif os.path.isfile(success):
-                    self.log("Download of run {}: SUCCESS", ExpName)
-                    self.execute("UPDATE Operations SET Download=?, Dend=? WHERE Id=?", OP_COMPLETED, now(), Id)
-        finally:
-            self.closedb()
-        
     def copySampleSheetIfExists(self, runname, flowcell):
         sspattern = "{}/*{}*.csv".format(self.get("sampleSheetsPath"), flowcell)
         sheets = glob(sspattern)
@@ -239,76 +696,91 @@ WHERE A.Id == B.Id and a.Download='{}' and b.Status!='Running' and b.Status!='Up
         return False
 
     def setSampleSheet(self, runId, ssname):
-        self.opendb()
-        try:
+        with self.transaction(write=True):
             self.execute("""UPDATE Runs SET Samplesheet=? WHERE Id=?;""", ssname, runId)
-        finally:
-            self.closedb()
 
     def hasSampleSheet(self, runId):
-        self.opendb()
-        try:
+        with self.transaction():
             res = self.execute("""SELECT Samplesheet FROM Runs WHERE ID=?;""", runId).fetchone()
             if res:
                 return res[0]
             else:
                 return None
-        finally:
-            self.closedb()
 
-    def startDemux(self):
-        self.opendb()
-        try:
-            for row in self.execute("SELECT a.Id, a.ExperimentName, a.Json FROM Runs a, Operations b WHERE a.Id=b.Id and b.Download='{}' and b.Demux='{}';"
-                                    .format(OP_COMPLETED, OP_REQUESTED)).fetchall():
-                runname = row["ExperimentName"]
-                rundata = json.loads(row["Json"])
-                flowcell = rundata["FlowcellBarcode"]
+    def startDemux(self, tasks=None):
+        with self.transaction():
+            rows = self.execute("SELECT a.Id, a.ExperimentName, a.FlowcellBarcode FROM Runs a, Operations b WHERE a.Id=b.Id and b.Download='{}' and b.Demux='{}';"
+                                .format(OP_COMPLETED, OP_REQUESTED)).fetchall()
+        new = []
+        for row in rows:
+            runname = row["ExperimentName"]
+            flowcell = row["FlowcellBarcode"]
+            def work(runname=runname, flowcell=flowcell):
                 ss = self.copySampleSheetIfExists(runname, flowcell)
                 if ss:
-                    subprocess.check_call("submit -p NGS {}/pardemux.qsub {} {} {}".format(
-                        self.get("binPath"), runname, ss, self.get("projectsPath")), shell=True)
-                    self.log("Starting demux of run {}", row[1])
-                    self.execute("UPDATE Runs SET Samplesheet=? WHERE Id=?", os.path.split(ss)[1], row["Id"])
-                    self.execute("UPDATE Operations SET Demux=?, Xstart=? WHERE Id=?", OP_ONGOING, now(), row["Id"])
-        finally:
-            self.closedb()
+                    return Job(self.get("binPath") + "/pardemux.qsub", [runname, ss, self.get("projectsPath")])
+                return None
+            def apply(job, runId=row["Id"], runname=runname):
+                if job:
+                    self.log("Starting demux of run {}", runname)
+                    self.execute("UPDATE Runs SET Samplesheet=? WHERE Id=?", os.path.split(job.args[1])[1], runId)
+                    self.execute("UPDATE Operations SET Demux=?, Xstart=?, Xjob=? WHERE Id=?", OP_ONGOING, now(), job.jobid, runId)
+            new.append(("demux of " + runname, work, apply))
+        return self.runTasks(new, tasks)
 
     def newDemux(self, rundata, projects, newops):
-        cmdline = "submit -p NGS {}/reDemux.qsub {}".format(self.get("binPath"), rundata["ExperimentName"])
-        doit = False
+        job = Job(self.get("binPath") + "/reDemux.qsub", [rundata["ExperimentName"]])
         for pr in projects:
             pname = pr["Name"]
             no = newops[pname]
             if no:
-                cmdline += " " + pname + " " + str(no)
-                doit = True
-        if doit:
-            subprocess.check_call(cmdline, shell=True)
+                job.args += [pname, str(no)]
+        if len(job.args) > 1:
+            self.submitJobs([job])
+            if not job.jobid:
+                raise OSError("Could not submit redemux job: {}".format(job.error))
             self.log("Starting redemux of run {}", rundata["ExperimentName"])
-        return cmdline
+            with self.transaction(write=True):
+                self.execute("UPDATE Operations SET Xjob=? WHERE Id=?", job.jobid, rundata["Id"])
+        return job
     
-    def checkDemux(self):
-        self.opendb()
-        try:
-            for row in self.execute("SELECT a.Id, a.ExperimentName FROM Runs a, Operations b WHERE a.Id=b.Id and b.Demux=?;", OP_ONGOING).fetchall():
-                runId = row[0]
-                name = row[1]
-                statusPath = self.get("projectsPath") + "/" + name + "/STATUS"
+    def checkDemux(self, tasks=None):
+        with self.transaction():
+            rows = self.execute("SELECT a.Id, a.ExperimentName FROM Runs a, Operations b WHERE a.Id=b.Id and b.Demux=?;", OP_ONGOING).fetchall()
+        new = []
+        for row in rows:
+            runId = row[0]
+            name = row[1]
+            statusPath = self.get("projectsPath") + "/" + name + "/STATUS"
+            def work(name=name, statusPath=statusPath):
                 if os.path.isfile(statusPath):
-                    self.log("Run {} demux: SUCCESS, statusfile={}", name, statusPath)
-                    self.execute("UPDATE Operations SET Demux=?, Xend=? WHERE Id=?;", OP_COMPLETED, now(), runId)
-                    self.recordDemuxProjects(runId, statusPath)
-#                else:
-#                    self.execute("UPDATE Operations SET Demux=?, Xend=? WHERE Id=?;", OP_FAILED, now(), runId)
-#                    self.log("Run {} demux: FAILED", name)
-        finally:
-            self.closedb()
+                    return self.demuxMetrics(name)
+                return None
+            def apply(metrics, runId=runId, name=name, statusPath=statusPath):
+                if metrics is not None:
+                    self.finishDemux(runId, name, statusPath, metrics)
+            new.append(("demux check of " + name, work, apply))
+        return self.runTasks(new, tasks)
+
+    def finishDemux(self, runId, name, statusPath, metrics=None):
+        """Mark the demux of run `name' as completed, recording its projects and its demux
+`metrics' (read from the run directory if not supplied)."""
+        if metrics is None:
+            metrics = self.demuxMetrics(name)
+        with self.transaction(write=True):
+            self.log("Run {} demux: SUCCESS, statusfile={}", name, statusPath)
+            self.execute("UPDATE Operations SET Demux=?, Xend=? WHERE Id=?;", OP_COMPLETED, now(), runId)
+            self.recordDemuxProjects(runId, statusPath)
+            self.storeDemuxMetrics(runId, metrics)
+
+    def failDemux(self, runId, name):
+        with self.transaction(write=True):
+            self.execute("UPDATE Operations SET Demux=?, Xend=? WHERE Id=?;", OP_FAILED, now(), runId)
+            self.log("Run {} demux: FAILED", name)
 
     def recordDemuxProjects(self, runId, statusPath):
         ts = now()
-        self.opendb()
-        try:
+        with self.transaction(write=True):
             with open(statusPath, "r") as f:
                 c = csv.reader(f, delimiter='\t')
                 for row in c:
@@ -317,65 +789,322 @@ WHERE A.Id == B.Id and a.Download='{}' and b.Status!='Running' and b.Status!='Up
                     self.execute("INSERT INTO Projects (Name, ParentRun, Timestamp, Status, Upload) VALUES (?, ?, ?, ?, ?);",
                                  proj, runId, ts, status, OP_NOT_REQUESTED)
                     self.log("Project {}: {}", proj, status)
-        finally:
-            self.closedb()
+            self.indexRuns([runId])
 
-    def startUpload(self):
-        self.opendb()
+    def demuxMetrics(self, name):
+        """Read the demux metrics of run `name' from its directory in projectsPath. Errors are
+logged and give empty metrics, so they never keep a demux from being marked as completed."""
         try:
-            for row in self.execute("""SELECT a.Name, a.ParentRun, b.ExperimentName FROM Projects a, Runs b WHERE a.ParentRun = b.Id and a.Upload=?;""", OP_REQUESTED).fetchall():
-                proj = row[0]
-                run = row[2]
-                statusFile = self.get("projectsPath") + "/" + run + "/" + proj + "/UPLOAD"
+            return readDemuxMetrics(self.get("projectsPath") + "/" + name)
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            log("Could not read demux metrics of run {}: {}", name, e)
+            return ([], [])
+
+    def storeDemuxMetrics(self, runId, metrics):
+        """Replace the demux metrics of run `runId' with `metrics' (as returned by readDemuxMetrics)."""
+        (lanes, samples) = metrics
+        with self.transaction(write=True):
+            self.execute("DELETE FROM DemuxLanes WHERE RunId=?;", runId)
+            self.execute("DELETE FROM DemuxSamples WHERE RunId=?;", runId)
+            self._conn.executemany("""INSERT INTO DemuxLanes (RunId, Lane, TotalClustersRaw, TotalClustersPF, IdentifiedReads, Undetermined)
+VALUES (?, ?, ?, ?, ?, ?);""", [ [runId] + lane for lane in lanes ])
+            self._conn.executemany("""INSERT INTO DemuxSamples (RunId, Lane, Project, Sample, SampleId, IndexSequence, NumberReads)
+VALUES (?, ?, ?, ?, ?, ?, ?);""", [ [runId] + smp for smp in samples ])
+
+    def ingestDemux(self, names=None):
+        """Load the demux metrics of the runs called `names' (default: all runs whose demux
+completed) from their Stats.json files."""
+        with self.transaction():
+            if names:
+                rows = []
+                for name in names:
+                    row = self.execute("SELECT Id, ExperimentName FROM Runs WHERE ExperimentName=?;", name).fetchone()
+                    if row:
+                        rows.append(row)
+                    else:
+                        log("Run {} not found.", name)
+            else:
+                rows = self.execute("SELECT a.Id, a.ExperimentName FROM Runs a, Operations b WHERE a.Id=b.Id and b.Demux=?;", OP_COMPLETED).fetchall()
+        for (runId, name) in rows:
+            metrics = self.demuxMetrics(name)
+            self.storeDemuxMetrics(runId, metrics)
+            log("Run {}: {} lanes, {} samples.", name, len(metrics[0]), len(metrics[1]))
 
+    def demuxTrends(self, n=50, bylane=False):
+        """Return the demux metrics of the `n' most recent runs that have them, most recent
+first: (run, date, lanes, raw clusters, PF clusters, identified reads, undetermined reads),
+one row per run or, with `bylane', per lane (lanes is then the lane number)."""
+        with self.transaction():
+            if bylane:
+                return self.execute("""SELECT r.ExperimentName, r.DateCreated, l.Lane, l.TotalClustersRaw, l.TotalClustersPF, l.IdentifiedReads, l.Undetermined
+FROM DemuxLanes l, Runs r
+WHERE l.RunId=r.Id AND r.Id IN (SELECT Id FROM Runs WHERE Id IN (SELECT RunId FROM DemuxLanes) ORDER BY DateCreated DESC LIMIT ?)
+ORDER BY r.DateCreated DESC, r.Id, l.Lane;""", n).fetchall()
+            return self.execute("""SELECT r.ExperimentName, r.DateCreated, count(*), sum(l.TotalClustersRaw), sum(l.TotalClustersPF), sum(l.IdentifiedReads), sum(l.Undetermined)
+FROM DemuxLanes l, Runs r
+WHERE l.RunId=r.Id
+GROUP BY r.Id
+ORDER BY r.DateCreated DESC LIMIT ?;""", n).fetchall()
+
+    def showTrends(self, args):
+        """Print the demux trends table for `rundb trends [lanes] [N]'."""
+        bylane = "lanes" in args
+        n = 50
+        for a in args:
+            if a.isdigit():
+                n = int(a)
+        rows = self.demuxTrends(n, bylane)
+        sys.stdout.write("Run\tDate\t{}\tRaw clusters\tPF clusters\tPF%\tUndetermined\tUndet% of PF\n".format("Lane" if bylane else "Lanes"))
+        undet = []
+        for row in rows:
+            pfpct = 100.0 * row[4] / row[3] if row[3] else 0.0
+            undpct = 100.0 * row[6] / row[4] if row[4] else 0.0
+            undet.append(undpct)
+            sys.stdout.write("{}\t{}\t{}\t{}\t{}\t{:.1f}%\t{}\t{:.1f}%\n".format(row[0], (row[1] or "")[:10], row[2], row[3], row[4], pfpct, row[6], undpct))
+        if undet:
+            sys.stdout.write("\n{} {}: undetermined {:.1f}% of PF on average (min {:.1f}%, max {:.1f}%)\n".format(
+                len(undet), "lanes" if bylane else "runs", sum(undet) / len(undet), min(undet), max(undet)))
+
+    def startUpload(self, tasks=None):
+        with self.transaction():
+            rows = self.execute("""SELECT a.Name, a.ParentRun, b.ExperimentName FROM Projects a, Runs b WHERE a.ParentRun = b.Id and a.Upload=?;""", OP_REQUESTED).fetchall()
+        new = []
+        for row in rows:
+            proj = row[0]
+            run = row[2]
+            statusFile = self.get("projectsPath") + "/" + run + "/" + proj + "/UPLOAD"
+            def work(proj=proj, run=run, statusFile=statusFile):
                 # If we're retrying upload, remove previous status
                 if os.path.isfile(statusFile):
                     os.remove(statusFile)
 
-                # Submit upload job
-                subprocess.check_call("/apps/dibig_tools/1.0/bin/submit -p NGS {}/upload-project.qsub {}/{}/{}".format(
-                    self.get("binPath"), self.get("projectsPath"), run, proj), shell=True)
+                # Upload job
+                return Job(self.get("binPath") + "/upload-project.qsub", ["{}/{}/{}".format(self.get("projectsPath"), run, proj)],
+                           submit="/apps/dibig_tools/1.0/bin/submit -p NGS")
+            def apply(job, proj=proj, runId=row[1]):
                 self.log("Starting upload of project {}", proj)
-                self.execute("UPDATE Projects SET Upload=?, Ustart=? WHERE Name=? AND ParentRun=?;", OP_ONGOING, now(), proj, row[1])
-                self.setUploadStatus(row[1])
-        finally:
-            self.closedb()
+                self.execute("UPDATE Projects SET Upload=?, Ustart=?, Ujob=? WHERE Name=? AND ParentRun=?;", OP_ONGOING, now(), job.jobid, proj, runId)
+                self.setUploadStatus(runId)
+            new.append(("upload of " + proj, work, apply))
+        return self.runTasks(new, tasks)
+
+    def checkUpload(self, tasks=None):
+        with self.transaction():
+            rows = self.execute("""SELECT a.Name, a.ParentRun, b.ExperimentName FROM Projects a, Runs b WHERE a.ParentRun = b.Id and a.Upload=?;""", OP_ONGOING).fetchall()
+        new = []
+        for row in rows:
+            proj = row["Name"]
+            run = row["ExperimentName"]
+            def work(run=run, proj=proj):
+                return self.uploadMarker(run, proj)
+            def apply(code, proj=proj, runId=row["ParentRun"]):
+                if code is not None:
+                    self.finishUpload(proj, runId, code == "0")
+            new.append(("upload check of " + proj, work, apply))
+        return self.runTasks(new, tasks)
 
-    def checkUpload(self):
-        self.opendb()
+    def uploadMarker(self, run, proj):
+        """Return the exit code written to the UPLOAD marker of project `proj' of run `run',
+or None if there is no marker yet."""
+        statusFile = self.get("projectsPath") + "/" + run + "/" + proj + "/UPLOAD"
+        if os.path.isfile(statusFile):
+            with open(statusFile, "r") as f:
+                return f.readline().strip()
+        return None
+
+    def finishUpload(self, proj, runId, good):
+        with self.transaction(write=True):
+            if good:
+                self.log("Upload of project {}: SUCCESS", proj)
+                self.execute("UPDATE Projects SET Upload=?, Uend=? WHERE Name=? AND ParentRun=?;", OP_COMPLETED, now(), proj, runId)
+            else:
+                self.log("Upload of project {}: FAILED", proj)
+                self.execute("UPDATE Projects SET Upload=?, Uend=? WHERE Name=? AND ParentRun=?;", OP_FAILED, now(), proj, runId)
+            self.setUploadStatus(runId)
+
+    # Job completion events
+
+    def readEvents(self):
+        """Return the job completion events appended to the events file since the position
+saved in the database, as lists of [timestamp, kind, run, project, status], and the new
+position to save once they have been applied (None if it has not changed)."""
+        path = self.get("eventsFile")
+        if not path or not os.path.isfile(path):
+            return ([], None)
+        start = offset = int(self.getSetting("EventOffset", "0"))
+        size = os.path.getsize(path)
+        if size < offset:       # File was truncated or rotated
+            offset = 0
+        events = []
+        if size > offset:
+            with open(path, "rb") as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break   # Still being written
+                    offset += len(line)
+                    fields = line.decode(errors="replace").rstrip("\n").split("\t")
+                    if len(fields) >= 5:
+                        events.append(fields[:5])
+        return (events, offset if offset != start else None)
+
+    def processEvents(self):
+        """Apply job completion events to ongoing operations. Returns the number of events read."""
+        (events, offset) = self.readEvents()
+        # Demux metrics are read before taking the write lock
+        metrics = {}
+        for (ts, kind, run, proj, status) in events:
+            if kind == "demux" and run not in metrics and os.path.isfile(self.get("projectsPath") + "/" + run + "/STATUS"):
+                metrics[run] = self.demuxMetrics(run)
+        with self.transaction(write=True):
+            # Saved with the changes made by the events, so that they are read again if
+            # applying them fails
+            if offset is not None:
+                self.setSetting("EventOffset", str(offset))
+            for (ts, kind, run, proj, status) in events:
+                if kind == "download":
+                    row = self.execute("SELECT b.Id FROM Operations a, Runs b WHERE a.Id=b.Id and a.Download=? and b.ExperimentName=?;", OP_ONGOING, run).fetchone()
+                    if row:
+                        self.finishDownload(row["Id"], run, status == "SUCCESS")
+                elif kind == "demux":
+                    row = self.execute("SELECT a.Id FROM Runs a, Operations b WHERE a.Id=b.Id and b.Demux=? and a.ExperimentName=?;", OP_ONGOING, run).fetchone()
+                    statusPath = self.get("projectsPath") + "/" + run + "/STATUS"
+                    if row and os.path.isfile(statusPath):
+                        self.finishDemux(row["Id"], run, statusPath, metrics.get(run))
+                elif kind == "upload":
+                    row = self.execute("""SELECT a.ParentRun FROM Projects a, Runs b WHERE a.ParentRun = b.Id and a.Upload=? and a.Name=? and b.ExperimentName=?;""", OP_ONGOING, proj, run).fetchone()
+                    if row:
+                        self.finishUpload(proj, row["ParentRun"], status == "0")
+                elif kind == "project":
+                    log("Run {} project {} demux: {}", run, proj, status)
+        return len(events)
+
+    # Job state reconciliation
+
+    def jobStates(self, jobids):
+        """Return a dictionary with the Slurm state of each job in `jobids', obtained with a
+single sacct call (the command can be replaced with sacct in the config, e.g. by a stand-in
+for testing). Jobs unknown to sacct are not included."""
+        cmdline = shlex.split(self.get("sacct") or "sacct") + ["--noheader", "--parsable2", "--allocations",
+                                                               "--format=JobID,State", "--jobs=" + ",".join(jobids)]
+        states = {}
+        for line in subprocess.check_output(cmdline, universal_newlines=True).splitlines():
+            fields = line.split("|")
+            if len(fields) >= 2 and fields[1]:
+                states[fields[0]] = fields[1].split()[0]    # "CANCELLED by 1234"
+        return states
+
+    def reconcileJobs(self):
+        """Compare ongoing operations with the state of their jobs. Operations whose job was
+killed, timed out or crashed are finished according to their marker files if these exist
+(the job may have failed after its main work was done, e.g. while writing reports), and
+marked failed otherwise. Returns True if any job completed normally, so that its marker
+files should be checked now."""
+        with self.transaction():
+            downloads = self.execute("SELECT b.Id, b.ExperimentName, a.Djob FROM Operations a, Runs b WHERE a.Id=b.Id and a.Download=? and a.Djob IS NOT NULL;", OP_ONGOING).fetchall()
+            demuxes = self.execute("SELECT a.Id, a.ExperimentName, b.Xjob FROM Runs a, Operations b WHERE a.Id=b.Id and b.Demux=? and b.Xjob IS NOT NULL;", OP_ONGOING).fetchall()
+            uploads = self.execute("SELECT a.Name, a.ParentRun, a.Ujob, b.ExperimentName FROM Projects a, Runs b WHERE a.ParentRun=b.Id and a.Upload=? and a.Ujob IS NOT NULL;", OP_ONGOING).fetchall()
+        jobids = set([ row[2] for row in downloads + demuxes + uploads ])
+        if not jobids:
+            return False
         try:
-            for row in self.execute("""SELECT a.Name, a.ParentRun, b.ExperimentName FROM Projects a, Runs b WHERE a.ParentRun = b.Id and a.Upload=?;""", OP_ONGOING).fetchall():
-                proj = row["Name"]
-                run = row["ExperimentName"]
-                statusFile = self.get("projectsPath") + "/" + run + "/" + proj + "/UPLOAD"
-                if os.path.isfile(statusFile):
-                    with open(statusFile, "r") as f:
-                        code = f.readline().strip()
-                    if code == "0":
-                        good = True
-                        self.log("Upload of project {}: SUCCESS", proj)
-                        self.execute("UPDATE Projects SET Upload=?, Uend=? WHERE Name=? AND ParentRun=?;", OP_COMPLETED, now(), proj, row["ParentRun"])
-                        self.setUploadStatus(row[1])
-                    else:
-                        self.log("Upload of project {}: FAILED", proj)
-                        self.execute("UPDATE Projects SET Upload=?, Uend=? WHERE Name=? AND ParentRun=?;", OP_FAILED, now(), proj, row["ParentRun"])
-                    self.setUploadStatus(row[1])
-        finally:
-            self.closedb()
+            states = self.jobStates(sorted(jobids))
+        except (OSError, subprocess.CalledProcessError) as e:
+            log("Error querying job states: {}", e)
+            return False
+        finished = False
+        actions = []            # Marker files are checked before taking the write lock
+        for (rows, check) in [(downloads, self.reconcileDownload),
+                              (demuxes, self.reconcileDemux),
+                              (uploads, self.reconcileUpload)]:
+            for row in rows:
+                state = states.get(row[2])
+                if state in FAILED_JOB_STATES:
+                    log("Job {} ended with state {}", row[2], state)
+                    actions.append(check(row))
+                elif state == "COMPLETED":
+                    finished = True
+        if actions:
+            with self.transaction(write=True):
+                for action in actions:
+                    action()
+        return finished
+
+    def reconcileDownload(self, row):
+        good = self.downloadMarker(row[1])
+        return lambda: self.finishDownload(row[0], row[1], good is True)
+
+    def reconcileDemux(self, row):
+        statusPath = self.get("projectsPath") + "/" + row[1] + "/STATUS"
+        if os.path.isfile(statusPath):
+            metrics = self.demuxMetrics(row[1])
+            return lambda: self.finishDemux(row[0], row[1], statusPath, metrics)
+        return lambda: self.failDemux(row[0], row[1])
+
+    def reconcileUpload(self, row):
+        code = self.uploadMarker(row[3], row[0])
+        return lambda: self.finishUpload(row[0], row[1], code == "0")
+
+    def markerPollDue(self):
+        """Should marker files be checked in this cycle? Always true if events are not enabled."""
+        if not self.get("eventsFile"):
+            return True
+        last = self.getSetting("LastMarkerPoll")
+        if last and (datetime.now() - datetime.fromisoformat(last)).total_seconds() < MARKER_POLL_INTERVAL:
+            return False
+        self.setSetting("LastMarkerPoll", now())
+        return True
 
     def updateAll(self):
+        """Sync runs from Basespace and perform all requested operations. The Basespace query
+runs in the background while local operations proceed, so a slow API does not hold up
+demux and upload jobs for runs we already have."""
         self.messages = []
-        self.loadAllRuns()
-        self.checkDownloads()
-        self.startDownloads()
-        self.checkDemux()
-        self.startDemux()
-        self.checkUpload()
-        self.startUpload()
+        since = self.syncStart()
+        with ThreadPoolExecutor(max_workers=1) as bs:
+            pending = bs.submit(self.fetchNewRuns, since)
+            self.updateLocal()
+            try:
+                self.storeRuns(pending.result())
+            except Exception as e:
+                log("Error loading runs from Basespace: {}", e)
         self.sendNotifications()
 
+    def updateLocal(self):
+        """The part of updateAll() that does not talk to Basespace: check for completed and
+failed jobs and start requested ones. All checks and submissions run in parallel, and their
+results are stored in a single transaction."""
+        self.processEvents()
+        finished = self.reconcileJobs()
+        poll = self.markerPollDue() or finished
+        tasks = []
+        if poll:
+            self.checkDownloads(tasks)
+            self.checkDemux(tasks)
+            self.checkUpload(tasks)
+        self.startDownloads(tasks)
+        self.startDemux(tasks)
+        self.startUpload(tasks)
+        self.runTasks(tasks)
+
+    def lock(self):
+        """Take an exclusive lock on the database for the update process, so that two
+updaters (e.g. cron and `rundb serve') never run at the same time. Returns False if the
+lock is held by another process. The lock is released when the process exits."""
+        self._lockfile = open(os.path.abspath(self.dbfile) + ".lock", "w")
+        try:
+            fcntl.flock(self._lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            self._lockfile.close()
+            self._lockfile = None
+            return False
+
+    def socketPath(self):
+        return self.get("controlSocket") or os.path.abspath(self.dbfile) + ".sock"
+
     def sendNotifications(self):
-        if self.messages:
+        if self.messages and self.get("SMTPserver"):
             S = SMTP(self.get("SMTPserver"))
             sender = self.get("emailSender")
             recipients = [r.strip() for r in self.get("emailRecipients").split(",")]
@@ -388,8 +1117,7 @@ To: {}
 
     def operations(self, args):
         run = args[0]
-        self.opendb()
-        try:
+        with self.transaction(write=True):
             runId = self.execute("SELECT Id FROM Runs WHERE ExperimentName=?", run).fetchone()
             if runId:
                 runId = runId[0]
@@ -426,56 +1154,137 @@ To: {}
                     if not self.execute("SELECT * FROM Operations WHERE Id=?", runId).fetchone():
                         self.execute("INSERT INTO Operations (Id, Download, Demux, Upload) VALUES (?, ?, ?, ?);", runId, OP_NOT_REQUESTED, OP_NOT_REQUESTED, OP_NOT_REQUESTED)
                     self.execute("UPDATE Operations SET {} WHERE Id=?".format(",".join(sets)), runId)
-                    self._conn.commit()
                     self.operations([run])
-        finally:
-            self.closedb()
 
 
     # Retrieval methods for run manager
 
-    def getAllRuns(self, n=-1):
+    def getAllRuns(self, n=-1, offset=0, name=None):
+        """Return runs as [Id, DateCreated, Status, ExperimentName, ops], most recent first, where
+ops is the string of Download, Demux and Upload codes. Returns at most `n' runs (all if -1)
+starting at `offset', optionally only those whose name contains `name'."""
         data = []
-        self.opendb()
-        try:
-            for row in self.execute("SELECT Id, ExperimentName, DateCreated, Status FROM Runs ORDER BY DateCreated desc LIMIT {};".format(n)):
-                runops = self.execute("SELECT * FROM Operations WHERE Id=?", row["Id"]).fetchone()
-                if runops:
-                    ops = runops["Download"] + runops["Demux"] + runops["Upload"]
-                else:
-                    ops = OP_NOT_REQUESTED*3
-                data.append([row["Id"], row["DateCreated"], row["Status"], row["ExperimentName"], ops])
-        finally:
-            self.closedb()
+        where, args = self.runNameFilter(name)
+        with self.transaction():
+            for row in self.execute("""SELECT r.Id, r.ExperimentName, r.DateCreated, r.Status,
+  COALESCE(o.Download, '{0}') AS Download, COALESCE(o.Demux, '{0}') AS Demux, COALESCE(o.Upload, '{0}') AS Upload
+FROM Runs r LEFT JOIN Operations o ON o.Id=r.Id {1}
+ORDER BY r.DateCreated DESC, r.Id DESC LIMIT ? OFFSET ?;""".format(OP_NOT_REQUESTED, where), *(args + [n, offset])):
+                data.append([row["Id"], row["DateCreated"], row["Status"], row["ExperimentName"],
+                             row["Download"] + row["Demux"] + row["Upload"]])
         return data
 
-    def getRun(self, runId):
-        result = {}
-        self.opendb()
-        try:
-            rundata = self.execute("SELECT * FROM Runs WHERE Id=?", runId).fetchone()
-            runops = self.execute("SELECT * FROM Operations WHERE Id=?", runId).fetchone()
-            for k in ["ExperimentName", "DateCreated", "Status", "Json", "Samplesheet"]:
+    def runNameFilter(self, name):
+        """Return WHERE clause and arguments to select runs whose name contains `name' (case-insensitive)."""
+        if not name:
+            return "", []
+        pattern = "%" + name.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        return "WHERE r.ExperimentName LIKE ? ESCAPE '\\'", [pattern]
+
+    # Full-text search
+
+    def ensureSearch(self):
+        """Make sure the RunSearch full-text index exists, building it if necessary. Returns
+False if this SQLite does not support FTS5 with the trigram tokenizer."""
+        if self._fts is not None:
+            return self._fts
+        with self.transaction(write=True):
+            found = self.execute("SELECT name FROM sqlite_master WHERE name='RunSearch';").fetchone()
+            if found:
+                self._fts = True
+            else:
+                try:
+                    self.execute("""CREATE VIRTUAL TABLE RunSearch USING fts5(
+  ExperimentName, FlowcellBarcode, InstrumentName, Projects, tokenize='trigram');""")
+                    self._fts = True
+                except sql.OperationalError:
+                    self._fts = False
+                if self._fts:
+                    self.indexRuns(self.getcolumn("SELECT Id FROM Runs;", []))
+        return self._fts
+
+    def indexRuns(self, runIds):
+        """(Re)build the search index entries for the runs in `runIds'."""
+        if not self.ensureSearch():
+            return
+        with self.transaction(write=True):
+            for runId in runIds:
+                row = self.execute("SELECT ExperimentName, FlowcellBarcode, InstrumentName FROM Runs WHERE Id=?;", runId).fetchone()
+                if not row:
+                    continue
+                projects = " ".join(self.getcolumn("SELECT DISTINCT Name FROM Projects WHERE ParentRun=?;", [runId]))
+                self.execute("DELETE FROM RunSearch WHERE rowid=?;", runId)
+                self.execute("INSERT INTO RunSearch (rowid, ExperimentName, FlowcellBarcode, InstrumentName, Projects) VALUES (?, ?, ?, ?, ?);",
+                             runId, row["ExperimentName"], row["FlowcellBarcode"] or "", row["InstrumentName"] or "", projects)
+
+    def reindexSearch(self):
+        """Drop and rebuild the search index."""
+        with self.transaction(write=True):
+            self.execute("DROP TABLE IF EXISTS RunSearch;")
+            self._fts = None
+            self.ensureSearch()
+
+    def searchFilter(self, query):
+        """Return FROM/WHERE clause, ORDER BY clause and arguments to find runs matching `query'
+in their name, flowcell, instrument or project names."""
+        if self.ensureSearch() and len(query) >= 3:
+            return ("FROM RunSearch s JOIN Runs r ON r.Id=s.rowid LEFT JOIN Operations o ON o.Id=r.Id WHERE RunSearch MATCH ?",
+                    "s.rank, r.DateCreated DESC", ['"' + query.replace('"', '""') + '"'])
+        # Without a usable index (or for very short queries) fall back to a scan
+        pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        return ("""FROM Runs r LEFT JOIN Operations o ON o.Id=r.Id
+WHERE r.ExperimentName LIKE ?1 ESCAPE '\\' OR r.FlowcellBarcode LIKE ?1 ESCAPE '\\' OR r.InstrumentName LIKE ?1 ESCAPE '\\'
+  OR EXISTS (SELECT 1 FROM Projects p WHERE p.ParentRun=r.Id AND p.Name LIKE ?1 ESCAPE '\\')""",
+                "(r.ExperimentName LIKE ?1 ESCAPE '\\') DESC, r.DateCreated DESC", [pattern])
+
+    def searchRuns(self, query, n=-1, offset=0):
+        """Return runs matching `query' (see searchFilter()), best matches first, in the same
+format as getAllRuns(). Returns at most `n' runs (all if -1) starting at `offset'."""
+        data = []
+        fromwhere, order, args = self.searchFilter(query)
+        with self.transaction():
+            for row in self.execute("""SELECT r.Id, r.ExperimentName, r.DateCreated, r.Status,
+  COALESCE(o.Download, '{0}') AS Download, COALESCE(o.Demux, '{0}') AS Demux, COALESCE(o.Upload, '{0}') AS Upload
+{1}
+ORDER BY {2} LIMIT ? OFFSET ?;""".format(OP_NOT_REQUESTED, fromwhere, order), *(args + [n, offset])):
+                data.append([row["Id"], row["DateCreated"], row["Status"], row["ExperimentName"],
+                             row["Download"] + row["Demux"] + row["Upload"]])
+        return data
+
+    def numberOfMatches(self, query):
+        """Return the number of runs matching `query'."""
+        fromwhere, order, args = self.searchFilter(query)
+        with self.transaction():
+            return self.execute("SELECT count(*) {};".format(fromwhere), *args).fetchone()[0]
+
+    def getRun(self, runId, full=False):
+        """Return a dictionary with the main columns of run `runId' (including RUN_FIELDS) and its
+operations. If `full' is True, also include the Basespace document, as Json and parsed as alldata."""
+        result = {"Id": runId}
+        columns = ["ExperimentName", "DateCreated", "Status", "Samplesheet"] + [ f[0] for f in RUN_FIELDS ]
+        if full:
+            columns.append("Json")
+        with self.transaction():
+            rundata = self.execute("SELECT {} FROM Runs WHERE Id=?".format(", ".join(columns)), runId).fetchone()
+            runops = self.execute("SELECT Download, Demux, Upload FROM Operations WHERE Id=?", runId).fetchone()
+            for k in columns:
                 result[k] = rundata[k]
             if runops:
                 for k in ["Download", "Demux", "Upload"]:
                     result[k] = runops[k]
+        if full:
             result["alldata"] = json.loads(result["Json"])
-        finally:
-            self.closedb()
         return result
 
-    def numberOfRuns(self):
-        self.opendb()
-        try:
-            n = self.execute("SELECT count(*) FROM Runs;").fetchone()[0]
-        finally:
-            self.closedb()
+    def numberOfRuns(self, name=None):
+        """Return the number of runs, optionally only those whose name contains `name'."""
+        where, args = self.runNameFilter(name)
+        with self.transaction():
+            n = self.execute("SELECT count(*) FROM Runs r {};".format(where), *args).fetchone()[0]
         return int(n)
 
     def toggleOperation(self, runId, operation):
-        self.opendb()
-        try:
+        with self.transaction(write=True):
             runops = self.execute("SELECT * FROM Operations WHERE Id=?", runId).fetchone()
             if runops:
                 op = runops[operation]
@@ -491,74 +1300,60 @@ To: {}
                     self.execute("UPDATE Operations SET {} WHERE Id=?".format(setter), runId)
             else:
                 self.execute("INSERT INTO Operations(Id, {}) VALUES(?, ?);".format(operation), runId, OP_REQUESTED)
-        finally:
-            self.closedb()
 
     def forceOperation(self, runId, operation, value):
-        self.opendb()
-        try:
+        with self.transaction(write=True):
             runops = self.execute("SELECT * FROM Operations WHERE Id=?", runId).fetchone()
             if runops:
                 setter = operation + "='{}'".format(value)
                 self.execute("UPDATE Operations SET {} WHERE Id=?".format(setter), runId)
             else:
                 self.execute("INSERT INTO Operations(Id, {}) VALUES(?, ?);".format(operation), runId, value)
-        finally:
-            self.closedb()
 
     def ongoingOperations(self):
-        results = []
-        self.opendb()
-        try:
-            for row in self.execute("""SELECT r.Id, r.ExperimentName, o.Download, o.Demux, o.Upload 
-FROM Operations o, Runs r 
-WHERE o.Id=r.Id and (o.Download=? or o.Download=? or o.Demux=? or o.Demux=? or o.Upload=? or o.Upload=?) 
-ORDER BY r.DateCreated DESC;""", OP_ONGOING, OP_REQUESTED, OP_ONGOING, OP_REQUESTED, OP_ONGOING, OP_REQUESTED).fetchall():
-                results.append(row)
-        finally:
-            self.closedb()
-        return results
+        return self.operationsIn(OP_ONGOING, OP_REQUESTED)
 
     def completedOperations(self):
+        return self.operationsIn(OP_COMPLETED, OP_FAILED)
+
+    def operationsIn(self, code1, code2):
+        """Return the operations of runs that have at least one operation with status `code1' or
+`code2', with their start and end times. The times for Upload are those of the earliest
+started and latest finished project."""
         results = []
-        self.opendb()
-        try:
-            for row in self.execute("""SELECT r.Id, r.ExperimentName, o.Download, o.Demux, o.Upload 
+        with self.transaction():
+            for row in self.execute("""SELECT r.Id, r.ExperimentName, o.Download, o.Demux, o.Upload, o.Dstart, o.Dend, o.Xstart, o.Xend,
+  (SELECT min(p.Ustart) FROM Projects p WHERE p.ParentRun=r.Id AND p.Upload=o.Upload) AS Ustart,
+  (SELECT max(p.Uend) FROM Projects p WHERE p.ParentRun=r.Id AND p.Upload=o.Upload) AS Uend
 FROM Operations o, Runs r 
 WHERE o.Id=r.Id and (o.Download=? or o.Download=? or o.Demux=? or o.Demux=? or o.Upload=? or o.Upload=?) 
-ORDER BY r.DateCreated DESC;""", OP_COMPLETED, OP_FAILED, OP_COMPLETED, OP_FAILED, OP_COMPLETED, OP_FAILED).fetchall():
+ORDER BY r.DateCreated DESC;""", code1, code2, code1, code2, code1, code2).fetchall():
                 results.append(row)
-        finally:
-            self.closedb()
         return results
 
+    def dataVersion(self):
+        """Return a number that changes whenever another process commits changes to the
+database (SQLite's data_version), to find out cheaply if data should be reloaded."""
+        with self.transaction():
+            return self.execute("PRAGMA data_version;").fetchone()[0]
+
     def runHasProjects(self, runId):
         """Return True if this run has at least one demultiplexed project."""
-        self.opendb()
-        try:
+        with self.transaction():
             return self.execute("""SELECT * FROM Projects WHERE ParentRun=?;""", runId).fetchone()
-        finally:
-            self.closedb()
 
     def runIsDownloaded(self, runId):
-        self.opendb()
-        try:
+        with self.transaction():
             return self.execute("""SELECT * FROM Operations WHERE Id=? and Download=?;""", runId, OP_COMPLETED).fetchone()
-        finally:
-            self.closedb()
 
     def getRunProjects(self, runId):
-        self.opendb()
-        try:
+        with self.transaction():
             return self.execute("""SELECT * FROM Projects WHERE ParentRun=? AND status='Y';""", runId).fetchall()
-        finally:
-            self.closedb()
 
     def setUploadStatus(self, runId):
         """Call this after updating the Upload status a project to update the Upload status
 of its parent run."""
-        self.opendb()
-        try:
+        with self.transaction(write=True):
             upstatuses = []
             for row in self.execute("""SELECT Upload FROM Projects WHERE ParentRun=?;""", runId).fetchall():
                 upstatuses.append(row[0])
@@ -570,8 +1365,6 @@ of its parent run."""
             elif OP_COMPLETED in upstatuses:
                 st = OP_COMPLETED
             self.execute("""UPDATE Operations SET Upload=? WHERE Id=?;""", st, runId)
-        finally:
-            self.closedb()
 
     def getDemuxStatus(self, runId, expName, projects):
         result = {}
@@ -582,8 +1375,7 @@ of its parent run."""
         return result
             
     def toggleProj(self, runId, project):
-        self.opendb()
-        try:
+        with self.transaction(write=True):
             setter = None
             if project["Upload"] in [OP_NOT_REQUESTED, OP_FAILED]:
                 setter = "Upload='{}'".format(OP_REQUESTED)
@@ -592,11 +1384,148 @@ of its parent run."""
             if setter:
                 self.execute("""UPDATE Projects SET {} WHERE Name=? AND ParentRun=?;""".format(setter), project["Name"], project["ParentRun"])
                 self.setUploadStatus(runId)
+
+class Scheduler(object):
+    """Long-running replacement for calling `rundb update' from cron. Each stage of the
+update runs at its own interval: local completion checks and job submissions every few
+seconds, the Basespace sync every few minutes. Stages run one at a time in a single
+thread, so they can never overlap; only the Basespace query itself runs in a background
+worker (as in updateAll), so a slow or hung API call does not hold up local checks. The
+runs it returns are stored by the main thread. The scheduler listens on a Unix socket for
+one-line commands: `refresh' (run all stages now), `sync' (run the Basespace sync now) and
+`status'."""
+    db = None
+    stages = []                 # [name, interval, function, next run time]
+    server = None
+    worker = None               # Runs the Basespace query
+    pending = None              # Future of the Basespace query in progress
+
+    def __init__(self, db):
+        self.db = db
+        poll = float(db.get("pollInterval") or POLL_INTERVAL)
+        sync = float(db.get("syncInterval") or SYNC_INTERVAL)
+        self.stages = [["sync", sync, self.startSync, 0],
+                       ["local", poll, db.updateLocal, 0]]
+        self.worker = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def startSync(self):
+        """Start fetching new runs from Basespace in the background, unless the previous
+fetch is still running."""
+        if self.pending is None:
+            self.pending = self.worker.submit(self.db.fetchNewRuns, self.db.syncStart())
+        else:
+            log("Basespace sync still in progress, skipping.")
+
+    def finishSync(self):
+        """Store the runs fetched by startSync(), if the fetch has completed."""
+        if self.pending is not None and self.pending.done():
+            pending = self.pending
+            self.pending = None
+            try:
+                self.db.storeRuns(pending.result())
+            except Exception as e:
+                log("Error loading runs from Basespace: {}", e)
+
+    def listen(self):
+        path = self.db.socketPath()
+        if os.path.exists(path):
+            os.remove(path)     # Stale socket, we hold the lock
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(5)
+
+    def runDue(self):
+        """Run all stages that are due, then send notifications for what happened."""
+        self.db.messages = []
+        self.finishSync()
+        for stage in self.stages:
+            if stage[3] <= time.time():
+                try:
+                    stage[2]()
+                except Exception as e:
+                    log("Error in stage {}: {}", stage[0], e)
+                stage[3] = time.time() + stage[1]
+        try:
+            self.db.sendNotifications()
+        except Exception as e:
+            log("Error sending notifications: {}", e)
+
+    def command(self, cmd):
+        if cmd == "refresh":
+            for stage in self.stages:
+                stage[3] = 0
+            return "ok"
+        elif cmd == "sync":
+            self.stages[0][3] = 0
+            return "ok"
+        elif cmd == "status":
+            return " ".join(["{}={:.0f}s".format(st[0], max(0, st[3] - time.time())) for st in self.stages] +
+                            (["sync=running"] if self.pending else []))
+        else:
+            return "unknown command"
+
+    def handleClient(self):
+        conn, addr = self.server.accept()
+        try:
+            conn.settimeout(5)
+            cmd = conn.recv(1024).decode().strip()
+            conn.sendall((self.command(cmd) + "\n").encode())
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def run(self):
+        # Exit through the finally clause below on SIGTERM, so the socket is removed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self.listen()
+        log("Scheduler started, listening on {}", self.db.socketPath())
+        try:
+            while True:
+                self.runDue()
+                wait = max(0, min([ st[3] for st in self.stages ]) - time.time())
+                if self.pending:
+                    wait = min(wait, SYNC_CHECK_INTERVAL)
+                ready, w, x = select.select([self.server], [], [], wait)
+                if ready:
+                    self.handleClient()
         finally:
-            self.closedb()
+            self.worker.shutdown(wait=False)
+            self.server.close()
+            if os.path.exists(self.db.socketPath()):
+                os.remove(self.db.socketPath())
+
+def sendCommand(path, cmd, timeout=5):
+    """Send `cmd' to the scheduler listening on socket `path'. Returns its reply, or None
+if the scheduler is not running."""
+    try:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(timeout)
+        s.connect(path)
+        try:
+            s.sendall((cmd + "\n").encode())
+            return s.recv(1024).decode().strip()
+        finally:
+            s.close()
+    except OSError:
+        return None
 
 def usage():
-    sys.stdout.write("""Usage: rundb [-c configfile] {init,load,update,oper}
+    sys.stdout.write("""Usage: rundb [-c configfile] {init,migrate,explain,load,sync,update,serve,ctl,oper,search,reindex,ingest,trends}
+
+  init    - create an empty database (removes all existing data!)
+  migrate - bring the database schema up to date
+  explain - show query plans of frequent queries, flagging full table scans
+  load    - load all runs from Basespace
+  sync    - load new runs and runs still in progress from Basespace
+  update  - sync runs and perform all requested operations
+  serve   - keep running, performing the update steps at regular intervals
+  ctl C   - send command C (refresh, sync, status) to the running `serve' process
+  search  - search runs by name, flowcell, instrument or project
+  reindex - rebuild the search index
+  ingest  - load the demux metrics of the given runs (default: all demultiplexed runs)
+  trends  - show lane yield and undetermined reads of recent runs ([lanes] [N], default 50 runs)
 """)
 
 def main(args):
@@ -605,18 +1534,50 @@ def main(args):
         return usage()
     if args[0] == "-c":
       configfile_path = args[1]
-      cmd = args[2]
-    else:
-      cmd = args[0]
-    DB = RunDB(configfile=configfile_path)
+      args = args[2:]
+    cmd = args[0]
+    DB = RunDB(configfile=configfile_path, persistent=True)
     if cmd == "init":
         DB.initialize()
+        return
+    DB.migrate()
+    if cmd == "migrate":
+        sys.stdout.write("Schema version: {}\n".format(DB.schemaVersion()))
+    elif cmd == "explain":
+        if DB.explainQueries():
+            sys.exit(1)
     elif cmd == "load":
         DB.loadAllRuns()
+    elif cmd == "sync":
+        DB.loadNewRuns()
     elif cmd == "update":
-        DB.updateAll()
+        if DB.lock():
+            DB.updateAll()
+        else:
+            log("Another update is in progress, exiting.")
+    elif cmd == "serve":
+        if DB.lock():
+            Scheduler(DB).run()
+        else:
+            log("Another update process is running, exiting.")
+            sys.exit(1)
+    elif cmd == "ctl":
+        reply = sendCommand(DB.socketPath(), args[1] if len(args) > 1 else "status")
+        if reply is None:
+            sys.stderr.write("Scheduler is not running.\n")
+            sys.exit(1)
+        sys.stdout.write(reply + "\n")
     elif cmd == "oper":
         DB.operations(args[1:])
+    elif cmd == "search":
+        for run in DB.searchRuns(" ".join(args[1:]), n=50):
+            sys.stdout.write("{}\t{}\t{}\t{}\n".format(run[3], run[1][:10], run[2], run[4]))
+    elif cmd == "reindex":
+        DB.reindexSearch()
+    elif cmd == "ingest":
+        DB.ingestDemux(args[1:])
+    elif cmd == "trends":
+        DB.showTrends(args[1:])
     else:
         usage()
 
@@ -1,23 +1,31 @@
 #!/usr/bin/env python
 
+import os
 import sys
 import curses
 import curses.panel
+import hashlib
+import threading
+from datetime import datetime
 from curses.textpad import rectangle, Textbox
-from os.path import isfile, split
+from os.path import split
 from glob import glob
+from collections import OrderedDict
 import subprocess as sp
 
 import rundb
 import SampleSheet
 
 USENANO = True
+SSCACHESIZE = 20                # Number of parsed sample sheets kept in memory
+SPINNER = "|/-\\"
+RUNPAGES = 8                    # Pages of runs kept in memory by a RunList
+DASHREFRESH = 2                 # Seconds between checks for changes in the operations dashboard
 
 # Utils
 
 def runConfiguration(rundata):
-    ss = rundata["SequencingStats"]
-    return "{}+{}+{}+{}".format(ss["NumCyclesRead1"], ss["NumCyclesIndex1"], ss["NumCyclesIndex2"], ss["NumCyclesRead2"])
+    return "{}+{}+{}+{}".format(rundata["NumCyclesRead1"], rundata["NumCyclesIndex1"], rundata["NumCyclesIndex2"], rundata["NumCyclesRead2"])
 
 def decodeOp(rundata, key):
     if key in rundata:
@@ -50,22 +58,150 @@ def formatOpsList(opslist, completed=False):
         wanted = "YU"
     for op in opslist:
         if op["Download"] in wanted:
-            result.append([op["Id"], "Download", op["Download"], op["ExperimentName"]])
+            result.append([op["Id"], "Download", op["Download"], op["ExperimentName"], op["Dstart"], op["Dend"]])
         if op["Demux"] in wanted:
-            result.append([op["Id"], "Demux", op["Demux"], op["ExperimentName"]])
+            result.append([op["Id"], "Demux", op["Demux"], op["ExperimentName"], op["Xstart"], op["Xend"]])
         if op["Upload"] in wanted:
-            result.append([op["Id"], "Upload", op["Upload"], op["ExperimentName"]])
+            result.append([op["Id"], "Upload", op["Upload"], op["ExperimentName"], op["Ustart"], op["Uend"]])
     return result
 
-def loadSampleSheet(pathname):
-    if isfile(pathname):
+def formatElapsed(start, end=None):
+    """Return the time from `start' to `end' (or to now) as [Nd ]HH:MM:SS, or an empty string
+if `start' is not known."""
+    if not start:
+        return ""
+    try:
+        t0 = datetime.fromisoformat(start)
+        t1 = datetime.fromisoformat(end) if end else datetime.now()
+    except ValueError:
+        return ""
+    secs = max(0, int((t1 - t0).total_seconds()))
+    days, secs = divmod(secs, 86400)
+    hms = "{:02}:{:02}:{:02}".format(secs // 3600, (secs // 60) % 60, secs % 60)
+    return "{}d {}".format(days, hms) if days else hms
+
+class SampleSheetCache(object):
+    """Parsed sample sheets, by path. A sheet is only parsed again if its modification time
+or size changed; when more than `size' sheets are stored, the least recently used ones are
+dropped."""
+    size = SSCACHESIZE
+    sheets = None               # path -> ((mtime, size), SSParser or None)
+
+    def __init__(self, size=SSCACHESIZE):
+        self.size = size
+        self.sheets = OrderedDict()
+
+    def get(self, pathname):
+        try:
+            st = os.stat(pathname)
+        except OSError:
+            self.sheets.pop(pathname, None)
+            return None
+        stamp = (st.st_mtime_ns, st.st_size)
+        entry = self.sheets.get(pathname)
+        if entry and entry[0] == stamp:
+            self.sheets.move_to_end(pathname)
+            return entry[1]
         ss = SampleSheet.SSParser()
-        if ss.parse(pathname):
-            return ss
+        if not ss.parse(pathname):
+            ss = None
+        self.sheets[pathname] = (stamp, ss)
+        self.sheets.move_to_end(pathname)
+        while len(self.sheets) > self.size:
+            self.sheets.popitem(last=False)
+        return ss
+
+SHEETS = SampleSheetCache()
+
+def loadSampleSheet(pathname):
+    return SHEETS.get(pathname)
+
+class SampleSheetCheck(object):
+    """Verification of a sample sheet, running in a background thread. The warnings for
+each lane are added to `warnings' as soon as the lane has been checked, and `done' is set
+when all lanes are finished."""
+    warnings = []
+    nlanes = 0
+    lanesdone = 0
+    done = False
+
+    def __init__(self, ss):
+        self.ss = ss
+        self.warnings = []
+        self.nlanes = len(ss.laneprojects)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            for lane in list(self.ss.laneprojects):
+                self.warnings = self.warnings + self.ss.verifyLane(lane)
+                self.lanesdone += 1
+        except Exception as e:
+            self.warnings = self.warnings + ["Error verifying sample sheet: {}".format(e)]
+        finally:
+            self.done = True
+
+# Sample sheet checks (finished or still running), by hash of the sample sheet contents
+CHECKS = OrderedDict()
+
+def checkSampleSheet(pathname, ss):
+    """Return the SampleSheetCheck for the sample sheet `ss' read from `pathname', starting
+it unless the same contents have been checked before."""
+    with open(pathname, "rb") as f:
+        key = hashlib.sha1(f.read()).hexdigest()
+    if key not in CHECKS:
+        CHECKS[key] = SampleSheetCheck(ss)
+        while len(CHECKS) > SSCACHESIZE:
+            CHECKS.popitem(last=False)
+    CHECKS.move_to_end(key)
+    return CHECKS[key]
+
+class RunList(object):
+    """The list of all runs, or of those matching a search query, most recent (or best
+matching) first. Runs are fetched from the database one page at a time when they are first
+needed, and only the most recently used pages are kept."""
+    db = None
+    query = None
+    pagesize = 10
+    size = 0
+    pages = None                # page number -> list of runs, as returned by getAllRuns()
+
+    def __init__(self, db, query=None, limit=None, pagesize=10):
+        self.db = db
+        self.query = query
+        self.pagesize = pagesize
+        self.size = db.numberOfMatches(query) if query else db.numberOfRuns()
+        if limit is not None:
+            self.size = min(self.size, limit)
+        self.pages = OrderedDict()
+
+    def __len__(self):
+        return self.size
+
+    def page(self, p):
+        if p in self.pages:
+            self.pages.move_to_end(p)
         else:
+            if self.query:
+                self.pages[p] = self.db.searchRuns(self.query, n=self.pagesize, offset=p * self.pagesize)
+            else:
+                self.pages[p] = self.db.getAllRuns(n=self.pagesize, offset=p * self.pagesize)
+            while len(self.pages) > RUNPAGES:
+                self.pages.popitem(last=False)
+        return self.pages[p]
+
+    def get(self, i):
+        """Return run number `i', or None if there is no such run."""
+        if i < 0 or i >= self.size:
             return None
-    else:
-        return None
+        rows = self.page(i // self.pagesize)
+        i = i % self.pagesize
+        return rows[i] if i < len(rows) else None
+
+    def invalidate(self):
+        """Forget all pages, so that runs are fetched again (e.g. after changing operations)."""
+        self.pages.clear()
 
 def maketextbox(screen, h, w, y, x, textColorpair=0, decoColorpair=0):
     nw = curses.newwin(h, w, y, x)
@@ -121,7 +257,7 @@ class Manager(object):
         curses.init_pair(5, curses.COLOR_CYAN, curses.COLOR_BLACK)
         self.w.bkgd(' ', curses.color_pair(1))
         self.initialize()
-        self.db = rundb.RunDB(configfile="/orange/icbrngs/bin/runmgr/config.sh")
+        self.db = rundb.RunDB(configfile="/orange/icbrngs/bin/runmgr/config.sh", persistent=True)
 
     def initialize(self):
         rows, cols = self.w.getmaxyx()
@@ -192,6 +328,25 @@ class Manager(object):
         self.setMenu(None)
         return c
 
+    def getch(self, timeout=None):
+        """Like getkey(), but returns a key code, or -1 if no key was pressed in time."""
+        self.w.timeout(-1 if timeout is None else int(timeout * 1000))
+        try:
+            return self.w.getch()
+        finally:
+            self.w.timeout(-1)
+
+    def getkey(self, timeout=None):
+        """Wait for a key, but for at most `timeout' seconds if specified. Returns None if no
+key was pressed in time."""
+        self.w.timeout(-1 if timeout is None else int(timeout * 1000))
+        try:
+            return self.w.getkey()
+        except curses.error:
+            return None
+        finally:
+            self.w.timeout(-1)
+
     def dispatch(self, key, commands):
         if key in commands:
             func = commands[key]
@@ -206,7 +361,7 @@ class Manager(object):
 
  Press (r) to view the 10 most recent runs
        (a) to view all runs
-       (s) to search for runs by name
+       (s) to search for runs by name, flowcell, instrument or project
        (o) to view ongoing / requested operations
        (c) to view completed operations
        (u) to update the database with new runs
@@ -236,38 +391,7 @@ class Manager(object):
                                   'u': self.updateRuns})
 
     def viewRecentRuns(self):
-        selected = 0
-        while True:
-            runs = self.db.getAllRuns(n=10)
-            self.mainw.clear()
-            self.mainw.addstr(1, 1, """Press a number key to select a run:
-
-    Date         Status           DXU   Name
-    ----------   ---------        ---   -----------------""")
-            for i in range(10):
-                run = runs[i]
-                self.mainw.addstr(5+i, 1, """{}] {}   {:15}  """.format(i, run[1][:10], run[2]))
-                for z in range(3):
-                    self.writeRunOp(run[4][z])
-                self.mainw.addstr(5+i, 39, run[3], curses.A_REVERSE if selected == i else curses.A_BOLD)
-            self.runOpsLegend()
-            self.setMenu([("0..9", "select run"),
-                          ("q", "back")])
-            self.mainw.refresh()
-            k = self.w.getkey()
-            if k == 'q':
-                return
-            elif k == "KEY_UP" and selected > 0:
-                selected += -1
-            elif k == "KEY_DOWN" and selected < 9:
-                selected += 1
-            elif k == "\n":
-                self.viewRun(runs[selected][0])
-            elif k in "0123456789":
-                idx = int(k)
-                self.viewRun(runs[idx][0])
-            else:
-                badkey()
+        self.viewRunList(limit=10)
 
     def writeRunOp(self, op):
         self.mainw.addstr(op, curses.color_pair(OPCOLORS[op]) | curses.A_BOLD)
@@ -294,61 +418,59 @@ class Manager(object):
         self.mainw.addstr(": failed, ")
 
     def viewAllRuns(self):
-        runs = self.db.getAllRuns()
-        self.viewRunList(runs)
+        self.viewRunList()
 
     def searchRuns(self):
         query = self.getString("Search for: ")
         if not query:
             return
-        query = query.decode().upper()
-        runs = self.db.getAllRuns()
-        wanted = []
-        for r in runs:
-            if query in r[3].upper():
-                wanted.append(r)
-        if wanted:
-            self.viewRunList(wanted)
-
-    def viewRunList(self, runs):
-        start = 0
-        selected = 0
+        query = query.decode().strip()
+        if query and self.db.numberOfMatches(query):
+            self.viewRunList(query=query)
+
+    def viewRunList(self, query=None, limit=None):
+        """Browse all runs (at most `limit' if specified), or those matching search `query'.
+Runs are fetched a page at a time through a RunList, and only the lines of the list that
+changed are redrawn."""
+        runs = RunList(self.db, query=query, limit=limit)
         nruns = len(runs)
+        selected = 0
+        drawn = None            # Contents of each line of the list, or None to redraw everything
         while True:
-            self.mainw.clear()
-            self.mainw.addstr(1, 1, """Press a number key to select a run:
-
-    Date         Status           DXU   Name
-    ----------   ---------        ---   -----------------""")
-            keys = []
             if selected < 5:
                 start = 0
             elif (nruns - selected) < 5:
-                start = nruns - 10
+                start = max(0, nruns - 10)
             else:
                 start = selected - 5
+            if drawn is None:
+                self.mainw.erase()
+                self.mainw.addstr(1, 1, """Press a number key to select a run:
 
+    Date         Status           DXU   Name
+    ----------   ---------        ---   -----------------""")
+                self.runOpsLegend()
+                self.setMenu([("0..{}".format(max(0, min(10, nruns) - 1)), "select run"),
+                              ("n", "next page"),
+                              ("p", "previous page"),
+                              ("t", "top"),
+                              ("b", "bottom"),
+                              ("q", "back")])
+                drawn = [None] * 10
+            keys = []
             for i in range(10):
-                idx = start + i
-                if idx < nruns:
-                    run = runs[idx]
-                    self.mainw.addstr(5+i, 1, """{}] {}   {:15}  """.format(i, run[1][:10], run[2]))
-                    for z in range(3):
-                        self.writeRunOp(run[4][z])
-                    self.mainw.addstr(5+i, 40, run[3], curses.A_REVERSE if selected == start+i else curses.A_BOLD)
+                run = runs.get(start+i)
+                line = (run, selected == start+i)
+                if line != drawn[i]:
+                    self.drawRunLine(5+i, i, run, selected == start+i)
+                    drawn[i] = line
+                if run:
                     keys.append(str(i))
-                else:
-                    i += 1
-                    break
-            self.mainw.addstr(17, 1, "Runs: {}-{} / {}".format(start+1, start+10, nruns))
-            self.runOpsLegend()
-            self.setMenu([("0..{}".format(i), "select run"),
-                          ("n", "next page"),
-                          ("p", "previous page"),
-                          ("t", "top"),
-                          ("b", "bottom"),
-                          ("q", "back")])
-            self.mainw.refresh()
+            self.mainw.move(17, 1)
+            self.mainw.clrtoeol()
+            self.mainw.addstr(17, 1, "Runs: {}-{} / {}".format(min(start+1, nruns), min(start+10, nruns), nruns))
+            self.mainw.noutrefresh()
+            curses.doupdate()
             k = self.w.getkey()
             if k == 'q':
                 return
@@ -365,52 +487,74 @@ class Manager(object):
             elif k == 't':
                 selected = 0
             elif k == 'b':
-                selected = nruns - 1
-            elif k == '\n':
-                self.viewRun(runs[selected][0])
-            elif k in keys:
-                idx = start + int(k)
-                self.viewRun(runs[idx][0])
+                selected = max(0, nruns - 1)
+            elif (k == '\n' and nruns) or k in keys:
+                run = runs.get(selected if k == '\n' else start + int(k))
+                self.viewRun(run[0])
+                runs.invalidate()
+                drawn = None
             else:
                 badkey()
 
+    def drawRunLine(self, row, i, run, selected):
+        """Draw `run' (or nothing, if None) as line `i' of a run list, at `row'."""
+        self.mainw.move(row, 1)
+        self.mainw.clrtoeol()
+        if run:
+            self.mainw.addstr(row, 1, """{}] {}   {:15}  """.format(i, run[1][:10], run[2]))
+            for z in range(3):
+                self.writeRunOp(run[4][z])
+            self.mainw.addstr(row, 40, run[3], curses.A_REVERSE if selected else curses.A_BOLD)
+
     def showOngoing(self):
-        operations = formatOpsList(self.db.ongoingOperations())
-        self.showOperations(operations)
+        self.showOperations(self.db.ongoingOperations)
 
     def showCompleted(self):
-        operations = formatOpsList(self.db.completedOperations(), completed=True)
-        self.showOperations(operations)
+        self.showOperations(self.db.completedOperations, completed=True)
 
-    def showOperations(self, operations):
+    def showOperations(self, getOperations, completed=False):
+        """Live view of the operations returned by `getOperations'. The screen is updated every
+few seconds, but the operations are only loaded again if the database has changed. Shows how
+long ongoing operations have been running, or how long completed ones took."""
         start = 0
-        nops = len(operations)
+        operations = None
+        version = None
         while True:
-            self.mainw.clear()
+            v = self.db.dataVersion()
+            if operations is None or v != version:
+                version = v
+                operations = formatOpsList(getOperations(), completed=completed)
+                nops = len(operations)
+                start = min(start, max(0, nops - 1))
+                self.setMenu([("0..{}".format(max(0, min(10, nops) - 1)), "select run"),
+                              ("n", "next page"),
+                              ("p", "previous page"),
+                              ("t", "top"),
+                              ("b", "bottom"),
+                              ("q", "back")])
+            self.mainw.erase()
             self.mainw.addstr(1, 1, """Press a number key to select a run:
 
-    Operation   Status      Name
-    ---------   ---------   ---------""")
+    Operation   Status      {:11}   Name
+    ---------   ---------   -----------   ---------""".format("Duration" if completed else "Elapsed"))
             keys = []
             for i in range(10):
                 idx = start + i
                 if idx < nops:
-                    self.mainw.addstr(5+i, 1, """{}] {:9}   """.format(i, operations[idx][1]))
-                    self.mainw.addstr("{:9}".format(rundb.writeOper(operations[idx][2])), curses.color_pair(OPCOLORS[operations[idx][2]]))
-                    self.mainw.addstr("   " + operations[idx][3])
+                    op = operations[idx]
+                    self.mainw.addstr(5+i, 1, """{}] {:9}   """.format(i, op[1]))
+                    self.mainw.addstr("{:9}".format(rundb.writeOper(op[2])), curses.color_pair(OPCOLORS[op[2]]))
+                    self.mainw.addstr("   {:>11}".format(formatElapsed(op[4], op[5] if completed else None) if op[2] != rundb.OP_REQUESTED else ""))
+                    self.mainw.addstr("   " + op[3])
                     keys.append(ord(str(i)))
                 else:
                     break
-            self.mainw.addstr(17, 1, "{}-{} / {}".format(start+1, start+10, nops))
-            self.setMenu([("0..{}".format(i-1), "select run"),
-                          ("n", "next page"),
-                          ("p", "previous page"),
-                          ("t", "top"),
-                          ("b", "bottom"),
-                          ("q", "back")])
+            self.mainw.addstr(17, 1, "{}-{} / {}".format(min(start+1, nops), min(start+10, nops), nops))
             self.mainw.refresh()
-            k = self.w.getch()
-            if k == ord('q'):
+            k = self.getch(DASHREFRESH)
+            if k == -1:
+                continue
+            elif k == ord('q'):
                 return
             elif k == ord('n') or k == curses.KEY_RIGHT:
                 if start + 10 < nops:
@@ -429,6 +573,7 @@ class Manager(object):
             elif k in keys:
                 idx = start + int(k) - ord('0')
                 self.viewRun(operations[idx][0])
+                operations = None       # Our own changes don't affect dataVersion()
             else:
                 badkey()
 
@@ -436,8 +581,12 @@ class Manager(object):
         self.mainw.clear()
         self.mainw.addstr(1, 1, """Updating runs - please wait...""")
         self.mainw.refresh()
-        self.db.loadAllRuns()
-        self.mainw.addstr(3, 1, """Runs db updated. Total runs: {}""".format(self.db.numberOfRuns()))
+        # If `rundb serve' is running, ask it to refresh instead of loading all runs here
+        if rundb.sendCommand(self.db.socketPath(), "refresh") is None:
+            self.db.loadAllRuns()
+            self.mainw.addstr(3, 1, """Runs db updated. Total runs: {}""".format(self.db.numberOfRuns()))
+        else:
+            self.mainw.addstr(3, 1, """Refresh requested from the run manager service.""")
         self.mainw.refresh()
         curses.beep()
         self.setMenu1("Press any key...")
@@ -454,16 +603,19 @@ class Manager(object):
         return row
 
     def viewRun(self, runId):
+        reload = True
         while True:
-            rundata = self.db.getRun(runId)
-            alldata = rundata["alldata"]
-            stats = alldata["SequencingStats"]
-            ssname = rundata["Samplesheet"]
-            if ssname:
-                sspath = self.db.get("runDirectory") + "/" + rundata["ExperimentName"] + "/" + rundata["Samplesheet"]
-                ss = loadSampleSheet(sspath)
-            else:
-                ss = None
+            # Only go back to the database and the sample sheet after a command that may
+            # have changed them, not on every keypress
+            if reload:
+                rundata = self.db.getRun(runId)
+                ssname = rundata["Samplesheet"]
+                if ssname:
+                    sspath = self.db.get("runDirectory") + "/" + rundata["ExperimentName"] + "/" + rundata["Samplesheet"]
+                    ss = loadSampleSheet(sspath)
+                else:
+                    ss = None
+                reload = False
             self.mainw.clear()
             self.mainw.addstr(1, 1, """Run:
  Flowcell:
@@ -479,10 +631,10 @@ class Manager(object):
  Upload:
 """)
             self.mainw.addstr(1, 16, rundata["ExperimentName"], curses.A_BOLD)
-            self.mainw.addstr(2, 16, alldata["FlowcellBarcode"], curses.A_BOLD)
-            self.mainw.addstr(3, 16, str(stats["NumLanes"]), curses.A_BOLD)
-            self.mainw.addstr(4, 16, "{} ({})".format(alldata["InstrumentName"], alldata["InstrumentType"]), curses.A_BOLD)
-            self.mainw.addstr(5, 16, runConfiguration(alldata), curses.A_BOLD)
+            self.mainw.addstr(2, 16, rundata["FlowcellBarcode"], curses.A_BOLD)
+            self.mainw.addstr(3, 16, str(rundata["NumLanes"]), curses.A_BOLD)
+            self.mainw.addstr(4, 16, "{} ({})".format(rundata["InstrumentName"], rundata["InstrumentType"]), curses.A_BOLD)
+            self.mainw.addstr(5, 16, runConfiguration(rundata), curses.A_BOLD)
             self.mainw.addstr(7, 16, rundata["DateCreated"].replace("T", " "), curses.A_BOLD)
             self.mainw.addstr(8, 16, rundata["Status"], curses.A_BOLD)
             
@@ -508,8 +660,11 @@ class Manager(object):
             self.mainw.refresh()
 
             k = self.w.getkey()
+            reload = True
             if k == 'q':
                 return
+            elif k == 'r':
+                pass
             elif k == 'd':
                 self.db.toggleOperation(runId, "Download")
             elif k == 'D':
@@ -523,8 +678,9 @@ class Manager(object):
             elif k == 'p' and self.db.hasSampleSheet(runId):
                 self.runProjects(runId)
             elif k == 's': # and self.db.runIsDownloaded(runId):
-                self.chooseSampleSheet(runId, alldata["FlowcellBarcode"])
+                self.chooseSampleSheet(runId, rundata["FlowcellBarcode"])
             else:
+                reload = False
                 badkey()
 
     def findSampleSheet(self, flowcell):
@@ -540,9 +696,17 @@ class Manager(object):
 
     def chooseSampleSheet(self, runId, flowcell):
         rundata = self.db.getRun(runId)
+        reload = True
+        spin = 0
         while True:
-            sspath = self.findSampleSheet(flowcell)
-            self.mainw.clear()
+            # The sample sheet is verified in the background: redraw periodically to show
+            # the warnings found so far, and accept keys before verification is finished
+            if reload:
+                sspath = self.findSampleSheet(flowcell)
+                ss = loadSampleSheet(sspath) if sspath else None
+                check = checkSampleSheet(sspath, ss) if ss else None
+                reload = False
+            self.mainw.erase()
             self.mainw.addstr(1, 1, """Run:
 
  Sample sheet:""")
@@ -550,12 +714,16 @@ class Manager(object):
 
             good = False
             if sspath:
-                ss = loadSampleSheet(sspath)
                 if ss:
                     ssname = split(sspath)[1]
                     self.mainw.addstr(3, 16, ssname, curses.A_BOLD)
                     lastrow = self.viewSampleSheetProjects(ss, 5) + 1
-                    warnings = ss.verify()
+                    warnings = check.warnings
+                    if not check.done:
+                        spin = (spin + 1) % len(SPINNER)
+                        self.mainw.addstr(lastrow, 1, "{} Verifying sample sheet: {}/{} lanes checked".format(
+                            SPINNER[spin], check.lanesdone, check.nlanes), curses.color_pair(2))
+                        lastrow += 2
                     if warnings:
                         self.mainw.addstr(lastrow, 1, "Warnings:")
                         lastrow += 1
@@ -573,11 +741,14 @@ class Manager(object):
                 self.setMenu([("p", "paste sample sheet"), ("q", "back")])
             self.mainw.refresh()
 
-            k = self.w.getkey()
-            if k == 'q':
+            k = self.getkey(0.2 if check and not check.done else None)
+            if k is None:
+                continue
+            elif k == 'q':
                 return
             elif k == 'p':
                 self.enterSampleSheet(rundata['ExperimentName'], flowcell)
+                reload = True
             elif k == 'Y' and good:
                 self.db.setSampleSheet(runId, ssname)
                 return
@@ -596,8 +767,6 @@ class Manager(object):
     def runProjects(self, runId):
         idx = 0
         rundata = self.db.getRun(runId)
-        alldata = rundata["alldata"]
-        stats = alldata["SequencingStats"]
         projects = self.db.getRunProjects(runId)
         demuxStatus = self.db.getDemuxStatus(runId, rundata["ExperimentName"], projects)
         newOps = {pr["Name"]: 0 for pr in projects}
@@ -612,10 +781,10 @@ class Manager(object):
  Demux status:
 """)
             self.mainw.addstr(1, 16, rundata["ExperimentName"], curses.A_BOLD)
-            self.mainw.addstr(2, 16, alldata["FlowcellBarcode"], curses.A_BOLD)
-            self.mainw.addstr(3, 16, str(stats["NumLanes"]), curses.A_BOLD)
-            self.mainw.addstr(4, 16, "{} ({})".format(alldata["InstrumentName"], alldata["InstrumentType"]), curses.A_BOLD)
-            self.mainw.addstr(5, 16, runConfiguration(alldata), curses.A_BOLD)
+            self.mainw.addstr(2, 16, rundata["FlowcellBarcode"], curses.A_BOLD)
+            self.mainw.addstr(3, 16, str(rundata["NumLanes"]), curses.A_BOLD)
+            self.mainw.addstr(4, 16, "{} ({})".format(rundata["InstrumentName"], rundata["InstrumentType"]), curses.A_BOLD)
+            self.mainw.addstr(5, 16, runConfiguration(rundata), curses.A_BOLD)
 
             row = 9
             if projects:
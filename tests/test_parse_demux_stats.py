@@ -0,0 +1,92 @@
+import os
+import sys
+import json
+import random
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "runmgr"))
+
+import parse_demux_stats as pds
+
+def makeStats(seed, nbarcodes=500):
+    """Return the contents of a bcl2fastq Stats.json with two lanes, including ties in the
+unknown barcode counts and strings that need escaping."""
+    rnd = random.Random(seed)
+    def barcode():
+        return "".join([ rnd.choice("ACGT") for i in range(8) ]) + "+" + "".join([ rnd.choice("ACGT") for i in range(8) ])
+    lanes = [1, 2]
+    return {"Flowcell": "FC{}".format(seed), "RunNumber": seed, "RunId": "RUN\"{}\"é".format(seed),
+            "ReadInfosForLanes": [ {"LaneNumber": ln, "ReadInfos": [ {"Number": 1, "NumCycles": 151, "IsIndexedRead": False},
+                                                                     {"Number": 2, "NumCycles": 8, "IsIndexedRead": True} ]}
+                                   for ln in lanes ],
+            "ConversionResults": [ {"LaneNumber": ln, "TotalClustersRaw": 100000, "TotalClustersPF": 90000, "Yield": 1.5e9,
+                                    "DemuxResults": [ {"SampleId": "{}_s".format(i), "SampleName": "smp\\{}".format(i),
+                                                       "NumberReads": rnd.randint(1, 9999), "Yield": rnd.random(),
+                                                       "IndexMetrics": [ {"IndexSequence": barcode(), "MismatchCounts": {"0": 5, "1": 2}} ]}
+                                                      for i in range(10) ],
+                                    "Undetermined": {"NumberReads": 1234, "Yield": None}}
+                                   for ln in lanes ],
+            "UnknownBarcodes": [ {"Lane": ln, "Barcodes": { barcode(): rnd.randint(1, 20) for i in range(nbarcodes) }}
+                                 for ln in lanes ]}
+
+def topBarcodes(data, n):
+    """The reference result: json.load, then the `n' most frequent barcodes of each lane (the first
+ones on equal counts), with the total count of all of them."""
+    for unk in data["UnknownBarcodes"]:
+        bcs = sorted(unk["Barcodes"].items(), key=lambda kv: -kv[1])
+        unk["Total"] = sum(unk["Barcodes"].values())
+        unk["Barcodes"] = dict(bcs[:n])
+    return data
+
+@pytest.fixture(params=["stdlib", "ijson"])
+def reader(request, monkeypatch):
+    if request.param == "ijson":
+        monkeypatch.setattr(pds, "ijson", pytest.importorskip("ijson"))
+    else:
+        monkeypatch.setattr(pds, "ijson", None)
+    return request.param
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("n", [1, 20, 1000])
+def test_read_stats_matches_json_load(tmp_path, reader, seed, n):
+    jf = tmp_path / "Stats.json"
+    jf.write_text(json.dumps(makeStats(seed), indent=seed))
+    with open(str(jf), "r") as f:
+        expected = topBarcodes(json.load(f), n)
+    data = pds.readStats(str(jf), n)
+    assert data == expected
+    for (unk, exp) in zip(data["UnknownBarcodes"], expected["UnknownBarcodes"]):
+        assert list(unk["Barcodes"].items()) == list(exp["Barcodes"].items())
+
+def batchReports(projdir):
+    """Run batch mode on `projdir', returning the mtime of each file in DemuxReports."""
+    M = pds.Main()
+    assert M.parseArgs(["-b", str(projdir), "-j", "1"])
+    M.run()
+    dest = projdir / "DemuxReports"
+    return { p.name: p.stat().st_mtime_ns for p in dest.iterdir() }
+
+def test_batch_rerun_writes_only_changed_projects(tmp_path, capsys):
+    projdir = tmp_path / "RUN1"
+    for (name, seed) in [("P1", 1), ("P2", 2)]:
+        (projdir / name / "Stats").mkdir(parents=True)
+        (projdir / name / "Stats" / "Stats.json").write_text(json.dumps(makeStats(seed, 50)))
+
+    first = batchReports(projdir)
+    assert set(first) == {"P1.html", "P1.txt", "P2.html", "P2.txt", "RUN1.html", "index.html", pds.MANIFEST}
+    assert capsys.readouterr().err.count("Writing report") == 2
+
+    # Same inputs, even with a new mtime: nothing is written but the manifest
+    jf = projdir / "P2" / "Stats" / "Stats.json"
+    os.utime(str(jf), ns=(jf.stat().st_mtime_ns + 10**9,) * 2)
+    second = batchReports(projdir)
+    assert "Writing report" not in capsys.readouterr().err
+    assert { k: v for (k, v) in second.items() if k != pds.MANIFEST } == { k: v for (k, v) in first.items() if k != pds.MANIFEST }
+
+    # A changed Stats.json only rewrites its own project report (and the run report)
+    jf.write_text(json.dumps(makeStats(3, 50)))
+    third = batchReports(projdir)
+    assert [ l for l in capsys.readouterr().err.splitlines() if "Writing report" in l ] == ["Writing report for project P2."]
+    changed = sorted([ k for k in third if third[k] != second[k] ])
+    assert changed == sorted(["P2.html", "P2.txt", "RUN1.html", pds.MANIFEST])
@@ -0,0 +1,147 @@
+import os
+import sys
+import json
+import sqlite3
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "runmgr"))
+
+import rundb
+
+def writeStats(path, lanes):
+    """Write a minimal bcl2fastq Stats.json with two samples in each of `lanes'."""
+    os.makedirs(os.path.dirname(path))
+    data = {"Flowcell": "FC1", "RunNumber": 1, "RunId": "RUN1",
+            "ConversionResults": [ {"LaneNumber": ln, "TotalClustersRaw": 1000, "TotalClustersPF": 900,
+                                    "DemuxResults": [ {"SampleId": "{}_s".format(i), "SampleName": "smp{}".format(i), "NumberReads": 300,
+                                                       "IndexMetrics": [{"IndexSequence": "ACGTACG{}+TTGGCCA{}".format("AC"[i], "AC"[i])}]}
+                                                      for i in range(2) ]}
+                                   for ln in lanes ],
+            "UnknownBarcodes": [ {"Lane": ln, "Barcodes": {"GGGGGGGG+AAAAAAAA": 200}} for ln in lanes ]}
+    with open(path, "w") as f:
+        json.dump(data, f)
+
+def makeDB(tmp_path, *settings):
+    """Return a new RunDB in `tmp_path', with projectsPath and eventsFile in `tmp_path'
+and the additional config `settings'."""
+    conf = tmp_path / "config.sh"
+    conf.write_text("projectsPath={}\neventsFile={}\n".format(tmp_path / "projects", tmp_path / "events.log") +
+                    "".join([ s + "\n" for s in settings ]))
+    DB = rundb.RunDB(configfile=str(conf), persistent=True)
+    DB.dbfile = str(tmp_path / "runs.db")
+    DB.initialize()
+    return DB
+
+def addRun(DB, runId, name, demux, xjob=None):
+    with DB.transaction(write=True):
+        DB.execute("INSERT INTO Runs (Id, ExperimentName, DateCreated, Status) VALUES (?, ?, ?, ?);", runId, name, "2024-01-01", "Complete")
+        DB.execute("INSERT INTO Operations (Id, Download, Demux, Xjob) VALUES (?, ?, ?, ?);", runId, rundb.OP_COMPLETED, demux, xjob)
+
+def test_demux_event_stores_metrics(tmp_path):
+    projects = tmp_path / "projects"
+    events = tmp_path / "events.log"
+    DB = makeDB(tmp_path)
+    addRun(DB, 1, "RUN1", rundb.OP_ONGOING)
+
+    # What pardemux.qsub leaves behind when the demux is done
+    writeStats(str(projects / "RUN1" / "P1" / "Stats" / "Stats.json"), [1, 2])
+    (projects / "RUN1" / "STATUS").write_text("P1\tY\n")
+    events.write_text("2024-01-01T10:00:00\tdemux\tRUN1\t-\tDONE\n")
+
+    assert DB.processEvents() == 1
+    with DB.transaction():
+        assert DB.execute("SELECT Demux FROM Operations WHERE Id=1;").fetchone()[0] == rundb.OP_COMPLETED
+        lanes = [ tuple(row) for row in DB.execute("SELECT Lane, TotalClustersRaw, TotalClustersPF, IdentifiedReads, Undetermined FROM DemuxLanes WHERE RunId=1 ORDER BY Lane;") ]
+        nsamples = DB.execute("SELECT count(*) FROM DemuxSamples WHERE RunId=1;").fetchone()[0]
+    assert lanes == [(1, 1000, 900, 600, 300), (2, 1000, 900, 600, 300)]
+    assert nsamples == 4
+    DB.close()
+
+def test_failed_job_with_marker_finishes_demux(tmp_path, monkeypatch):
+    """A demux job that fails after writing STATUS (e.g. in the reports step) completes the demux."""
+    states = tmp_path / "states"
+    states.write_text("101 FAILED\n102 FAILED\n")
+    monkeypatch.setenv("FAKE_SACCT_STATES", str(states))
+    DB = makeDB(tmp_path, "sacct=" + os.path.join(os.path.dirname(rundb.__file__), "fake_sacct.sh"))
+    addRun(DB, 1, "RUN1", rundb.OP_ONGOING, "101")
+    addRun(DB, 2, "RUN2", rundb.OP_ONGOING, "102")
+    writeStats(str(tmp_path / "projects" / "RUN1" / "P1" / "Stats" / "Stats.json"), [1])
+    (tmp_path / "projects" / "RUN1" / "STATUS").write_text("P1\tY\n")
+
+    DB.reconcileJobs()
+    with DB.transaction():
+        demux = dict([ tuple(row) for row in DB.execute("SELECT Id, Demux FROM Operations;") ])
+        projects = [ tuple(row) for row in DB.execute("SELECT Name, ParentRun FROM Projects;") ]
+        nlanes = DB.execute("SELECT count(*) FROM DemuxLanes WHERE RunId=1;").fetchone()[0]
+    assert demux == {1: rundb.OP_COMPLETED, 2: rundb.OP_FAILED}
+    assert projects == [("P1", 1)]
+    assert nlanes == 1
+    DB.close()
+
+def test_task_error_does_not_undo_other_tasks(tmp_path):
+    """An error applying one task's result leaves the other results of the cycle in place."""
+    DB = makeDB(tmp_path, "updateWorkers=0")
+    addRun(DB, 1, "RUN1", rundb.OP_ONGOING)
+    addRun(DB, 2, "RUN2", rundb.OP_ONGOING)
+    for (name, status) in [("RUN1", "P1\tY\n"), ("RUN2", "P2\n")]:     # RUN2's STATUS is malformed
+        writeStats(str(tmp_path / "projects" / name / "P" / "Stats" / "Stats.json"), [1])
+        (tmp_path / "projects" / name / "STATUS").write_text(status)
+
+    DB.checkDemux()
+    with DB.transaction():
+        demux = dict([ tuple(row) for row in DB.execute("SELECT Id, Demux FROM Operations;") ])
+        projects = [ tuple(row) for row in DB.execute("SELECT Name, ParentRun FROM Projects;") ]
+        lanes = [ row[0] for row in DB.execute("SELECT RunId FROM DemuxLanes;") ]
+    assert demux == {1: rundb.OP_COMPLETED, 2: rundb.OP_ONGOING}
+    assert projects == [("P1", 1)]
+    assert lanes == [1]
+    DB.close()
+
+def test_events_are_read_again_after_an_error(tmp_path, monkeypatch):
+    DB = makeDB(tmp_path)
+    addRun(DB, 1, "RUN1", rundb.OP_ONGOING)
+    writeStats(str(tmp_path / "projects" / "RUN1" / "P1" / "Stats" / "Stats.json"), [1])
+    (tmp_path / "projects" / "RUN1" / "STATUS").write_text("P1\tY\n")
+    (tmp_path / "events.log").write_text("2024-01-01T10:00:00\tdemux\tRUN1\t-\tDONE\n")
+
+    def broken(*args):
+        raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(DB, "finishDemux", broken)
+    with pytest.raises(sqlite3.OperationalError):
+        DB.processEvents()
+    assert DB.getSetting("EventOffset") is None
+
+    monkeypatch.undo()
+    assert DB.processEvents() == 1
+    assert DB.processEvents() == 0
+    with DB.transaction():
+        assert DB.execute("SELECT Demux FROM Operations WHERE Id=1;").fetchone()[0] == rundb.OP_COMPLETED
+    DB.close()
+
+def fakeCommand(path, jobid):
+    """Write a stand-in for sbatch or submit that logs its arguments and prints `jobid'."""
+    path.write_text("#!/bin/bash\necho \"$@\" >> {}.log\necho {}\n".format(path, jobid))
+    path.chmod(0o755)
+    return str(path)
+
+def test_array_mode_keeps_own_submit_commands(tmp_path):
+    sbatch = fakeCommand(tmp_path / "sbatch", "500")
+    submit = fakeCommand(tmp_path / "submit", "Submitted job 600")
+    script = tmp_path / "job.qsub"
+    script.write_text("#!/bin/bash\n#SBATCH --mem=1G\n")
+
+    DB = makeDB(tmp_path, "submitMode=array", "sbatch=" + sbatch)
+    jobs = [rundb.Job(str(script), ["a"]), rundb.Job(str(script), ["b"]), rundb.Job(str(script), ["c"], submit=submit)]
+    DB.submitJobs(jobs)
+    assert [ job.jobid for job in jobs ] == ["500_0", "500_1", "600"]
+    assert len((tmp_path / "sbatch.log").read_text().splitlines()) == 1
+    DB.close()
+
+    # Jobs are submitted one by one with their submit command by default
+    DB = makeDB(tmp_path)
+    jobs = [rundb.Job(str(script), ["d"], submit=submit)]
+    DB.submitJobs(jobs)
+    assert jobs[0].jobid == "600"
+    assert (tmp_path / "submit.log").read_text().splitlines()[-1] == "{} d".format(script)
+    DB.close()
@@ -0,0 +1,92 @@
+import os
+import sys
+import random
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "runmgr"))
+
+import SampleSheet
+
+def randomBarcodes(seed, n=60):
+    """Return `n' (i7, i5) pairs close to each other, with mixed lengths, single indexes and Ns."""
+    rnd = random.Random(seed)
+    bases = [ "".join([ rnd.choice("ACGT") for i in range(10) ]) for k in range(4) ]
+    result = []
+    for k in range(n):
+        i7 = list(rnd.choice(bases))
+        i5 = list(rnd.choice(bases))
+        for m in range(rnd.randint(0, 3)):
+            seq = rnd.choice([i7, i5])
+            seq[rnd.randrange(len(seq))] = rnd.choice("ACGTN" if k % 10 == 0 else "ACGT")
+        i7 = "".join(i7)[:rnd.choice([8, 10])]
+        i5 = "".join(i5)[:rnd.choice([0, 8, 10])]
+        result.append((i7, i5))
+    return result
+
+def makeSamples(barcodes):
+    smps = []
+    for (i7, i5) in barcodes:
+        smp = SampleSheet.Sample("1", "s{}".format(len(smps)))
+        smp.i7index = i7
+        smp.i5index = i5
+        smps.append(smp)
+    return smps
+
+def pairwise(barcodes, maxdist):
+    """The reference result: distance() on every pair."""
+    result = []
+    for i in range(len(barcodes)):
+        for j in range(i+1, len(barcodes)):
+            d = SampleSheet.distance(barcodes[i][0], barcodes[j][0], barcodes[i][1], barcodes[j][1])
+            if d <= maxdist:
+                result.append((i, j, d))
+    return result
+
+@pytest.fixture(params=["numpy", "python"])
+def backend(request, monkeypatch):
+    if request.param == "numpy":
+        if SampleSheet.np is None:
+            pytest.skip("numpy not available")
+    else:
+        monkeypatch.setattr(SampleSheet, "np", None)
+    return request.param
+
+@pytest.mark.parametrize("seed", range(5))
+def test_matrix_matches_pairwise_distance(backend, seed):
+    barcodes = randomBarcodes(seed)
+    matrix = SampleSheet.BarcodeMatrix(makeSamples(barcodes))
+    for maxdist in [0, 1, 2, 3]:
+        assert matrix.pairs(maxdist) == pairwise(barcodes, maxdist)
+    assert matrix.minDistance() == min([ d for (i, j, d) in pairwise(barcodes, 100) ])
+
+def test_matrix_min_distance_default(backend):
+    assert SampleSheet.BarcodeMatrix(makeSamples([("ACGTACGT", "")])).minDistance() == 100
+    assert SampleSheet.BarcodeMatrix(makeSamples([])).minDistance(5) == 5
+
+@pytest.mark.parametrize("seed", range(5))
+def test_similar_barcodes_matches_distance(backend, seed):
+    seqs = [ i7 for (i7, i5) in randomBarcodes(seed) ]
+    for bc in seqs[:5]:
+        expected = [ (i, SampleSheet.distance(bc, seqs[i], "", "")) for i in range(len(seqs))
+                     if SampleSheet.distance(bc, seqs[i], "", "") <= 2 ]
+        assert SampleSheet.similarBarcodes(bc, seqs, 2) == expected
+
+@pytest.mark.parametrize("seed", range(5))
+def test_index_matches_pairwise_distance(backend, seed):
+    barcodes = randomBarcodes(seed)
+    index = SampleSheet.BarcodeIndex(makeSamples(barcodes))
+    for maxdist in [0, 1, 2, 3]:
+        assert index.conflicts(maxdist) == pairwise(barcodes, maxdist)
+    assert index.minDistance() == min([ d for (i, j, d) in pairwise(barcodes, 100) ])
+    (i7, i5) = barcodes[0]
+    expected = sorted([ (p, SampleSheet.distance(i7, barcodes[p][0], i5, barcodes[p][1])) for p in range(len(barcodes))
+                        if SampleSheet.distance(i7, barcodes[p][0], i5, barcodes[p][1]) <= 1 ])
+    assert index.query(i7, i5, 1) == expected
+
+def test_index_min_distance_beyond_two(backend):
+    barcodes = [("AAAAAAAA", "CCCCCCCC"), ("AAAATTTT", "CCCCCCCC"), ("TTTTAAAA", "GGGGCCCC"), ("ACGT", "")]
+    index = SampleSheet.BarcodeIndex(makeSamples(barcodes))
+    assert index.conflicts(2) == []
+    assert index.minDistance() == min([ d for (i, j, d) in pairwise(barcodes, 100) ])
+    assert SampleSheet.BarcodeIndex(makeSamples(barcodes[:1])).minDistance() == 100